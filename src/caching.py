@@ -0,0 +1,103 @@
+"""Helpers for content-addressed on-disk caches.
+
+Several intermediate products (contraction hierarchies, travel matrices, ...)
+are expensive to build but depend only on the bytes of their inputs. We key
+them by a hash of those inputs so that a changed input is never served a stale
+result, and we write them atomically so that concurrent workers never see a
+half-written file.
+"""
+
+import contextlib
+import hashlib
+import os
+import tempfile
+
+
+
+#Memoized file hashes keyed by (path, size, mtime) so that a file is only read
+#once per process unless it changes
+_file_hash_memo = {}
+
+
+
+def FileHash(filename, block_size=2**20):
+  """Returns the sha256 hex digest of a file's contents.
+
+  Args:
+    filename (str):   File to hash
+    block_size (int): How many bytes to read at a time
+
+  Returns: Hex digest (str)
+  """
+  st  = os.stat(filename)
+  key = (os.path.abspath(filename), st.st_size, st.st_mtime_ns)
+  if key not in _file_hash_memo:
+    h = hashlib.sha256()
+    with open(filename, 'rb') as fin:
+      for block in iter(lambda: fin.read(block_size), b''):
+        h.update(block)
+    _file_hash_memo[key] = h.hexdigest()
+  return _file_hash_memo[key]
+
+
+
+def FileStat(filename):
+  """Returns a file's [size, mtime_ns]. Recorded beside the file's hash, it
+  lets `FileUnchanged()` skip reading files that haven't been touched."""
+  st = os.stat(filename)
+  return [st.st_size, st.st_mtime_ns]
+
+
+
+def FileUnchanged(filename, sha256, stat=None):
+  """Whether a file still has the contents whose hash was `sha256`.
+
+  Args:
+    filename (str): File to check
+    sha256 (str):   Hex digest recorded for the file
+    stat (list):    [size, mtime_ns] recorded with the hash, if any. If the
+                    file's still match, it is taken to be unchanged unread.
+
+  Returns: bool
+  """
+  if not os.path.isfile(filename):
+    return False
+  if stat is not None and FileStat(filename)==list(stat):
+    return True
+  return FileHash(filename)==sha256
+
+
+
+def GetCacheDir(cache_dir, near_file):
+  """Returns (and creates, if needed) a cache directory.
+
+  Args:
+    cache_dir (str): Cache directory to use. If None, a `cache/` directory next
+                     to `near_file` is used.
+    near_file (str): File next to which the default cache directory lives
+
+  Returns: Path of the cache directory (str)
+  """
+  if cache_dir is None:
+    cache_dir = os.path.join(os.path.dirname(os.path.abspath(near_file)), 'cache')
+  os.makedirs(cache_dir, exist_ok=True)
+  return cache_dir
+
+
+
+@contextlib.contextmanager
+def AtomicWrite(filename):
+  """Yields a temporary filename which is moved to `filename` once the body of
+  the `with` block completes successfully. If the body raises, the temporary
+  file is removed and `filename` is left untouched.
+  """
+  dirname, basename = os.path.split(os.path.abspath(filename))
+  fd, temp_filename = tempfile.mkstemp(prefix=f".{basename}.", dir=dirname)
+  os.close(fd)
+  try:
+    yield temp_filename
+    os.replace(temp_filename, filename)
+  except BaseException:
+    if os.path.exists(temp_filename):
+      os.remove(temp_filename)
+    raise
@@ -0,0 +1,251 @@
+"""Typed, column-per-file storage for tables.
+
+`parse_gtfs.py` writes large tables that `sim.py` reads back, usually only in
+part. Round-tripping them through CSV means formatting and re-parsing every
+value of every column and guessing dtypes on the way back. Here a table is a
+directory holding one raw binary file per column plus a small `_meta.json`
+giving the number of rows and each column's NumPy dtype. Reading a column is a
+single `np.fromfile()` and only the requested columns are touched.
+
+Strings are dictionary-encoded: the column's file holds an int32 code per row
+(-1 for a missing value) indexing a vocabulary kept beside it as the UTF-8
+bytes of each distinct string and the offset at which each one ends. Appending
+rows only ever adds to the ends of these files. Other columns whose values
+are all numbers are stored as numbers, which is the dtype reading them back
+from a CSV would have given them; identifiers, which may have leading zeros or
+only some of which may be numbers, should be named in `WriteTable()`'s
+`strings` so that they are always kept as strings.
+
+A table's column types are fixed when it is written. Appended rows must fit
+them, so stored values are never converted.
+"""
+
+
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+import caching
+
+
+
+META_FILENAME = '_meta.json'
+
+
+
+def IsTable(dirname):
+  """Whether `dirname` holds a table written by `WriteTable()`."""
+  return os.path.exists(os.path.join(dirname, META_FILENAME))
+
+
+
+def _ColumnFilename(dirname, column):
+  return os.path.join(dirname, f'{column}.bin')
+
+
+
+def _VocabFilenames(dirname, column):
+  """Returns the files holding a string column's vocabulary: the UTF-8 bytes of
+  its strings and the offset (int64) at which each of them ends."""
+  return (os.path.join(dirname, f'{column}.strings.bin'),
+          os.path.join(dirname, f'{column}.offsets.bin'))
+
+
+
+def _ReadMeta(dirname):
+  with open(os.path.join(dirname, META_FILENAME), 'r') as f:
+    return json.load(f)
+
+
+
+def _WriteMeta(dirname, meta):
+  #The metadata is written last and atomically, so a table interrupted while
+  #being written or appended to still reads back as its last complete state
+  with caching.AtomicWrite(os.path.join(dirname, META_FILENAME)) as temp_filename:
+    with open(temp_filename, 'w') as f:
+      json.dump(meta, f, indent=2)
+
+
+
+def _ColumnArray(col, as_strings=False):
+  """Returns a column of a DataFrame as a NumPy array. Columns are stored as
+  numbers if they can be, unless `as_strings`. Strings are returned as an
+  object array with None for missing values."""
+  if not as_strings:
+    if pd.api.types.is_numeric_dtype(col) or pd.api.types.is_bool_dtype(col):
+      return col.to_numpy()
+    try:
+      return pd.to_numeric(col).to_numpy()
+    except (ValueError, TypeError):
+      pass
+  present = col.notna().to_numpy()
+  values  = np.full(len(col), None, dtype=object)
+  values[present] = col[present].astype(str).to_numpy(dtype=object)
+  return values
+
+
+
+def _IsStrings(info):
+  return 'vocab' in info
+
+
+
+def _StringsInfo(name):
+  return {'name': name, 'dtype': np.dtype('<i4').str, 'vocab': 0, 'vocab_bytes': 0}
+
+
+
+def _Truncated(filename, size):
+  """Opens `filename` for appending after its first `size` bytes. Anything
+  past them is left over from an interrupted append."""
+  f = open(filename, 'r+b' if os.path.exists(filename) else 'wb')
+  f.seek(size)
+  f.truncate()
+  return f
+
+
+
+def _ReadVocab(dirname, info):
+  """Returns a string column's vocabulary as a list."""
+  strings_filename, offsets_filename = _VocabFilenames(dirname, info['name'])
+  if info['vocab']==0:
+    return []
+  ends = np.fromfile(offsets_filename, dtype='<i8', count=info['vocab'])
+  with open(strings_filename, 'rb') as f:
+    data = f.read(info['vocab_bytes'])
+  starts = np.concatenate(([0], ends[:-1]))
+  return [data[a:b].decode('utf-8') for a, b in zip(starts, ends)]
+
+
+
+def _AppendStrings(dirname, info, values, rows):
+  """Appends strings (None where missing) to a dictionary-encoded column which
+  holds `rows` rows, adding any new strings to the end of its vocabulary."""
+  vocab   = _ReadVocab(dirname, info)
+  present = values[pd.notna(values)]
+  unique  = pd.unique(present)
+  new     = [x for x in unique[~pd.Index(unique, dtype=object).isin(vocab)]]
+
+  strings_filename, offsets_filename = _VocabFilenames(dirname, info['name'])
+  encoded = [x.encode('utf-8') for x in new]
+  ends    = info['vocab_bytes']+np.cumsum([len(x) for x in encoded], dtype='<i8')
+  with _Truncated(strings_filename, info['vocab_bytes']) as f:
+    f.write(b''.join(encoded))
+  with _Truncated(offsets_filename, info['vocab']*8) as f:
+    ends.astype('<i8').tofile(f)
+  info['vocab']      += len(new)
+  info['vocab_bytes'] = int(ends[-1]) if len(new) else info['vocab_bytes']
+
+  codes = pd.Index(vocab+new, dtype=object).get_indexer(values).astype('<i4')
+  with _Truncated(_ColumnFilename(dirname, info['name']), rows*4) as f:
+    codes.tofile(f)
+
+
+
+def _ReadStrings(dirname, info, rows):
+  """Returns a dictionary-encoded column as an object array, NaN where a value
+  is missing."""
+  codes  = np.fromfile(_ColumnFilename(dirname, info['name']), dtype='<i4', count=rows)
+  vocab  = np.array(_ReadVocab(dirname, info)+[np.nan], dtype=object)
+  return vocab[np.where(codes>=0, codes, len(vocab)-1)]
+
+
+
+def WriteTable(dirname, df, strings=()):
+  """Writes a DataFrame as a columnar table, replacing any existing table.
+
+  Args:
+    dirname (str):         Directory to hold the table
+    df (pandas.DataFrame): Table to write. The index is not stored.
+    strings (list):        Columns to store as strings whatever their values.
+                           Other columns are stored as numbers if they can be.
+  """
+  if os.path.exists(dirname):
+    shutil.rmtree(dirname)
+  os.makedirs(dirname)
+  meta = {'rows': 0, 'columns': []}
+  for column in df.columns:
+    values = _ColumnArray(df[column], as_strings=(column in strings))
+    if values.dtype==object:
+      meta['columns'].append(_StringsInfo(column))
+    else:
+      meta['columns'].append({'name': column, 'dtype': values.dtype.str})
+  _WriteMeta(dirname, meta)
+  AppendTable(dirname, df)
+
+
+
+def AppendTable(dirname, df):
+  """Appends the rows of a DataFrame to a table written by `WriteTable()`.
+
+  `df` must have the table's columns. Values appended to a string column are
+  stored as strings. Those appended to a numeric column must be numbers which
+  its dtype holds exactly (ints in a float column, but not floats in an int
+  column); otherwise an exception is raised and the table is left as it was.
+
+  Args:
+    dirname (str):         Directory holding the table
+    df (pandas.DataFrame): Rows to append
+  """
+  meta = _ReadMeta(dirname)
+  rows = meta['rows']
+
+  #Check every column before anything is written
+  columns = []
+  for info in meta['columns']:
+    values = _ColumnArray(df[info['name']], as_strings=_IsStrings(info))
+    if not _IsStrings(info) and not np.can_cast(values.dtype, np.dtype(info['dtype']), casting='safe'):
+      raise Exception(f"Column '{info['name']}' of table {dirname} is stored as {np.dtype(info['dtype'])} "
+                      f"and can't take values of dtype {values.dtype}!")
+    columns.append((info, values))
+
+  for info, values in columns:
+    if _IsStrings(info):
+      _AppendStrings(dirname, info, values, rows)
+      continue
+    dtype = np.dtype(info['dtype'])
+    with _Truncated(_ColumnFilename(dirname, info['name']), rows*dtype.itemsize) as f:
+      values.astype(dtype).tofile(f)
+  meta['rows'] += len(df)
+  _WriteMeta(dirname, meta)
+
+
+
+def TableColumns(dirname):
+  """Returns the names of a table's columns, in order."""
+  return [x['name'] for x in _ReadMeta(dirname)['columns']]
+
+
+
+def ReadTable(dirname, columns=None):
+  """Reads a table written by `WriteTable()`.
+
+  Args:
+    dirname (str):   Directory holding the table
+    columns (list):  Columns to read, in the order wanted. None reads them all.
+
+  Returns: pandas.DataFrame
+  """
+  meta  = _ReadMeta(dirname)
+  infos = {x['name']: x for x in meta['columns']}
+  if columns is None:
+    columns = list(infos)
+  missing = [c for c in columns if c not in infos]
+  if missing:
+    raise Exception(f"Table {dirname} has no columns {missing}!")
+  data = {}
+  for c in columns:
+    if _IsStrings(infos[c]):
+      data[c] = _ReadStrings(dirname, infos[c], meta['rows'])
+    else:
+      data[c] = np.fromfile(_ColumnFilename(dirname, c), dtype=np.dtype(infos[c]['dtype']), count=meta['rows'])
+  return pd.DataFrame(data, columns=columns)
+
+
+
+def ExportCSV(dirname, csv_filename):
+  """Writes a table written by `WriteTable()` out as a CSV."""
+  ReadTable(dirname).to_csv(csv_filename, index=False)
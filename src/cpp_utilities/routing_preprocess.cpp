@@ -16,11 +16,13 @@ namespace rk = RoutingKit;
 
 
 int main(int argc, char **argv){
-  if(argc!=3){
-    std::cout<<"Syntax: "<<argv[0]<<" <Input File .osm.pbf> <Output File>"<<std::endl;
+  if(argc!=3 && argc!=4){
+    std::cout<<"Syntax: "<<argv[0]<<" <Input File .osm.pbf> <Output File> [Output Graph Snapshot]"<<std::endl;
     return -1;
   }
 
   Router router(argv[1]);
   router.save_ch(argv[2]);
+  if(argc==4)
+    router.save_snapshot(argv[3]);
 }
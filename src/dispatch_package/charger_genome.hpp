@@ -0,0 +1,59 @@
+#pragma once
+
+#include <bitset>
+#include <cstdint>
+#include <vector>
+
+///Which of a model's charger-eligible stops have a charger, packed one bit per
+///stop. Bit `g` refers to the stop `ModelInfo::genome_stops[g]`.
+class ChargerGenome {
+ public:
+  ChargerGenome() = default;
+  explicit ChargerGenome(const size_t size) : bits(size), words((size+63)/64, 0) {}
+
+  size_t size() const { return bits; }
+
+  bool test(const size_t g) const {
+    return (words[g/64]>>(g%64)) & 1;
+  }
+
+  void set(const size_t g, const bool value){
+    if(test(g)!=value)
+      flip(g);
+  }
+
+  void flip(const size_t g){
+    words[g/64] ^= uint64_t(1)<<(g%64);
+  }
+
+  ///Number of stops with a charger
+  int32_t count() const {
+    int32_t total = 0;
+    for(const auto &w: words)
+      total += std::bitset<64>(w).count();
+    return total;
+  }
+
+  uint64_t hash() const {
+    uint64_t h = bits;
+    for(const auto &w: words)
+      h = mix(h ^ w);
+    return h;
+  }
+
+  bool operator==(const ChargerGenome &o) const {
+    return bits==o.bits && words==o.words;
+  }
+
+ private:
+  size_t bits = 0;
+  std::vector<uint64_t> words;
+
+  //splitmix64 finalizer
+  static uint64_t mix(uint64_t x){
+    x += 0x9e3779b97f4a7c15;
+    x = (x ^ (x >> 30)) * 0xbf58476d1ce4e5b9;
+    x = (x ^ (x >> 27)) * 0x94d049bb133111eb;
+    return x ^ (x >> 31);
+  }
+};
@@ -71,4 +71,69 @@ trips_t csv_trips_to_internal(const std::string &inpstr){
   }
 
   return trips;
-}
\ No newline at end of file
+}
+
+
+
+stops_t columns_stops_to_internal(
+  const size_t N,
+  const int64_t *stop_id,
+  const int64_t *depot_id,
+  const double  *depot_time,
+  const double  *depot_distance
+){
+  stops_t stops;
+  stops.reserve(N);
+
+  for(size_t i=0;i<N;i++){
+    const stop_id_t sid(stop_id[i]);
+    if(stops.count(sid)!=0)
+      throw std::runtime_error("stop_id was in the table twice!");
+    stops[sid] = StopInfo{
+      sid,
+      depot_id_t(depot_id[i]),
+      seconds(depot_time[i]),
+      meters(depot_distance[i])
+    };
+  }
+
+  return stops;
+}
+
+
+
+trips_t columns_trips_to_internal(
+  const size_t N,
+  const std::vector<std::string> &trip_id,
+  const int64_t *block_id,
+  const double  *start_arrival_time,
+  const int64_t *start_stop_id,
+  const double  *end_arrival_time,
+  const int64_t *end_stop_id,
+  const double  *distance,
+  const double  *wait_time
+){
+  trips_t trips;
+  trips.reserve(N);
+
+  for(size_t i=0;i<N;i++){
+    trips.push_back(TripInfo{
+      trip_id.at(i),
+      block_id_t(block_id[i]),
+      seconds(start_arrival_time[i]),
+      stop_id_t(start_stop_id[i]),
+      seconds(end_arrival_time[i]),
+      stop_id_t(end_stop_id[i]),
+      meters(distance[i]),
+      seconds(wait_time[i]),
+      seconds::invalid(),        //bus_busy_start
+      seconds::invalid(),        //bus_busy_end
+      -1,                        //bus_id
+      depot_id_t::invalid(),     //start_depot_id
+      depot_id_t::invalid(),     //end_depot_id
+      kilowatt_hours::invalid(), //energy_left
+    });
+  }
+
+  return trips;
+}
@@ -2,7 +2,30 @@
 
 #include "data_structures.hpp"
 
+#include <cstdint>
 #include <string>
+#include <vector>
 
 stops_t csv_stops_to_internal(const std::string &inpstr);
-trips_t csv_trips_to_internal(const std::string &inpstr);
\ No newline at end of file
+trips_t csv_trips_to_internal(const std::string &inpstr);
+
+//Build the internal tables directly from column arrays, each of which holds
+//`N` elements
+stops_t columns_stops_to_internal(
+  const size_t N,
+  const int64_t *stop_id,
+  const int64_t *depot_id,
+  const double  *depot_time,
+  const double  *depot_distance
+);
+trips_t columns_trips_to_internal(
+  const size_t N,
+  const std::vector<std::string> &trip_id,
+  const int64_t *block_id,
+  const double  *start_arrival_time,
+  const int64_t *start_stop_id,
+  const double  *end_arrival_time,
+  const int64_t *end_stop_id,
+  const double  *distance,
+  const double  *wait_time
+);
@@ -1,7 +1,9 @@
 #pragma once
 
+#include <limits>
 #include <ostream>
 #include <sstream>
+#include <string>
 #include <unordered_map>
 #include <vector>
 
@@ -26,12 +28,19 @@ struct Parameters {
   dollars         nondepot_charger_cost = 600'000.0_dollars;
   kilowatts       nondepot_charger_rate = 500.0_kW;
   int32_t         chargers_per_depot    = 1; //TODO: Bad default
+  std::string         optimizer     = "genetic"; //"genetic" or "local_search"
+  std::string         local_search_start = "none"; //Local search starts with chargers at "none" or "all" of the candidate stops
   std::vector<int>    generations   = {{100, 100,1000}};
   std::vector<double> mutation_rate = {{0.1,0.05,0.01}};
   std::vector<int>    keep_top      = {{  5,   5,   5}};
   std::vector<int>    spawn_size    = {{ 50,  50, 100}};
-  int                 restarts      = 1;
+  std::vector<int>    patience        = {}; //Per stage: stop after this many generations without improvement. 0 or missing disables.
+  std::vector<double> min_improvement = {}; //Per stage: smallest relative drop in the best cost that counts as an improvement
+  std::vector<double> time_limit      = {}; //Per stage: stop after this many seconds. 0 or missing disables.
+  int                 restarts      = 1;     //Number of islands evolved in parallel
+  int                 migration_interval = 0; //Generations between migrations of islands' best individuals. 0 disables.
   uint32_t            seed          = 0;     //Initialize using random device
+  int32_t             fitness_cache_size = 100'000; //Max charger configurations whose costs are remembered. 0 disables.
   std::string repr() const {
     std::ostringstream oss;
     oss << "<dispatch.Parameters "
@@ -44,12 +53,19 @@ struct Parameters {
       << ", nondepot_charger_cost=" << nondepot_charger_cost
       << ", nondepot_charger_rate=" << nondepot_charger_rate
       << ", chargers_per_depot="    << chargers_per_depot
+      << ", optimizer="             << optimizer
+      << ", local_search_start="    << local_search_start
       << ", generations=[vec]"
       << ", mutation_rate=[vec]"
       << ", keep_top=[vec]"
       << ", spawn_size=[vec]"
+      << ", patience=[vec]"
+      << ", min_improvement=[vec]"
+      << ", time_limit=[vec]"
       << ", restarts="              << restarts
+      << ", migration_interval="    << migration_interval
       << ", seed="                  << seed
+      << ", fitness_cache_size="    << fitness_cache_size
       << ">";
     return oss.str();
   }
@@ -136,6 +152,59 @@ struct TripInfo {
 };
 
 
+//Everything the simulation needs to know about a trip, with the stop lookups
+//and parameter-dependent energies worked out ahead of time. See
+//ModelInfo::sim_trips.
+struct SimTrip {
+  seconds        start_arrival_time;
+  seconds        end_arrival_time;
+  kilowatt_hours energy;              //Energy used by the trip itself
+  kilowatt_hours charge_energy;       //Energy gained while waiting at the end stop, if it has a charger
+  kilowatt_hours start_depot_energy;  //Energy used getting from the depot to the start stop
+  kilowatt_hours end_depot_energy;    //Energy used getting from the end stop to the depot
+  seconds        start_depot_time;
+  seconds        end_depot_time;
+  depot_id_t     start_depot_id;
+  depot_id_t     end_depot_id;
+  uint32_t       start_depot;         //Dense indices of the depots in ModelInfo::depot_ids
+  uint32_t       end_depot;
+  uint32_t       end_gene;            //Index of the end stop in ModelInfo::genome_stops or `no_gene`
+
+  static constexpr uint32_t no_gene = std::numeric_limits<uint32_t>::max();
+};
+
+
+
+//What happened to the bus serving a trip. Produced by simulating a block and
+//copied into the corresponding TripInfo.
+struct TripOutcome {
+  seconds        bus_busy_start;
+  seconds        bus_busy_end;
+  int32_t        bus_id;              //Index of the bus within its block
+  depot_id_t     start_depot_id;
+  depot_id_t     end_depot_id;
+  kilowatt_hours energy_left;
+};
+
+
+
+//A bus leaving (+1) or returning to (-1) a depot
+struct DepotEvent {
+  seconds  time;
+  uint32_t depot;   //Dense index of the depot, see ModelInfo::depot_ids
+  int8_t   delta;
+};
+
+
+
+//The depot events generated by the buses serving one block, in `event_order`
+//(see depot_occupancy.hpp) so that each depot's events form a sorted run. This
+//is all the costing needs to know about a block.
+struct BlockResult {
+  std::vector<DepotEvent> events;
+};
+
+
 typedef std::vector<TripInfo> trips_t;
 typedef std::unordered_map<stop_id_t, StopInfo> stops_t;
 typedef std::unordered_map<stop_id_t, bool> HasCharger;
\ No newline at end of file
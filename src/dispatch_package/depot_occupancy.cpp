@@ -0,0 +1,245 @@
+#include <algorithm>
+
+#include "depot_occupancy.hpp"
+
+void DepotOccupancy::reset(const size_t depot_count){
+  events.clear();
+  first.assign(depot_count+1, 0);
+  peaks.assign(depot_count, 0);
+  peak_times.assign(depot_count, seconds(0.0));
+}
+
+
+
+void DepotOccupancy::sweep(){
+  const auto depots = peaks.size();
+
+  //Bucket the events by depot
+  std::fill(first.begin(), first.end(), 0);
+  for(const auto &e: events)
+    first[e.depot+1]++;
+  for(size_t d=1;d<=depots;d++)
+    first[d] += first[d-1];
+  fill.assign(first.begin(), first.end()-1);
+  sorted.resize(events.size());
+  for(const auto &e: events)
+    sorted[fill[e.depot]++] = e;
+
+  for(size_t d=0;d<depots;d++){
+    const auto begin = sorted.begin()+first[d];
+    const auto end   = sorted.begin()+first[d+1];
+    std::sort(begin, end, [](const DepotEvent &a, const DepotEvent &b){
+      return a.time<b.time || (a.time==b.time && a.delta<b.delta);
+    });
+
+    //Running count of buses out of the depot
+    int32_t buses = 0;
+    peaks[d] = 0;
+    for(auto e=begin;e!=end;e++){
+      buses += e->delta;
+      if(buses>peaks[d]){
+        peaks[d]      = buses;
+        peak_times[d] = e->time;
+      }
+    }
+  }
+}
+
+
+
+int32_t DepotOccupancy::total_peak() const {
+  int32_t total = 0;
+  for(const auto &p: peaks)
+    total += p;
+  return total;
+}
+
+
+
+int32_t DepotOccupancy::depots_used() const {
+  int32_t count = 0;
+  for(size_t d=0;d<depot_count();d++)
+    count += used(d);
+  return count;
+}
+
+
+
+int32_t total_peak(const depot_profiles_t &profiles){
+  int32_t total = 0;
+  for(const auto &p: profiles)
+    total += p ? p->peak : 0;
+  return total;
+}
+
+
+
+int32_t depots_used(const depot_profiles_t &profiles){
+  int32_t count = 0;
+  for(const auto &p: profiles)
+    count += p && !p->events.empty();
+  return count;
+}
+
+
+
+namespace {
+
+typedef std::vector<DepotEvent>::const_iterator event_iterator;
+
+///Call `f(event)`, in `event_order`, for each of one depot's `events` which is
+///not matched by one of `removed` and for each of `added`. `removed` must be a
+///sub-multiset of `events`; all three must be in `event_order`.
+template<class F>
+void merge_events(
+  const std::vector<DepotEvent> &events,
+  event_iterator removed, const event_iterator removed_end,
+  event_iterator added,   const event_iterator added_end,
+  F f
+){
+  const auto same = [](const DepotEvent &a, const DepotEvent &b){ return a.time==b.time && a.delta==b.delta; };
+  auto e = events.begin();
+  while(e!=events.end() || added!=added_end){
+    if(e!=events.end() && removed!=removed_end && same(*e, *removed)){
+      ++e;
+      ++removed;
+    } else if(added==added_end || (e!=events.end() && !event_order(*added, *e))){
+      f(*e++);
+    } else {
+      f(*added++);
+    }
+  }
+}
+
+///Tracks the running count of buses out of a depot to find its peak
+struct PeakFinder {
+  int32_t buses     = 0;
+  int32_t peak      = 0;
+  seconds peak_time = seconds(0.0);
+  void operator()(const DepotEvent &e){
+    buses += e.delta;
+    if(buses>peak){
+      peak      = buses;
+      peak_time = e.time;
+    }
+  }
+};
+
+const std::vector<DepotEvent> no_events;
+
+}
+
+
+
+template<class F>
+void DepotPatch::for_each_depot(F f){
+  std::sort(removed.begin(), removed.end(), event_order);
+  std::sort(added.begin(),   added.end(),   event_order);
+  auto r = removed.cbegin();
+  auto a = added.cbegin();
+  while(r!=removed.cend() || a!=added.cend()){
+    const auto depot = (a==added.cend() || (r!=removed.cend() && r->depot<a->depot)) ? r->depot : a->depot;
+    const auto r_end = std::find_if(r, removed.cend(), [&](const DepotEvent &e){ return e.depot!=depot; });
+    const auto a_end = std::find_if(a, added.cend(),   [&](const DepotEvent &e){ return e.depot!=depot; });
+    f(depot, r, r_end, a, a_end);
+    r = r_end;
+    a = a_end;
+  }
+}
+
+
+
+void DepotPatch::apply(depot_profiles_t &profiles){
+  for_each_depot([&](const uint32_t depot, event_iterator r, event_iterator r_end, event_iterator a, event_iterator a_end){
+    const auto &old = profiles.at(depot) ? profiles[depot]->events : no_events;
+    auto profile = std::make_shared<DepotProfile>();
+    profile->events.reserve(old.size()+(a_end-a)-(r_end-r));
+    PeakFinder peak;
+    merge_events(old, r, r_end, a, a_end, [&](const DepotEvent &e){
+      profile->events.push_back(e);
+      peak(e);
+    });
+    profile->peak      = peak.peak;
+    profile->peak_time = peak.peak_time;
+    profiles[depot] = std::move(profile);
+  });
+}
+
+
+
+std::pair<int32_t, int32_t> DepotPatch::score(const depot_profiles_t &profiles){
+  int32_t peak_change = 0;
+  int32_t used_change = 0;
+  for_each_depot([&](const uint32_t depot, event_iterator r, event_iterator r_end, event_iterator a, event_iterator a_end){
+    const auto &old = profiles.at(depot) ? profiles[depot]->events : no_events;
+    PeakFinder peak;
+    size_t count = 0;
+    merge_events(old, r, r_end, a, a_end, [&](const DepotEvent &e){
+      peak(e);
+      count++;
+    });
+    peak_change += peak.peak-(profiles[depot] ? profiles[depot]->peak : 0);
+    used_change += (count>0)-(!old.empty());
+  });
+  return {peak_change, used_change};
+}
+
+
+
+namespace {
+
+///Peaks, and the time series if `with_series`, of the depots `trips` use
+DepotUsage sweep_trips(const trips_t &trips, const bool with_series){
+  //Give each depot the trips use a dense index
+  std::vector<depot_id_t> depots;
+  for(const auto &t: trips){
+    if(t.start_depot_id.is_valid())
+      depots.push_back(t.start_depot_id);
+    if(t.end_depot_id.is_valid())
+      depots.push_back(t.end_depot_id);
+  }
+  std::sort(depots.begin(), depots.end());
+  depots.erase(std::unique(depots.begin(), depots.end()), depots.end());
+  const auto index = [&](const depot_id_t id) -> uint32_t {
+    return std::lower_bound(depots.begin(), depots.end(), id)-depots.begin();
+  };
+
+  DepotOccupancy occupancy;
+  occupancy.reset(depots.size());
+  for(const auto &t: trips){
+    if(t.start_depot_id.is_valid())
+      occupancy.add(DepotEvent{t.bus_busy_start, index(t.start_depot_id),  1}); //Going out
+    if(t.end_depot_id.is_valid())
+      occupancy.add(DepotEvent{t.bus_busy_end,   index(t.end_depot_id),   -1}); //Coming in
+  }
+  occupancy.sweep();
+
+  DepotUsage usage;
+  for(size_t d=0;d<depots.size();d++){
+    usage.depot_id.push_back(depots[d]);
+    usage.peak_buses.push_back(occupancy.peak(d));
+    usage.peak_time.push_back(occupancy.peak_time(d));
+    if(!with_series)
+      continue;
+    occupancy.for_each_step(d, [&](const seconds time, const int32_t buses){
+      usage.series_depot_id.push_back(depots[d]);
+      usage.series_time.push_back(time);
+      usage.series_buses.push_back(buses);
+    });
+  }
+  return usage;
+}
+
+}
+
+
+
+DepotUsage depot_usage(const trips_t &trips){
+  return sweep_trips(trips, true);
+}
+
+
+
+DepotUsage depot_peaks(const trips_t &trips){
+  return sweep_trips(trips, false);
+}
@@ -0,0 +1,135 @@
+#pragma once
+
+#include <cstdint>
+#include <memory>
+#include <utility>
+#include <vector>
+
+#include "data_structures.hpp"
+
+///Tracks how many buses are out of each depot over time. Depots are referred
+///to by dense indices in [0, depot_count).
+///
+///Events go into a flat buffer which is bucketed by depot with a counting sort
+///and then sorted by time within each depot, so each sort is small. All the
+///buffers are kept between uses, so a warmed-up instance doesn't allocate.
+class DepotOccupancy {
+ public:
+  DepotOccupancy() = default;
+
+  ///Forget all events and prepare for `depot_count` depots
+  void reset(const size_t depot_count);
+
+  void add(const DepotEvent &e){ events.push_back(e); }
+  void add(const std::vector<DepotEvent> &es){ events.insert(events.end(), es.begin(), es.end()); }
+
+  ///Order the events and find each depot's peak. At equal times buses
+  ///returning are counted before buses leaving.
+  void sweep();
+
+  size_t  depot_count()               const { return peaks.size(); }
+  bool    used(const size_t d)        const { return first[d]!=first[d+1]; }
+  int32_t peak(const size_t d)        const { return peaks[d]; }
+  seconds peak_time(const size_t d)   const { return peak_times[d]; }
+  int32_t total_peak()                const; //Sum of the peaks over all depots
+  int32_t depots_used()               const;
+
+  ///Call `f(time, buses)` with the number of buses out of depot `d` after
+  ///each distinct event time. Only valid after `sweep()`.
+  template<class F>
+  void for_each_step(const size_t d, F f) const {
+    int32_t buses = 0;
+    for(auto i=first[d];i<first[d+1];i++){
+      buses += sorted[i].delta;
+      if(i+1==first[d+1] || sorted[i+1].time!=sorted[i].time)
+        f(sorted[i].time, buses);
+    }
+  }
+
+ private:
+  std::vector<DepotEvent> events;   //Events in the order they were added
+  std::vector<DepotEvent> sorted;   //Events grouped by depot and sorted by time
+  std::vector<uint32_t>   first;    //Depot d's events are sorted[first[d], first[d+1])
+  std::vector<uint32_t>   fill;
+  std::vector<int32_t>    peaks;
+  std::vector<seconds>    peak_times;
+};
+
+
+
+///The order in which depot events are counted: by depot, then by time, with
+///buses returning counted before buses leaving at equal times
+inline bool event_order(const DepotEvent &a, const DepotEvent &b){
+  if(a.depot!=b.depot)
+    return a.depot<b.depot;
+  return a.time<b.time || (a.time==b.time && a.delta<b.delta);
+}
+
+
+
+///One depot's events in `event_order` and the peak number of buses out of it
+struct DepotProfile {
+  std::vector<DepotEvent> events;
+  int32_t peak = 0;
+  seconds peak_time = seconds(0.0);
+};
+
+typedef std::shared_ptr<const DepotProfile> depot_profile_ptr;
+
+///The occupancy of every depot, indexed densely. A null profile has no events.
+///Profiles are immutable, so copies of a set of profiles share them.
+typedef std::vector<depot_profile_ptr> depot_profiles_t;
+
+int32_t total_peak (const depot_profiles_t &profiles);
+int32_t depots_used(const depot_profiles_t &profiles);
+
+
+
+///Events to take out of and put into a set of depot profiles. Applying the
+///changes only touches the depots they involve: each of those is merged with
+///its changes in one linear pass, without re-sorting. All the buffers are kept
+///between uses, so a warmed-up instance doesn't allocate.
+class DepotPatch {
+ public:
+  void clear(){ removed.clear(); added.clear(); }
+
+  void remove(const std::vector<DepotEvent> &es){ removed.insert(removed.end(), es.begin(), es.end()); }
+  void add   (const std::vector<DepotEvent> &es){ added.insert(added.end(), es.begin(), es.end()); }
+
+  ///Give every depot with changes a new profile holding its events less those
+  ///removed plus those added. Other depots keep their profiles.
+  void apply(depot_profiles_t &profiles);
+
+  ///The change in the total peak and in the number of depots used which
+  ///`apply()` would make to `profiles`, without building any profiles
+  std::pair<int32_t, int32_t> score(const depot_profiles_t &profiles);
+
+ private:
+  std::vector<DepotEvent> removed;
+  std::vector<DepotEvent> added;
+
+  ///Order the changes and call `f(depot, first_removed, last_removed,
+  ///first_added, last_added)` for each depot with changes
+  template<class F>
+  void for_each_depot(F f);
+};
+
+
+
+///Peak buses, when the peak was first reached and occupancy over time for each
+///depot used by a set of simulated trips
+struct DepotUsage {
+  std::vector<depot_id_t> depot_id;
+  std::vector<int32_t>    peak_buses;
+  std::vector<seconds>    peak_time;
+  //Occupancy time series in long form: after `series_time[i]` there are
+  //`series_buses[i]` buses out of depot `series_depot_id[i]`
+  std::vector<depot_id_t> series_depot_id;
+  std::vector<seconds>    series_time;
+  std::vector<int32_t>    series_buses;
+};
+
+DepotUsage depot_usage(const trips_t &trips);
+
+///As `depot_usage()`, but only the peaks: the time series are left empty
+DepotUsage depot_peaks(const trips_t &trips);
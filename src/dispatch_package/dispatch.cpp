@@ -1,59 +1,152 @@
+#include <algorithm>
 #include <iostream>
 #include <limits>
-#include <queue>
+#include <numeric>
 #include <random>
 #include <sstream>
 #include <stdexcept>
-#include <tuple>
 
 #include "dispatch.hpp"
 #include "utility.hpp"
 
 std::unordered_map<depot_id_t, int> count_buses(const trips_t &trips){
-  //Tupe of Time, Depot, Count(-1 or 1)
-  typedef std::tuple<double, depot_id_t, int8_t> DepotEvent;
+  const auto usage = depot_peaks(trips);
+  buses_per_depot_t max_buses_out;
+  for(size_t d=0;d<usage.depot_id.size();d++)
+    max_buses_out[usage.depot_id[d]] = usage.peak_buses[d];
+  return max_buses_out;
+}
 
-  //Load the priority queue
-  std::priority_queue<DepotEvent, std::vector<DepotEvent>, std::greater<DepotEvent>> pq;
-  for(const auto &t: trips){
-    if(t.start_depot_id.is_valid())
-      pq.emplace(t.bus_busy_start, t.start_depot_id, 1); //Going out
-    if(t.end_depot_id.is_valid())
-      pq.emplace(t.bus_busy_end,   t.end_depot_id,  -1);  //Coming in
+
+
+trips_t ModelInfo::sort_trips(trips_t trips){
+  //Sort trips into blocks where each block is ordered by start arrival time
+  std::stable_sort(trips.begin(), trips.end(), [](const auto &a, const auto &b){ return a.start_arrival_time<b.start_arrival_time; });
+  std::stable_sort(trips.begin(), trips.end(), [](const auto &a, const auto &b){ return a.block_id<b.block_id; });
+
+  return trips;
+}
+
+std::vector<size_t> ModelInfo::find_blocks(const trips_t &trips){
+  std::vector<size_t> block_starts;
+  for(size_t i=0;i<trips.size();i++){
+    if(i==0 || trips[i].block_id!=trips[i-1].block_id)
+      block_starts.push_back(i);
   }
+  block_starts.push_back(trips.size());
+  return block_starts;
+}
 
-  //Run the priority queue
-  std::unordered_map<depot_id_t, RangeTracking<int>> max_buses;
-  while(!pq.empty()){
-    const auto c = pq.top();
-    pq.pop();
-    max_buses[std::get<1>(c)] += std::get<2>(c);
+std::vector<depot_id_t> ModelInfo::find_depot_ids() const {
+  std::vector<depot_id_t> depots;
+  for(const auto &t: trips)
+  for(const auto &stop_id: {t.start_stop_id, t.end_stop_id}){
+    const auto &depot = stops.at(stop_id).depot_id;
+    if(depot.is_valid())
+      depots.push_back(depot);
   }
+  std::sort(depots.begin(), depots.end());
+  depots.erase(std::unique(depots.begin(), depots.end()), depots.end());
+  return depots;
+}
 
-  //Get the counts
-  std::unordered_map<depot_id_t, int> max_buses_out;
-  for(const auto &mb: max_buses){
-    if(mb.first.is_valid())
-      max_buses_out[mb.first] = mb.second.max();
+size_t ModelInfo::count_trip_stops(const trips_t &trips){
+  std::vector<stop_id_t> stops;
+  for(const auto &t: trips){
+    stops.push_back(t.start_stop_id);
+    stops.push_back(t.end_stop_id);
   }
+  std::sort(stops.begin(), stops.end());
+  return std::unique(stops.begin(), stops.end())-stops.begin();
+}
 
-  return max_buses_out;
+std::vector<stop_id_t> ModelInfo::find_genome_stops() const {
+  std::vector<stop_id_t> stops;
+  for(size_t b=0;b<block_count();b++)
+  for(size_t i=block_starts[b];i+1<block_starts[b+1];i++){ //Trips followed by another in the block
+    if(trips[i].wait_time>0.0_s)
+      stops.push_back(trips[i].end_stop_id);
+  }
+  std::sort(stops.begin(), stops.end());
+  stops.erase(std::unique(stops.begin(), stops.end()), stops.end());
+  return stops;
+}
+
+std::vector<uint32_t> ModelInfo::find_end_genes() const {
+  std::vector<uint32_t> genes;
+  genes.reserve(trips.size());
+  for(const auto &t: trips){
+    const auto found = std::lower_bound(genome_stops.begin(), genome_stops.end(), t.end_stop_id);
+    if(found!=genome_stops.end() && *found==t.end_stop_id)
+      genes.push_back(found-genome_stops.begin());
+    else
+      genes.push_back(SimTrip::no_gene);
+  }
+  return genes;
 }
 
+std::vector<std::vector<size_t>> ModelInfo::index_gene_blocks() const {
+  std::vector<std::vector<size_t>> gene_blocks(genome_stops.size());
+  for(size_t b=0;b<block_count();b++)
+  for(size_t i=block_starts[b];i+1<block_starts[b+1];i++){ //The last trip of a block never charges
+    if(end_gene[i]==SimTrip::no_gene)
+      continue;
+    auto &blocks = gene_blocks[end_gene[i]];
+    if(blocks.empty() || blocks.back()!=b)
+      blocks.push_back(b);
+  }
+  return gene_blocks;
+}
 
+ChargerGenome ModelInfo::genome_from_map(const HasCharger &has_charger) const {
+  ChargerGenome genome(genome_stops.size());
+  for(size_t g=0;g<genome_stops.size();g++){
+    const auto found = has_charger.find(genome_stops[g]);
+    if(found!=has_charger.end() && found->second)
+      genome.flip(g);
+  }
+  return genome;
+}
 
-trips_t ModelInfo::load_and_sort_trips(const std::string &trips_csv){
-  trips_t trips = csv_trips_to_internal(trips_csv);
+HasCharger ModelInfo::genome_to_map(const ChargerGenome &genome) const {
+  HasCharger has_charger;
+  for(size_t g=0;g<genome_stops.size();g++)
+    has_charger[genome_stops[g]] = genome.test(g);
+  return has_charger;
+}
 
-  //Sort trips into blocks where each block is ordered by start arrival time
-  std::stable_sort(trips.begin(), trips.end(), [](const auto &a, const auto &b){ return a.start_arrival_time<b.start_arrival_time; });
-  std::stable_sort(trips.begin(), trips.end(), [](const auto &a, const auto &b){ return a.block_id<b.block_id; });
+void ModelInfo::build_sim_trips(){
+  const auto depot_index = [&](const depot_id_t id) -> uint32_t {
+    return std::lower_bound(depot_ids.begin(), depot_ids.end(), id)-depot_ids.begin();
+  };
 
-  return trips;
+  sim_trips.clear();
+  sim_trips.reserve(trips.size());
+  for(size_t i=0;i<trips.size();i++){
+    const auto &t          = trips[i];
+    const auto &start_stop = stops.at(t.start_stop_id);
+    const auto &end_stop   = stops.at(t.end_stop_id);
+    sim_trips.push_back(SimTrip{
+      t.start_arrival_time,
+      t.end_arrival_time,
+      t.distance * params.kwh_per_km,
+      t.wait_time * params.nondepot_charger_rate,
+      start_stop.depot_distance * params.kwh_per_km,
+      end_stop.depot_distance * params.kwh_per_km,
+      start_stop.depot_time,
+      end_stop.depot_time,
+      start_stop.depot_id,
+      end_stop.depot_id,
+      depot_index(start_stop.depot_id),
+      depot_index(end_stop.depot_id),
+      end_gene[i]
+    });
+  }
 }
 
 void ModelInfo::update_params(const Parameters &new_params){
   params = new_params;
+  build_sim_trips();
 }
 
 std::string ModelResults::repr() const {
@@ -62,6 +155,9 @@ std::string ModelResults::repr() const {
       <<", trips=[vec]"
       <<", has_charger={dict}"
       <<", cost="<<cost
+      <<", bus_count="<<bus_count
+      <<", charger_count="<<charger_count
+      <<", depot_count="<<depot_count
       <<">";
   return oss.str();
 }
@@ -78,103 +174,110 @@ int dict_value_sum(const T &dict){
 }
 
 
-void calculate_costs(const ModelInfo &model_info, ModelResults &results){
-  const auto &p = model_info.params;
 
-  const auto nondepot_charger_count = dict_value_sum(results.has_charger);
+dollars calculate_cost(const Parameters &p, const int nondepot_charger_count, const int bus_count, const int depot_count){
   const auto nondepot_charger_cost = nondepot_charger_count * p.nondepot_charger_cost;
 
-  const auto buses_per_depot = count_buses(results.trips);
-
-  const auto bus_count = dict_value_sum(buses_per_depot);
   const auto bus_cost = bus_count * p.bus_cost;
 
   const auto battery_cost = bus_count * (p.battery_cap_kwh * p.battery_cost_per_kwh);
 
-  const auto depot_charger_cost = static_cast<int>(buses_per_depot.size())*p.chargers_per_depot * p.depot_charger_cost;
+  const auto depot_charger_cost = depot_count*p.chargers_per_depot * p.depot_charger_cost;
 
-  results.cost = nondepot_charger_cost + bus_cost + battery_cost + depot_charger_cost;
+  return nondepot_charger_cost + bus_cost + battery_cost + depot_charger_cost;
 }
 
 
 
-void run_block(
-  const ModelInfo &model_info,
-  const HasCharger &has_charger,
-  trips_t::iterator block_start,
-  trips_t::iterator block_end,
-  int32_t &next_bus_id
-){
-  const auto &params = model_info.params;
-  const auto &stops = model_info.stops;
+dollars calculate_cost(const Parameters &p, const int nondepot_charger_count, const buses_per_depot_t &buses_per_depot){
+  return calculate_cost(p, nondepot_charger_count, dict_value_sum(buses_per_depot), buses_per_depot.size());
+}
 
-  const auto nrg_to_depot = [&](stop_id_t stop_id) -> kilowatt_hours {
-    return stops.at(stop_id).depot_distance * params.kwh_per_km;
-  };
 
-  const auto time_to_depot = [&](stop_id_t stop_id) -> seconds {
-    return stops.at(stop_id).depot_time;
-  };
 
-  const auto depot_id = [&](stop_id_t stop_id) -> depot_id_t {
-    return stops.at(stop_id).depot_id;
-  };
+void calculate_costs(const ModelInfo &model_info, ModelResults &results){
+  results.buses_per_depot = count_buses(results.trips);
+  results.bus_count       = dict_value_sum(results.buses_per_depot);
+  results.charger_count   = model_info.genome_from_map(results.has_charger).count(); //Only chargers which can be used
+  results.depot_count     = results.buses_per_depot.size();
+  results.cost = calculate_cost(
+    model_info.params,
+    results.charger_count,
+    results.buses_per_depot
+  );
+}
 
-  const auto end_trip = [&](trips_t::iterator trip, kilowatt_hours energy_left) -> void {
+
+
+int32_t run_block(
+  const ModelInfo &model_info,
+  const ChargerGenome &has_charger,
+  const size_t block,
+  TripOutcome *out
+){
+  const auto &params = model_info.params;
+  const auto block_start = model_info.sim_trips.data()+model_info.block_starts.at(block);
+  const auto block_end   = model_info.sim_trips.data()+model_info.block_starts.at(block+1);
+
+  const auto end_trip = [&](const SimTrip *trip, TripOutcome &o, kilowatt_hours energy_left) -> void {
     const seconds charge_time = std::min(params.battery_cap_kwh, params.battery_cap_kwh - energy_left)/params.depot_charger_rate;
-    trip->energy_left = energy_left;
-    trip->bus_busy_end = trip->end_arrival_time + time_to_depot(trip->end_stop_id) + charge_time;
-    trip->end_depot_id = depot_id(trip->end_stop_id);
+    o.energy_left = energy_left;
+    o.bus_busy_end = trip->end_arrival_time + trip->end_depot_time + charge_time;
+    o.end_depot_id = trip->end_depot_id;
   };
 
   bool new_bus = true;
+  int32_t buses = 0;
   kilowatt_hours energy_left = params.battery_cap_kwh;
 
-  for(auto trip=block_start;trip!=block_end;trip++){ // For each trip in block
+  for(auto trip=block_start;trip!=block_end;trip++,out++){ // For each trip in block
+    auto &o = *out;
+    o.start_depot_id = depot_id_t::invalid();
+    o.end_depot_id   = depot_id_t::invalid();
+
     if(new_bus){
       // Initially our energy is battery capacity minus what we need to get to the trip
-      energy_left = params.battery_cap_kwh - nrg_to_depot(trip->start_stop_id);
+      energy_left = params.battery_cap_kwh - trip->start_depot_energy;
       // Bus becomes busy when we leave the depot.
-      trip->bus_busy_start = trip->start_arrival_time - time_to_depot(trip->start_stop_id);
+      o.bus_busy_start = trip->start_arrival_time - trip->start_depot_time;
 
       // Note that we assume the bus doesn't charge at the start depot.
 
       // Identify the bus
-      trip->bus_id = next_bus_id++;
+      buses++;
       // Note the depot
-      trip->start_depot_id = depot_id(trip->start_stop_id);
+      o.start_depot_id = trip->start_depot_id;
       new_bus = false;
       #ifdef DISPATCH_DEBUG
       std::cerr<<"Start a new trip.\n";
       #endif
     } else {
       // Set trip information if it hasn't already been done (by starting a new bus)
-      trip->bus_id = next_bus_id;
-      trip->bus_busy_start = trip->start_arrival_time;
+      o.bus_busy_start = trip->start_arrival_time;
     }
+    o.bus_id = buses-1;
 
     // Note the next_trip
     const auto next_trip = trip+1;
-    auto trip_energy = trip->distance * params.kwh_per_km;
-    const auto energy_end_to_depot = nrg_to_depot(trip->end_stop_id);
+    auto trip_energy = trip->energy;
+    const auto energy_end_to_depot = trip->end_depot_energy;
 
     //If the charger at the end of this trip has a charger and there is a subsequent trip,
     //then we'll use the charger
-    if(has_charger.at(trip->end_stop_id) && next_trip!=block_end){
-      const auto charge_amount = (trip->wait_time * params.nondepot_charger_rate);
+    if(next_trip!=block_end && trip->end_gene!=SimTrip::no_gene && has_charger.test(trip->end_gene)){
       #ifdef DISPATCH_DEBUG
-      std::cerr<<"\tCharging by "<<charge_amount<<" kWh\n"<<std::endl;
+      std::cerr<<"\tCharging by "<<trip->charge_energy<<" kWh\n"<<std::endl;
       #endif
-      trip_energy -= charge_amount;
+      trip_energy -= trip->charge_energy;
     }
 
     // Do we have enough energy to do this trip and get to a depot?
     if(energy_left<trip_energy+energy_end_to_depot){
       // No: That's a problem. Raise a flag. Do the trip and end negative.
       #ifdef DISPATCH_DEBUG
-      std::cerr<<"\tEnergy trap found at trip="<<trip->trip_id<<" block_id="<<trip->block_id<<std::endl;
+      std::cerr<<"\tEnergy trap found at trip="<<model_info.trips[trip-model_info.sim_trips.data()].trip_id<<std::endl;
       #endif
-      end_trip(trip, energy_left - trip_energy - energy_end_to_depot);
+      end_trip(trip, o, energy_left - trip_energy - energy_end_to_depot);
       new_bus = true;
       continue;
     }
@@ -187,57 +290,85 @@ void run_block(
       #ifdef DISPATCH_DEBUG
       std::cerr<<"\tNo next trip. End it now.\n";
       #endif
-      end_trip(trip, energy_left - trip_energy - energy_end_to_depot);
-      return;
+      end_trip(trip, o, energy_left - trip_energy - energy_end_to_depot);
+      break;
     }
 
     // Do we have enough energy to do a trip after this?
-    const auto next_trip_energy = next_trip->distance * params.kwh_per_km;
-    const auto energy_next_end_to_depot = nrg_to_depot(next_trip->end_stop_id);
-    if(energy_left<trip_energy + next_trip_energy + energy_next_end_to_depot){
+    if(energy_left<trip_energy + next_trip->energy + next_trip->end_depot_energy){
       // NO: Do just this trip and then go to a depot.
       #ifdef DISPATCH_DEBUG
       std::cerr<<"\tInsufficient energy, get a new bus.\n";
       #endif
-      end_trip(trip, energy_left - trip_energy - energy_end_to_depot);
+      end_trip(trip, o, energy_left - trip_energy - energy_end_to_depot);
       new_bus = true;
     } else {
       // YES: Do this trip and continue on to next iteration of the loop
       #ifdef DISPATCH_DEBUG
       std::cerr<<"\tContinue with this bus.\n";
       #endif
-      trip->energy_left = energy_left = energy_left - trip_energy;
-      trip->bus_busy_end = trip->end_arrival_time;
+      o.energy_left = energy_left = energy_left - trip_energy;
+      o.bus_busy_end = trip->end_arrival_time;
       new_bus = false;
     }
   }
+
+  return buses;
+}
+
+
+
+BlockResult simulate_block(
+  const ModelInfo &model_info,
+  const ChargerGenome &has_charger,
+  const size_t block,
+  std::vector<TripOutcome> &scratch
+){
+  const auto block_size = model_info.block_starts.at(block+1)-model_info.block_starts.at(block);
+  scratch.resize(std::max(scratch.size(), block_size));
+  run_block(model_info, has_charger, block, scratch.data());
+
+  BlockResult result;
+  const auto first = model_info.block_starts[block];
+  for(size_t i=0;i<block_size;i++){
+    const auto &o = scratch[i];
+    const auto &t = model_info.sim_trips[first+i];
+    if(o.start_depot_id.is_valid())
+      result.events.push_back(DepotEvent{o.bus_busy_start, t.start_depot,  1}); //Going out
+    if(o.end_depot_id.is_valid())
+      result.events.push_back(DepotEvent{o.bus_busy_end,   t.end_depot,   -1}); //Coming in
+  }
+  std::sort(result.events.begin(), result.events.end(), event_order);
+  return result;
 }
 
 
 
-///Simulate bus movement along a route. Information about the journey is
-///stored by modifying the block.
-///
-///@param block_start Iterator pointing to the start of the block
-///@param block_end   Iterator pointing one past the end of the block
-///@param next_bus_id ID to assign to the next bus that's scheduled. Note that
-///                   this is passed by reference because it is incremented
-///                   across all the blocks `run_block` is called on.
+///Simulate bus movement along every block. Information about each trip's
+///journey is stored in `results.trips` and the cost of the fleet in
+///`results.cost`. Buses are numbered from 1 across all the blocks.
 void run_model(const ModelInfo &model_info, ModelResults &results){
   results.trips = model_info.trips;
-  auto start_of_block = results.trips.begin();
+
+  const auto genome = model_info.genome_from_map(results.has_charger);
+
+  std::vector<TripOutcome> outcomes(results.trips.size());
   int32_t next_bus_id = 1;
-  for(auto trip=results.trips.begin();trip!=results.trips.end();trip++){
-    //Have we found a new block?
-    if(trip->block_id!=start_of_block->block_id){
-      //If so, the trip is a valid end iterator for the previous block
-      run_block(model_info, results.has_charger, start_of_block, trip, next_bus_id);
-      //Current trip starts a new block
-      start_of_block=trip;
+  for(size_t b=0;b<model_info.block_count();b++){
+    const auto first = model_info.block_starts[b];
+    const auto buses = run_block(model_info, genome, b, outcomes.data()+first);
+    for(auto i=first;i<model_info.block_starts[b+1];i++){
+      auto &t = results.trips[i];
+      const auto &o = outcomes[i];
+      t.bus_busy_start = o.bus_busy_start;
+      t.bus_busy_end   = o.bus_busy_end;
+      t.bus_id         = next_bus_id+o.bus_id;
+      t.start_depot_id = o.start_depot_id;
+      t.end_depot_id   = o.end_depot_id;
+      t.energy_left    = o.energy_left;
     }
+    next_bus_id += buses;
   }
-  //Run the last block
-  run_block(model_info, results.has_charger, start_of_block, results.trips.end(), next_bus_id);
 
   calculate_costs(model_info, results);
 }
@@ -255,26 +386,14 @@ ClosestDepotInfo GetClosestDepot(
 ){
   ClosestDepotInfo closest_depot(stop_lat.size());
 
-  #pragma omp parallel for
-  for(size_t si=0;si<stop_lat.size();si++)
-  for(size_t di=0;di<depot_lat.size();di++){
-    try {
-      const auto [time, distance] = router.getTravelTime(
-        stop_lat[si],
-        stop_lon[si],
-        depot_lat[di],
-        depot_lon[di],
-        (int)search_radius_m
-      );
-      const auto current_best = closest_depot.time_to_depot[si];
-      if(std::isnan(current_best) || time<current_best){
-        closest_depot.depot_id[si] = depot_id_t(di);
-        closest_depot.time_to_depot[si] = time;
-        closest_depot.dist_to_depot[si] = distance;
-      }
-    } catch (const std::exception &e) {
-      //pass
-    }
+  const auto closest = router.getClosestTargets(stop_lat, stop_lon, depot_lat, depot_lon, (int)search_radius_m);
+  for(size_t si=0;si<stop_lat.size();si++){
+    if(closest.target[si]==-1)
+      continue;
+    closest_depot.depot_id[si]      = depot_id_t(closest.target[si]);
+    closest_depot.time_to_depot[si] = closest.travel_time[si];
+    closest_depot.dist_to_depot[si] = closest.distance[si];
   }
+
   return closest_depot;
 }
@@ -1,36 +1,104 @@
 #pragma once
 
 #include <algorithm>
+#include <utility>
 
+#include "charger_genome.hpp"
 #include "data_frames.hpp"
 #include "data_structures.hpp"
+#include "depot_occupancy.hpp"
 #include "routingkit.hpp"
 
 class ModelInfo {
  private:
-  static trips_t load_and_sort_trips(const std::string &trips_csv);
+  static trips_t sort_trips(trips_t trips);
+  static std::vector<size_t> find_blocks(const trips_t &trips);
+  static size_t count_trip_stops(const trips_t &trips);
+  std::vector<depot_id_t> find_depot_ids() const;
+  std::vector<stop_id_t> find_genome_stops() const;
+  std::vector<uint32_t> find_end_genes() const;
+  std::vector<std::vector<size_t>> index_gene_blocks() const;
+  void build_sim_trips();
 
  public:
   Parameters params;
   const trips_t trips;
   const stops_t stops;
+  //Block b is made up of trips [block_starts[b], block_starts[b+1])
+  const std::vector<size_t> block_starts;
+  //Depots which buses may use, sorted. Simulation events refer to depots by
+  //their index in this list.
+  const std::vector<depot_id_t> depot_ids;
+  //Number of distinct stops at which trips start or end
+  const size_t trip_stop_count;
+  //Stops where a charger can make a difference, in the order of a
+  //ChargerGenome's bits. A charger is only used at the end of a trip which is
+  //followed by another trip in the same block and which has time to charge,
+  //so chargers anywhere else are pointless and never searched.
+  const std::vector<stop_id_t> genome_stops;
+  //Index into `genome_stops` of each trip's end stop, or `no_gene` if it isn't
+  //one of them
+  const std::vector<uint32_t> end_gene;
+  //For each gene, the blocks whose simulation depends on whether its stop has
+  //a charger
+  const std::vector<std::vector<size_t>> gene_blocks;
+  //The trips in the form used by the simulation, in the same order as `trips`.
+  //Rebuilt whenever the parameters change.
+  std::vector<SimTrip> sim_trips;
+
+  ModelInfo(
+    const Parameters &params,
+    trips_t trips,
+    stops_t stops
+  ) : params(params),
+      trips(sort_trips(std::move(trips))),
+      stops(std::move(stops)),
+      block_starts(find_blocks(this->trips)),
+      depot_ids(find_depot_ids()),
+      trip_stop_count(count_trip_stops(this->trips)),
+      genome_stops(find_genome_stops()),
+      end_gene(find_end_genes()),
+      gene_blocks(index_gene_blocks())
+  {
+    build_sim_trips();
+  }
 
   ModelInfo(
     const Parameters &params,
     const std::string &trips_csv,
     const std::string &stops_csv
-  ) : params(params),
-      trips(load_and_sort_trips(trips_csv)),
-      stops(csv_stops_to_internal(stops_csv))
+  ) : ModelInfo(params, csv_trips_to_internal(trips_csv), csv_stops_to_internal(stops_csv))
   {}
 
   void update_params(const Parameters &new_params);
+
+  size_t block_count() const { return block_starts.size()-1; }
+
+  //Convert between the dictionary of stops with chargers used by Python and the
+  //packed form used by the simulation. Stops missing from `has_charger` have
+  //no charger; stops outside `genome_stops` are dropped.
+  ChargerGenome genome_from_map(const HasCharger &has_charger) const;
+  HasCharger genome_to_map(const ChargerGenome &genome) const;
 };
 
+typedef std::unordered_map<depot_id_t, int> buses_per_depot_t;
+
 struct ModelResults {
   trips_t trips;
   HasCharger has_charger;
   dollars cost;
+  //What `cost` was calculated from. These don't depend on prices, so the same
+  //fleet can be repriced without re-simulating it.
+  int32_t bus_count     = 0;
+  int32_t charger_count = 0; //Non-depot chargers
+  int32_t depot_count   = 0; //Depots used by at least one bus
+  buses_per_depot_t buses_per_depot; //Peak buses out of each depot used
+  //Set by the optimizer: for each stage, why it stopped ("generations",
+  //"patience" or "time_limit") and how many generations it ran. Local search
+  //reports a single stage which stops at a "local_optimum" or its
+  //"time_limit", and the number of moves it made.
+  std::vector<std::string> stop_reasons;
+  std::vector<int>         generations_run;
   std::string repr() const;
 };
 
@@ -50,6 +118,19 @@ ClosestDepotInfo GetClosestDepot(
 
 std::unordered_map<depot_id_t, int> count_buses(const trips_t &trips);
 
+
+//Simulate the buses serving block `block`, writing one outcome per trip of the
+//block to `out`. Returns the number of buses used.
+int32_t run_block(const ModelInfo &model_info, const ChargerGenome &has_charger, const size_t block, TripOutcome *out);
+
+//Simulate block `block` and return the depot events its buses generate, in
+//`event_order`. `scratch` is working space.
+BlockResult simulate_block(const ModelInfo &model_info, const ChargerGenome &has_charger, const size_t block, std::vector<TripOutcome> &scratch);
+
+//Simulate the model with the chargers given by `results.has_charger`
 void run_model(const ModelInfo &model_info, ModelResults &results);
 
+dollars calculate_cost(const Parameters &params, const int nondepot_charger_count, const buses_per_depot_t &buses_per_depot);
+dollars calculate_cost(const Parameters &params, const int nondepot_charger_count, const int bus_count, const int depot_count);
+
 void calculate_costs(const ModelInfo &model_info, ModelResults &results);
\ No newline at end of file
@@ -1,5 +1,14 @@
+#include <algorithm>
+#include <chrono>
+#include <cmath>
 #include <iostream>
+#include <list>
+#include <memory>
+#include <numeric>
 #include <random>
+#include <stdexcept>
+#include <string>
+#include <unordered_map>
 
 #include "data_structures.hpp"
 #include "dispatch.hpp"
@@ -7,16 +16,13 @@
 
 typedef std::mt19937 our_random_engine;
 
-void seed_rand(our_random_engine &eng, const uint32_t seed){
-  if(seed==0){
-    std::uint_least32_t seed_data[std::mt19937::state_size];
-    std::random_device r;
-    std::generate_n(seed_data, std::mt19937::state_size, std::ref(r));
-    std::seed_seq q(std::begin(seed_data), std::end(seed_data));
-    eng.seed(q);
-  } else {
-    eng.seed(seed);
-  }
+///The seed from which every island's random stream is derived. A seed of 0
+///means a different run each time.
+uint32_t master_seed(const uint32_t seed){
+  if(seed!=0)
+    return seed;
+  std::random_device r;
+  return r();
 }
 
 double r_uniform(our_random_engine &eng, double from, double thru){
@@ -24,100 +30,496 @@ double r_uniform(our_random_engine &eng, double from, double thru){
   return distribution(eng);
 }
 
-typedef std::vector<ModelResults> results_vec;
+typedef std::shared_ptr<const BlockResult> block_result_ptr;
+
+///A member of the population. Children share their parent's per-block
+///simulation results and depot occupancy, and only re-simulate the blocks their
+///mutations touch and re-count the depots those blocks use.
+struct Individual {
+  ChargerGenome has_charger;
+  dollars       cost;
+  std::vector<block_result_ptr> blocks;       //Simulation results of each block
+  std::vector<size_t>           dirty_blocks; //Blocks whose results are out of date
+  depot_profiles_t              depots;       //Occupancy of each depot given `blocks`
+};
+
+typedef std::vector<Individual> population_t;
+
+
+
+///Hashes and compares genomes through pointers, so that maps can index genomes
+///stored elsewhere without copying them. Lookups compare the genomes
+///themselves, so a hash collision can't hand one layout another's cost.
+struct GenomePtrHash {
+  size_t operator()(const ChargerGenome *g) const { return g->hash(); }
+};
+
+struct GenomePtrEqual {
+  bool operator()(const ChargerGenome *a, const ChargerGenome *b) const { return *a==*b; }
+};
+
+
+
+///Least-recently-used cache of the costs of charger configurations
+class FitnessCache {
+ public:
+  FitnessCache(const size_t capacity) : capacity(capacity) {}
+
+  ///If `genome` is cached, sets `cost` and returns true
+  bool get(const ChargerGenome &genome, dollars &cost){
+    const auto found = index.find(&genome);
+    if(found==index.end())
+      return false;
+    lru.splice(lru.begin(), lru, found->second); //Mark as most recently used
+    cost = found->second->second;
+    return true;
+  }
+
+  void put(const ChargerGenome &genome, const dollars cost){
+    if(capacity==0 || index.count(&genome)!=0)
+      return;
+    if(lru.size()==capacity){ //Evict least recently used
+      index.erase(&lru.back().first);
+      lru.pop_back();
+    }
+    lru.emplace_front(genome, cost);
+    index[&lru.front().first] = lru.begin();
+  }
+
+ private:
+  size_t capacity;
+  //The index's keys point at the genomes in `lru`, whose nodes never move
+  std::list<std::pair<ChargerGenome, dollars>> lru;
+  std::unordered_map<const ChargerGenome*, std::list<std::pair<ChargerGenome, dollars>>::iterator, GenomePtrHash, GenomePtrEqual> index;
+};
+
+
+
+struct CacheStats {
+  size_t hits   = 0;
+  size_t misses = 0;
+};
+
+
+
+///Re-simulate an individual's out-of-date blocks, patch the occupancy of the
+///depots they use and recompute its cost. `scratch` and `patch` are working
+///space.
+void evaluate_individual(
+  const ModelInfo &model_info,
+  Individual &individual,
+  std::vector<TripOutcome> &scratch,
+  DepotPatch &patch
+){
+  patch.clear();
+  for(const auto &b: individual.dirty_blocks){
+    if(individual.blocks[b])
+      patch.remove(individual.blocks[b]->events);
+    individual.blocks[b] = std::make_shared<const BlockResult>(simulate_block(model_info, individual.has_charger, b, scratch));
+    patch.add(individual.blocks[b]->events);
+  }
+  individual.dirty_blocks.clear();
+  patch.apply(individual.depots);
+
+  individual.cost = calculate_cost(model_info.params, individual.has_charger.count(), total_peak(individual.depots), depots_used(individual.depots));
+}
+
+
+
+///Set the cost of every member of the population. Configurations which are in
+///the cache or which appear more than once in the population are only
+///simulated once.
+void evaluate_population(
+  const ModelInfo &model_info,
+  FitnessCache &cache,
+  CacheStats &stats,
+  population_t &population
+){
+  std::vector<size_t> to_run;                          //Individuals to simulate
+  std::vector<std::pair<size_t, size_t>> duplicates;   //Individual, identical individual being simulated
+  //Genome to the individual simulating it
+  std::unordered_map<const ChargerGenome*, size_t, GenomePtrHash, GenomePtrEqual> running;
+
+  for(size_t i=0;i<population.size();i++){
+    const auto &genome = population[i].has_charger;
+    if(cache.get(genome, population[i].cost)){
+      stats.hits++;
+    } else if(const auto [it, inserted] = running.emplace(&genome, i); !inserted){
+      duplicates.emplace_back(i, it->second);
+      stats.hits++;
+    } else {
+      to_run.push_back(i);
+      stats.misses++;
+    }
+  }
+
+  #pragma omp parallel
+  {
+    std::vector<TripOutcome> scratch;
+    DepotPatch patch;
+    #pragma omp for schedule(dynamic)
+    for(size_t k=0;k<to_run.size();k++)
+      evaluate_individual(model_info, population.at(to_run[k]), scratch, patch);
+  }
+
+  for(const auto &i: to_run)
+    cache.put(population[i].has_charger, population[i].cost);
+  for(const auto &d: duplicates)
+    population[d.first].cost = population[d.second].cost;
+}
+
+
+
+///Flip each bit of `genome` with probability `mutation_rate`. Rather than
+///drawing a number per bit we draw the gaps between flipped bits from a
+///geometric distribution, so the cost is proportional to the number of flips.
+///The flipped bits are appended to `flipped` in increasing order.
+void mutate(
+  ChargerGenome &genome,
+  const double mutation_rate,
+  our_random_engine &eng,
+  std::vector<size_t> &flipped
+){
+  if(mutation_rate<=0)
+    return;
+  if(mutation_rate>=1){
+    for(size_t g=0;g<genome.size();g++){
+      genome.flip(g);
+      flipped.push_back(g);
+    }
+    return;
+  }
+  std::geometric_distribution<size_t> gap(mutation_rate);
+  for(size_t g=gap(eng);g<genome.size();g+=1+gap(eng)){
+    genome.flip(g);
+    flipped.push_back(g);
+  }
+}
 
 void spawn_from(
-  const ModelResults parent, //Don't reference, since we're resizing vector
+  const ModelInfo &model_info,
+  const Individual parent, //Don't reference, since we're resizing vector
   const int count,
   const double mutation_rate,
   our_random_engine &eng,
-  results_vec &population_vec
+  population_t &population
 ){
-  population_vec.reserve(population_vec.size()+count);
+  std::vector<size_t> flipped;
+  population.reserve(population.size()+count);
   for(int i=0;i<count;i++){
-    population_vec.push_back(parent);    //Copy parent into the vector
-    auto &child = population_vec.back(); //Get reference to
-    for(auto &kv: child.has_charger){
-      if(r_uniform(eng,0,1)<mutation_rate){ //If we mutate
-        kv.second = !kv.second;             //Flip the bit
-      }
-    }
+    population.push_back(parent);    //Copy parent into the vector
+    auto &child = population.back(); //Get reference to
+    flipped.clear();
+    mutate(child.has_charger, mutation_rate, eng, flipped);
+    //Note the blocks which need to be re-simulated
+    auto &dirty = child.dirty_blocks;
+    for(const auto &g: flipped)
+      dirty.insert(dirty.end(), model_info.gene_blocks[g].begin(), model_info.gene_blocks[g].end());
+    std::sort(dirty.begin(), dirty.end());
+    dirty.erase(std::unique(dirty.begin(), dirty.end()), dirty.end());
   }
 }
 
-ModelResults get_initial_entity(const ModelInfo &model_info){
-  ModelResults temp;
-  for(const auto &t: model_info.trips){
-    temp.has_charger[t.start_stop_id] = false;
-    temp.has_charger[t.end_stop_id]   = false;
-  }
+Individual get_initial_entity(const ModelInfo &model_info, const ChargerGenome &has_charger){
+  Individual temp;
+  temp.has_charger = has_charger;
+  //Nothing has been simulated yet
+  temp.blocks.resize(model_info.block_count());
+  temp.dirty_blocks.resize(model_info.block_count());
+  std::iota(temp.dirty_blocks.begin(), temp.dirty_blocks.end(), 0);
+  temp.depots.resize(model_info.depot_ids.size());
   return temp;
 }
 
-bool cost_compare(const ModelResults &a, const ModelResults &b){
+bool cost_compare(const Individual &a, const Individual &b){
   return a.cost<b.cost;
 }
 
-void optimization_stage_run(
-  const ModelInfo &model_info,
-  const size_t generation,
-  our_random_engine &eng,
-  results_vec &results
-){
-  const auto generations   = model_info.params.generations.at(generation);
-  const auto mutation_rate = model_info.params.mutation_rate.at(generation);
-  const auto keep_top      = model_info.params.keep_top.at(generation);
-  const auto spawn_size    = model_info.params.spawn_size.at(generation);
-
-  for(int g=0;g<generations;g++){
-    std::cerr<<(g%10)<<std::flush;
-    if(g%100==0)
-      std::cerr<<std::endl;
-    #pragma omp parallel for
-    for(size_t i=0;i<results.size();i++){
-      run_model(model_info, results.at(i));
-      results.at(i).trips.clear(); //Save memory
-    }
-    if(static_cast<int>(results.size())>keep_top){
-      std::nth_element(results.begin(), results.begin()+keep_top, results.end(), cost_compare);
-      results.erase(results.begin()+keep_top,results.end());
+
+
+///An independently evolving population. Each island has its own random
+///stream, derived from the master seed and the island's index, so its
+///evolution does not depend on which thread runs it or when.
+struct Island {
+  our_random_engine eng;
+  FitnessCache      cache;
+  CacheStats        stats;
+  population_t      population;
+
+  Island(const uint32_t seed, const uint32_t index, const size_t cache_size) : cache(cache_size) {
+    std::seed_seq seq{seed, index};
+    eng.seed(seq);
+  }
+};
+
+
+
+///Advance an island by one generation: the survivors spawn mutated children
+///and the best `keep_top` of parents and children survive
+void run_generation(const ModelInfo &model_info, const size_t stage, Island &island){
+  const auto mutation_rate = model_info.params.mutation_rate.at(stage);
+  const auto keep_top      = model_info.params.keep_top.at(stage);
+  const auto spawn_size    = model_info.params.spawn_size.at(stage);
+
+  auto &population = island.population;
+
+  const auto parents = std::min(population.size(), static_cast<size_t>(keep_top));
+  for(size_t i=0;i<parents;i++)
+    spawn_from(model_info, population.at(i), spawn_size, mutation_rate, island.eng, population);
+
+  evaluate_population(model_info, island.cache, island.stats, population);
+
+  if(static_cast<int>(population.size())>keep_top){
+    std::nth_element(population.begin(), population.begin()+keep_top, population.end(), cost_compare);
+    population.erase(population.begin()+keep_top, population.end());
+  }
+}
+
+
+
+///Each island's best individual replaces the worst individual of the next
+///island around the ring, if it is better
+void migrate(std::vector<Island> &islands){
+  if(islands.size()<2)
+    return;
+
+  std::vector<Individual> migrants;
+  for(const auto &island: islands)
+    migrants.push_back(*std::min_element(island.population.begin(), island.population.end(), cost_compare));
+
+  for(size_t i=0;i<islands.size();i++){
+    auto &population = islands[(i+1)%islands.size()].population;
+    const auto worst = std::max_element(population.begin(), population.end(), cost_compare);
+    if(cost_compare(migrants[i], *worst))
+      *worst = migrants[i];
+  }
+}
+
+
+
+///Best individual over all the islands. Ties go to the lower-numbered island.
+const Individual& best_of(const std::vector<Island> &islands){
+  const Individual *best = nullptr;
+  for(const auto &island: islands){
+    const auto &candidate = *std::min_element(island.population.begin(), island.population.end(), cost_compare);
+    if(best==nullptr || cost_compare(candidate, *best))
+      best = &candidate;
+  }
+  return *best;
+}
+
+
+
+///A per-stage setting, or `fallback` if none is given for the stage
+template<class T>
+T stage_setting(const std::vector<T> &settings, const size_t stage, const T fallback){
+  return stage<settings.size() ? settings[stage] : fallback;
+}
+
+
+
+///Deterministic steepest descent. Starting from no chargers or chargers at
+///every candidate stop, repeatedly make whichever single add/remove move
+///lowers the cost the most, until no move helps. Each move is scored by
+///re-simulating only the blocks its stop affects and re-counting only the
+///depots they use; only the chosen move is applied to the current layout. Ties
+///go to the stop with the lowest index.
+ModelResults local_search(const ModelInfo &model_info){
+  const auto &params = model_info.params;
+  const auto genes   = model_info.genome_stops.size();
+
+  ChargerGenome start(genes);
+  if(params.local_search_start=="all"){
+    for(size_t g=0;g<genes;g++)
+      start.flip(g);
+  } else if(params.local_search_start!="none"){
+    throw std::runtime_error("local_search_start must be 'none' or 'all'!");
+  }
+
+  std::vector<TripOutcome> scratch;
+  DepotPatch patch;
+  auto current = get_initial_entity(model_info, start);
+  evaluate_individual(model_info, current, scratch, patch);
+  std::cerr<<"Local search from "<<params.local_search_start<<": "<<current.cost<<std::endl;
+
+  const auto search_start = std::chrono::steady_clock::now();
+  const auto time_limit   = stage_setting(params.time_limit, 0, 0.0);
+  std::string stop_reason = "local_optimum";
+  std::vector<dollars> move_cost(genes);
+  int moves = 0;
+
+  while(genes>0){
+    const auto chargers = current.has_charger.count();
+    const auto peak     = total_peak(current.depots);
+    const auto used     = depots_used(current.depots);
+
+    //Score each move against `current` without building an individual for
+    //it: re-simulate the blocks its stop affects and re-count only the depots
+    //those blocks use
+    #pragma omp parallel
+    {
+      std::vector<TripOutcome> thread_scratch;
+      DepotPatch thread_patch;
+      auto genome = current.has_charger; //Each move is flipped in and back out
+      #pragma omp for schedule(dynamic)
+      for(int g=0;g<static_cast<int>(genes);g++){
+        genome.flip(g);
+        thread_patch.clear();
+        for(const auto &b: model_info.gene_blocks[g]){
+          thread_patch.remove(current.blocks[b]->events);
+          thread_patch.add(simulate_block(model_info, genome, b, thread_scratch).events);
+        }
+        const auto [peak_change, used_change] = thread_patch.score(current.depots);
+        move_cost[g] = calculate_cost(params, chargers+(genome.test(g) ? 1 : -1), peak+peak_change, used+used_change);
+        genome.flip(g);
+      }
     }
-    const auto pre_spawn_size = results.size();
-    for(int i=0;i<keep_top && (size_t)i<pre_spawn_size;i++){
-      spawn_from(results.at(i), spawn_size, mutation_rate, eng, results);
+
+    const size_t best_move = std::min_element(move_cost.begin(), move_cost.end())-move_cost.begin();
+    if(!(move_cost[best_move]<current.cost))
+      break;
+
+    current.has_charger.flip(best_move);
+    current.dirty_blocks = model_info.gene_blocks[best_move];
+    evaluate_individual(model_info, current, scratch, patch);
+    moves++;
+    std::cerr<<"Move "<<moves<<": "<<(current.has_charger.test(best_move) ? "add" : "remove")
+             <<" stop "<<model_info.genome_stops[best_move]<<", cost "<<current.cost<<std::endl;
+
+    const std::chrono::duration<double> elapsed = std::chrono::steady_clock::now()-search_start;
+    if(time_limit>0 && elapsed.count()>=time_limit){
+      stop_reason = "time_limit";
+      break;
     }
   }
-  std::cerr<<std::endl;
+
+  ModelResults best;
+  best.has_charger     = model_info.genome_to_map(current.has_charger);
+  best.stop_reasons    = {stop_reason};
+  best.generations_run = {moves};
+
+  //Rerun best model to get the full results
+  run_model(model_info, best);
+
+  return best;
 }
 
-ModelResults optimization_restart_run(
-  const ModelInfo &model_info,
-  our_random_engine &eng
-){
-  results_vec results;
 
-  results.push_back(get_initial_entity(model_info));
 
-  for(size_t g=0;g<model_info.params.generations.size();g++){
-    std::cerr<<"Stage "<<g<<std::endl;
-    optimization_stage_run(model_info, g, eng, results);
+ModelResults optimize_model(const ModelInfo &model_info, const std::vector<HasCharger> &seeds){
+  const auto &params = model_info.params;
+
+  if(params.optimizer=="local_search")
+    return local_search(model_info);
+  else if(params.optimizer!="genetic")
+    throw std::runtime_error("optimizer must be 'genetic' or 'local_search'!");
+
+  if(params.restarts<1)
+    throw std::runtime_error("restarts must be at least 1!");
+
+  //Costs depend only on the charger configuration for a given ModelInfo, so
+  //each island's cache is kept across all of its stages
+  const auto seed = master_seed(params.seed);
+  std::vector<Island> islands;
+  islands.reserve(params.restarts);
+  for(int r=0;r<params.restarts;r++)
+    islands.emplace_back(seed, r, std::max(params.fitness_cache_size, 0));
+
+  const int island_count = islands.size();
+
+  std::vector<ChargerGenome> initial_genomes;
+  initial_genomes.emplace_back(model_info.genome_stops.size());
+  for(const auto &seed_layout: seeds)
+    initial_genomes.push_back(model_info.genome_from_map(seed_layout));
+
+  //Islands run concurrently. If there is only one, its population is
+  //evaluated in parallel instead.
+  #pragma omp parallel for if(island_count>1) schedule(dynamic)
+  for(int i=0;i<island_count;i++){
+    auto &island = islands[i];
+    for(const auto &genome: initial_genomes)
+      island.population.push_back(get_initial_entity(model_info, genome));
+    evaluate_population(model_info, island.cache, island.stats, island.population);
   }
 
-  return *std::max_element(results.begin(), results.begin()+model_info.params.keep_top.back(), cost_compare);
-}
+  std::vector<std::string> stop_reasons;
+  std::vector<int> generations_run;
 
-ModelResults optimize_model(const ModelInfo &model_info){
-  our_random_engine eng;
+  for(size_t s=0;s<params.generations.size();s++){
+    std::cerr<<"Stage "<<s<<std::endl;
+
+    for(auto &island: islands)
+      island.stats = CacheStats();
+
+    const auto generations     = params.generations.at(s);
+    const auto patience        = stage_setting(params.patience,        s, 0);
+    const auto min_improvement = stage_setting(params.min_improvement, s, 0.0);
+    const auto time_limit      = stage_setting(params.time_limit,      s, 0.0);
+
+    const auto stage_start = std::chrono::steady_clock::now();
+    auto reference_cost    = best_of(islands).cost; //Best cost as of the last improvement
+    int  stagnant          = 0;                     //Generations since the last improvement
+    std::string stop_reason = "generations";
+
+    int g = 0;
+    while(g<generations){
+      std::cerr<<(g%10)<<std::flush;
+      if(g%100==0)
+        std::cerr<<std::endl;
+
+      //Islands run concurrently. If there is only one, its population is
+      //evaluated in parallel instead.
+      #pragma omp parallel for if(island_count>1) schedule(dynamic)
+      for(int i=0;i<island_count;i++)
+        run_generation(model_info, s, islands[i]);
+      g++;
 
-  seed_rand(eng, model_info.params.seed);
+      if(params.migration_interval>0 && g%params.migration_interval==0)
+        migrate(islands);
 
-  results_vec results;
+      //An improvement only counts if it is larger than `min_improvement` as a
+      //fraction of the best cost at the last improvement
+      const auto best_cost = best_of(islands).cost;
+      if(best_cost < reference_cost - dollars(min_improvement*std::abs(static_cast<double>(reference_cost)))){
+        reference_cost = best_cost;
+        stagnant = 0;
+      } else {
+        stagnant++;
+      }
+
+      if(patience>0 && stagnant>=patience){
+        stop_reason = "patience";
+        break;
+      }
+      const std::chrono::duration<double> elapsed = std::chrono::steady_clock::now()-stage_start;
+      if(time_limit>0 && elapsed.count()>=time_limit){
+        stop_reason = "time_limit";
+        break;
+      }
+    }
+    std::cerr<<std::endl;
+    if(stop_reason!="generations")
+      std::cerr<<"Stopped after "<<g<<" generations ("<<stop_reason<<")"<<std::endl;
+
+    stop_reasons.push_back(stop_reason);
+    generations_run.push_back(g);
 
-  for(int r=0;r<model_info.params.restarts;r++){
-    results.push_back(optimization_restart_run(model_info, eng));
+    CacheStats stats;
+    for(const auto &island: islands){
+      stats.hits   += island.stats.hits;
+      stats.misses += island.stats.misses;
+    }
+    const auto lookups = stats.hits+stats.misses;
+    std::cerr<<"Fitness cache: "<<stats.hits<<" hits, "<<stats.misses<<" misses ("
+             <<(lookups>0 ? 100.0*stats.hits/lookups : 0.0)<<"% hit rate)"<<std::endl;
   }
 
-  auto best = *std::max_element(results.begin(), results.end(), cost_compare);
+  const auto &best_individual = best_of(islands);
+
+  ModelResults best;
+  best.has_charger     = model_info.genome_to_map(best_individual.has_charger);
+  best.stop_reasons    = stop_reasons;
+  best.generations_run = generations_run;
 
   //Rerun best model to get the full results
   run_model(model_info, best);
@@ -2,4 +2,9 @@
 
 #include "dispatch.hpp"
 
-ModelResults optimize_model(const ModelInfo &model_info);
\ No newline at end of file
+//Search for the cheapest charger layout using the method chosen by
+//`params.optimizer`. For the genetic algorithm every island's initial
+//population holds the layout with no chargers plus each of `seeds`; stops
+//missing from a seed have no charger. Local search ignores `seeds` and starts
+//from `params.local_search_start`.
+ModelResults optimize_model(const ModelInfo &model_info, const std::vector<HasCharger> &seeds = {});
\ No newline at end of file
@@ -1,4 +1,5 @@
 #include <pybind11/pybind11.h>
+#include <pybind11/numpy.h>
 #include <pybind11/stl.h>
 #include "pybind11_conversions.hpp"
 
@@ -7,15 +8,143 @@
 
 namespace py = pybind11;
 
+
+
+//Get a column of a table given as a dict of arrays. The column's buffer is
+//used in place if it is already a contiguous array of type T; otherwise it is
+//converted.
+template<class T>
+py::array_t<T, py::array::c_style | py::array::forcecast> get_column(const py::dict &table, const char *name, const size_t N){
+  if(!table.contains(name))
+    throw std::runtime_error(std::string("Table is missing column '")+name+"'!");
+  const auto col = py::cast<py::array_t<T, py::array::c_style | py::array::forcecast>>(table[name]);
+  if(col.ndim()!=1 || static_cast<size_t>(col.shape(0))!=N)
+    throw std::runtime_error(std::string("Column '")+name+"' has the wrong shape!");
+  return col;
+}
+
+size_t column_length(const py::dict &table, const char *name){
+  if(!table.contains(name))
+    throw std::runtime_error(std::string("Table is missing column '")+name+"'!");
+  return py::len(table[name]);
+}
+
+stops_t dict_stops_to_internal(const py::dict &stops){
+  const auto N              = column_length(stops, "stop_id");
+  const auto stop_id        = get_column<int64_t>(stops, "stop_id",        N);
+  const auto depot_id       = get_column<int64_t>(stops, "depot_id",       N);
+  const auto depot_time     = get_column<double> (stops, "depot_time",     N);
+  const auto depot_distance = get_column<double> (stops, "depot_distance", N);
+  return columns_stops_to_internal(N, stop_id.data(), depot_id.data(), depot_time.data(), depot_distance.data());
+}
+
+trips_t dict_trips_to_internal(const py::dict &trips){
+  const auto N = column_length(trips, "trip_id");
+
+  //Trip ids are opaque strings, so they can't be used in place
+  std::vector<std::string> trip_id;
+  trip_id.reserve(N);
+  for(const auto &x: trips["trip_id"])
+    trip_id.push_back(py::str(x));
+
+  const auto block_id           = get_column<int64_t>(trips, "block_id",           N);
+  const auto start_arrival_time = get_column<double> (trips, "start_arrival_time", N);
+  const auto start_stop_id      = get_column<int64_t>(trips, "start_stop_id",      N);
+  const auto end_arrival_time   = get_column<double> (trips, "end_arrival_time",   N);
+  const auto end_stop_id        = get_column<int64_t>(trips, "end_stop_id",        N);
+  const auto distance           = get_column<double> (trips, "distance",           N);
+  const auto wait_time          = get_column<double> (trips, "wait_time",          N);
+  return columns_trips_to_internal(
+    N, trip_id, block_id.data(), start_arrival_time.data(), start_stop_id.data(),
+    end_arrival_time.data(), end_stop_id.data(), distance.data(), wait_time.data()
+  );
+}
+
+
+
+//Returns a column of NumPy values, one per trip, extracted by `field`
+template<class T, class F>
+py::array_t<T> trips_column(const trips_t &trips, F field){
+  py::array_t<T> col(trips.size());
+  auto *const out = col.mutable_data();
+  for(size_t i=0;i<trips.size();i++)
+    out[i] = field(trips[i]);
+  return col;
+}
+
+//Returns a NumPy copy of a vector, converting each element with `convert`
+template<class T, class V, class F>
+py::array_t<T> vector_column(const std::vector<V> &values, F convert){
+  py::array_t<T> col(values.size());
+  auto *const out = col.mutable_data();
+  for(size_t i=0;i<values.size();i++)
+    out[i] = convert(values[i]);
+  return col;
+}
+
+//Convert depot usage to two dicts of NumPy columns: one row per depot with its
+//peak, and the occupancy time series in long form
+py::tuple depot_usage_to_columns(const DepotUsage &usage){
+  const auto depot = [](const depot_id_t &x){ return static_cast<int64_t>(x); };
+  const auto time  = [](const seconds &x){ return static_cast<double>(x); };
+  const auto same  = [](const int32_t &x){ return x; };
+
+  py::dict peaks;
+  peaks["depot_id"]   = vector_column<int64_t>(usage.depot_id,   depot);
+  peaks["peak_buses"] = vector_column<int32_t>(usage.peak_buses, same);
+  peaks["peak_time"]  = vector_column<double> (usage.peak_time,  time);
+
+  py::dict series;
+  series["depot_id"] = vector_column<int64_t>(usage.series_depot_id, depot);
+  series["time"]     = vector_column<double> (usage.series_time,     time);
+  series["buses"]    = vector_column<int32_t>(usage.series_buses,    same);
+
+  return py::make_tuple(peaks, series);
+}
+
+//Convert trips to a dict mapping each TripInfo field to a column of values
+//suitable for building a DataFrame in one step
+py::dict trips_to_columns(const trips_t &trips){
+  py::list trip_id(trips.size());
+  for(size_t i=0;i<trips.size();i++)
+    trip_id[i] = py::str(trips[i].trip_id);
+
+  py::dict cols;
+  cols["trip_id"]            = trip_id;
+  cols["block_id"]           = trips_column<int64_t>(trips, [](const TripInfo &t){ return static_cast<int64_t>(t.block_id);           });
+  cols["start_arrival_time"] = trips_column<double> (trips, [](const TripInfo &t){ return static_cast<double> (t.start_arrival_time); });
+  cols["start_stop_id"]      = trips_column<int64_t>(trips, [](const TripInfo &t){ return static_cast<int64_t>(t.start_stop_id);      });
+  cols["end_arrival_time"]   = trips_column<double> (trips, [](const TripInfo &t){ return static_cast<double> (t.end_arrival_time);   });
+  cols["end_stop_id"]        = trips_column<int64_t>(trips, [](const TripInfo &t){ return static_cast<int64_t>(t.end_stop_id);        });
+  cols["distance"]           = trips_column<double> (trips, [](const TripInfo &t){ return static_cast<double> (t.distance);           });
+  cols["wait_time"]          = trips_column<double> (trips, [](const TripInfo &t){ return static_cast<double> (t.wait_time);          });
+  cols["bus_busy_start"]     = trips_column<double> (trips, [](const TripInfo &t){ return static_cast<double> (t.bus_busy_start);     });
+  cols["bus_busy_end"]       = trips_column<double> (trips, [](const TripInfo &t){ return static_cast<double> (t.bus_busy_end);       });
+  cols["bus_id"]             = trips_column<int32_t>(trips, [](const TripInfo &t){ return t.bus_id;                                  });
+  cols["start_depot_id"]     = trips_column<int64_t>(trips, [](const TripInfo &t){ return static_cast<int64_t>(t.start_depot_id);     });
+  cols["end_depot_id"]       = trips_column<int64_t>(trips, [](const TripInfo &t){ return static_cast<int64_t>(t.end_depot_id);       });
+  cols["energy_left"]        = trips_column<double> (trips, [](const TripInfo &t){ return static_cast<double> (t.energy_left);        });
+  return cols;
+}
+
+
+
 PYBIND11_MODULE(dispatch, m) {
   m.doc() = "Dispatch Python module"; // optional module docstring
 
+  //Long-running calls which touch no Python objects release the GIL so that
+  //other Python threads (e.g. concurrent scenarios) can run meanwhile
+  using release_gil = py::call_guard<py::gil_scoped_release>;
+
   py::class_<Router>(m, "Router")
-    .def(py::init<const std::string &>())
-    .def(py::init<const std::string &, const std::string &>())
+    .def(py::init<const std::string &>(), release_gil())
+    .def(py::init<const std::string &, const std::string &>(), release_gil())
+    .def_static("from_snapshot", py::overload_cast<const std::string &>(&Router::from_snapshot), release_gil())
+    .def_static("from_snapshot", py::overload_cast<const std::string &, const std::string &>(&Router::from_snapshot), release_gil())
     .def("getTravelTime",  &Router::getTravelTime)
     .def("getNearestNode", &Router::getNearestNode)
-    .def("save_ch",        &Router::save_ch);
+    .def("save_ch",        &Router::save_ch,       release_gil())
+    .def("save_snapshot",  &Router::save_snapshot, release_gil());
 
   py::class_<TripInfo>(m, "TripInfo")
     .def(py::init<>())
@@ -47,12 +176,19 @@ PYBIND11_MODULE(dispatch, m) {
     .def_readwrite("nondepot_charger_cost", &Parameters::nondepot_charger_cost)
     .def_readwrite("nondepot_charger_rate", &Parameters::nondepot_charger_rate)
     .def_readwrite("chargers_per_depot",    &Parameters::chargers_per_depot)
+    .def_readwrite("optimizer",             &Parameters::optimizer)
+    .def_readwrite("local_search_start",    &Parameters::local_search_start)
     .def_readwrite("generations",           &Parameters::generations)
     .def_readwrite("mutation_rate",         &Parameters::mutation_rate)
     .def_readwrite("keep_top",              &Parameters::keep_top)
     .def_readwrite("spawn_size",            &Parameters::spawn_size)
+    .def_readwrite("patience",              &Parameters::patience)
+    .def_readwrite("min_improvement",       &Parameters::min_improvement)
+    .def_readwrite("time_limit",            &Parameters::time_limit)
     .def_readwrite("restarts",              &Parameters::restarts)
-    .def_readwrite("seed",                  &Parameters::seed);
+    .def_readwrite("migration_interval",    &Parameters::migration_interval)
+    .def_readwrite("seed",                  &Parameters::seed)
+    .def_readwrite("fitness_cache_size",    &Parameters::fitness_cache_size);
 
 
   py::class_<ClosestDepotInfo>(m, "ClosestDepotInfo")
@@ -71,22 +207,62 @@ PYBIND11_MODULE(dispatch, m) {
     .def_readwrite("depot_distance", &StopInfo::depot_distance);
 
   py::class_<ModelInfo>(m, "ModelInfo")
-    .def(py::init<const Parameters&, const std::string&, const std::string&>())
+    .def(py::init<const Parameters&, const std::string&, const std::string&>(), release_gil())
+    .def(py::init([](const Parameters &params, const py::dict &trips, const py::dict &stops){
+      return new ModelInfo(params, dict_trips_to_internal(trips), dict_stops_to_internal(stops));
+    }), "Build from dicts mapping column names to NumPy arrays")
     .def("update_params", &ModelInfo:: update_params)
     .def_readonly("params", &ModelInfo::params)
     .def_readonly("trips",  &ModelInfo::trips)
-    .def_readonly("stops",  &ModelInfo::stops);
+    .def_readonly("stops",  &ModelInfo::stops)
+    .def_readonly("trip_stop_count",    &ModelInfo::trip_stop_count,
+      "Number of distinct stops at which trips start or end")
+    .def_readonly("charger_candidates", &ModelInfo::genome_stops,
+      "Stops where a charger can affect the simulation; the only ones the optimizer considers");
 
   py::class_<ModelResults>(m, "ModelResults")
     .def(py::init<>())
     .def("__repr__", &ModelResults::repr)
+    .def("trip_columns", [](const ModelResults &results){ return trips_to_columns(results.trips); },
+      "Returns the trips as a dict of NumPy arrays, one per TripInfo field")
+    .def("depot_usage", [](const ModelResults &results){ return depot_usage_to_columns(depot_usage(results.trips)); },
+      "Returns (peaks, series): per-depot peak buses and when they were first reached, and the number of buses out of each depot after each change, both as dicts of NumPy arrays")
     .def_readwrite("trips",        &ModelResults::trips)
     .def_readwrite("cost",         &ModelResults::cost)
+    .def_readonly("bus_count",     &ModelResults::bus_count)
+    .def_readonly("charger_count", &ModelResults::charger_count)
+    .def_readonly("depot_count",   &ModelResults::depot_count)
+    .def_readonly("buses_per_depot", &ModelResults::buses_per_depot)
+    .def_readonly("stop_reasons",    &ModelResults::stop_reasons)
+    .def_readonly("generations_run", &ModelResults::generations_run)
     .def_readwrite("has_charger",  &ModelResults::has_charger);
 
-  m.def("GetClosestDepot", &GetClosestDepot, "TODO");
+  m.def("GetClosestDepot", &GetClosestDepot, "TODO", release_gil());
+  m.def("GetTravelMatrix",
+    [](const Router &router, const std::vector<double> &source_lat, const std::vector<double> &source_lon, const std::vector<double> &target_lat, const std::vector<double> &target_lon, const double search_radius_m){
+      const auto matrix = [&]{
+        py::gil_scoped_release release;
+        return router.getTravelMatrix(source_lat, source_lon, target_lat, target_lon, (int)search_radius_m);
+      }();
+      const std::vector<size_t> shape = {matrix.rows, matrix.cols};
+      return py::make_tuple(
+        py::array_t<double>(shape, matrix.travel_time.data()),
+        py::array_t<double>(shape, matrix.distance.data())
+      );
+    },
+    "Returns (travel time (s), travel distance (m)) matrices of shape sources x targets. Times are NaN where there is no route; distances are only given for each source's closest target and are NaN elsewhere."
+  );
+  m.def("GetPathDistances", &Router::getPathDistances,
+    "Returns the route distance (m) from each source to the target with the same index. NaN where there is no route.",
+    py::arg("router"), py::arg("source_lat"), py::arg("source_lon"), py::arg("target_lat"), py::arg("target_lon"), py::arg("search_radius_m"),
+    release_gil());
   m.def("count_buses", &count_buses, "TODO");
-  m.def("run_model", &run_model, "TODO");
-  m.def("optimize_model", &optimize_model, "TODO");
+  m.def("depot_usage", [](const trips_t &trips){ return depot_usage_to_columns(depot_usage(trips)); },
+    "Returns (peaks, series) for a list of simulated trips. See ModelResults.depot_usage()");
+  m.def("trips_to_columns", &trips_to_columns, "Returns a vector of TripInfo as a dict of NumPy arrays, one per field");
+  m.def("run_model", &run_model, "TODO", release_gil());
+  m.def("optimize_model", &optimize_model,
+    "Search for the cheapest charger layout, optionally starting from seed has_charger layouts",
+    py::arg("model_info"), py::arg("seeds")=std::vector<HasCharger>(), release_gil());
   m.def("calculate_costs", &calculate_costs, "TODO");
 }
@@ -26,8 +26,10 @@ Keys:
 * `end_lng`:              Longitude of the end of the trip.
 * `distance`:             Length of the trip in meters.
 * `duration`:             Duration of the trip in seconds.
-* `wait_time`:            How long the bus is scheduled to spend waiting at
+* `dwell_time`:           How long the bus is scheduled to spend waiting at
                           stops during the trip.
+* `wait_time`:            How long the bus waits after the trip before the next
+                          trip of its block starts (0 if there isn't one).
 
 stops
 =========================
@@ -72,12 +74,18 @@ Keys:
 * `distance`:             Length of the segment. TODO: need traversal time.
 """
 
+import argparse
 import collections
-from functools import partial
+import contextlib
+import datetime
+from functools import lru_cache, partial
 import itertools
+import json
 import math
+import os
 import pickle
 import sys
+import zipfile
 
 import numpy as np
 import pandas as pd
@@ -86,8 +94,23 @@ import pyproj
 import shapely as shp
 import shapely.ops
 
+import caching
+import columnar
 
 
+
+#Version of what `ParseFile()` writes. Bump it whenever a change here changes
+#the parsed outputs so that feeds parsed by an older version are parsed again.
+PARSER_VERSION = 2
+
+#Tables written by `ParseFile()`
+PARSED_TABLES = ['trips', 'stops', 'stop_times']
+
+#GTFS identifiers. Columns holding them (including prefixed ones such as
+#`start_stop_id`) are always written as strings: ids may have leading zeros and
+#a feed may have both numeric and non-numeric ids.
+ID_COLUMNS = ['trip_id', 'stop_id', 'block_id', 'route_id', 'service_id', 'shape_id']
+
 #GTFS uses numeric identifiers to indicate what kind of vehicles serve a route.
 #The relevant bus-like identifiers for us are below.
 route_types = list(itertools.chain.from_iterable([
@@ -132,18 +155,33 @@ def dedupe_adjacent(iterable):
 
 
 
-def wgs_to_aea(x,y):
-  """Converts to a US Contiguous Albert Equal Area projection."""
-  # TODO: This fails on pyproj>2.0.
-  return pyproj.transform(
+@lru_cache(maxsize=None)
+def GetProjector():
+  """Returns a function mapping arrays of WGS84 longitudes and latitudes to US
+  Contiguous Albers Equal Area x and y coordinates (meters).
+
+  The projection is set up once per process and reused. pyproj>=2 provides a
+  `Transformer` for this; older versions (see requirements.txt) fall back to a
+  cached pair of `Proj` objects and `pyproj.transform()`, which also accepts
+  whole arrays.
+  """
+  if hasattr(pyproj, 'Transformer'):
+    transformer = pyproj.Transformer.from_crs('epsg:4326', 'esri:102003', always_xy=True)
+    return transformer.transform
+  return partial(
+    pyproj.transform,
     pyproj.Proj(init='epsg:4326'),    # source coordinate system
     pyproj.Proj(init='esri:102003'),  # destination coordinate system
-    x,
-    y
   )
 
 
 
+def wgs_to_aea(x,y):
+  """Converts to a US Contiguous Albert Equal Area projection."""
+  return GetProjector()(x, y)
+
+
+
 def ChangeProjection(geom):
     geom = shapely.ops.transform(wgs_to_aea, geom)  # apply projection
     #Something for getting spherical distances from linestrings of lat-long coordinates goes here
@@ -152,9 +190,186 @@ def ChangeProjection(geom):
 
 
 def GetGeoDistanceFromLineString(line_string):
-    line_string = shapely.ops.transform(wgs_to_aea, line_string)  # apply projection
-    #Something for getting spherical distances from linestrings of lat-long coordinates goes here
-    return line_string.length
+    return GetLineStringLengths([line_string])[0]
+
+
+
+def GetLineStringLengths(line_strings):
+  """Returns the length in meters of each of a sequence of lat-long
+  LineStrings, measured in the equal-area projection.
+
+  The vertices of all of the lines are projected in one call and the segment
+  lengths are summed per line with `np.add.reduceat`.
+  """
+  coords = [np.asarray(ls.coords)[:, :2] for ls in line_strings]
+  if len(coords)==0:
+    return np.zeros(0)
+  counts = np.array([len(c) for c in coords])
+  starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+  lng, lat = np.concatenate(coords).T
+  x, y = wgs_to_aea(lng, lat)
+
+  #seg[i] is the distance from vertex i to vertex i+1. The segments joining
+  #the last vertex of one line to the first of the next are not real, so
+  #they are zeroed, as is the padding after the final vertex.
+  seg = np.append(np.hypot(np.diff(x), np.diff(y)), 0.0)
+  seg[starts[1:]-1] = 0.0
+  return np.add.reduceat(seg, starts)
+
+
+
+#Rows of stop_times.txt to read at a time
+STOP_TIMES_CHUNKSIZE = 1000000
+
+#Columns of stop_times.txt that are used
+STOP_TIMES_COLUMNS = {
+  'trip_id', 'stop_id', 'stop_sequence', 'arrival_time', 'departure_time',
+  'pickup_type', 'drop_off_type',
+}
+
+
+
+def ParseTimes(times):
+  """Converts a Series of GTFS HH:MM:SS times into seconds after midnight.
+  Hours may exceed 23 for service past midnight. Blank times become NaN."""
+  hms = times.str.extract(r'^\s*(\d+):(\d{1,2}):(\d{1,2})\s*$').astype(float)
+  return hms[0]*3600 + hms[1]*60 + hms[2]
+
+
+
+@contextlib.contextmanager
+def OpenFeedFile(gtfs_filename, name):
+  """Opens one of the files of a GTFS feed, which may be a zip (possibly with
+  the files in a subdirectory) or a directory."""
+  if os.path.isdir(gtfs_filename):
+    with open(os.path.join(gtfs_filename, name), 'rb') as fin:
+      yield fin
+    return
+  with zipfile.ZipFile(gtfs_filename) as zf:
+    members = [x for x in zf.namelist() if os.path.basename(x)==name]
+    if not members:
+      raise Exception(f"{gtfs_filename} has no {name}!")
+    with zf.open(members[0]) as fin:
+      yield fin
+
+
+
+class FeedSession:
+  """A GTFS feed whose tables are each decoded at most once.
+
+  The zip is opened the first time a table is needed and each table is parsed
+  the first time it is used. Everything handed the same session (the
+  validation checks, `GetExtents()` and the `Generate*()` functions) then
+  shares those tables, so they must be treated as read-only: copy a table
+  before adding or changing columns.
+  """
+  def __init__(self, gtfs_filename):
+    """
+    Args:
+      gtfs_filename - Location of the GTFS zip
+    """
+    self.filename        = gtfs_filename
+    self._feed           = None
+    self._busiest_date   = None
+    self._stop_locations = None
+
+  @property
+  def feed(self):
+    """The underlying partridge geo feed. Tables are read on first access."""
+    if self._feed is None:
+      self._feed = ptg.load_geo_feed(self.filename)
+    return self._feed
+
+  routes     = property(lambda self: self.feed.routes)
+  trips      = property(lambda self: self.feed.trips)
+  stops      = property(lambda self: self.feed.stops)
+  stop_times = property(lambda self: self.feed.stop_times)
+  shapes     = property(lambda self: self.feed.shapes)
+
+  calendar       = property(lambda self: self.feed.calendar)
+  calendar_dates = property(lambda self: self.feed.calendar_dates)
+
+  def service_ids_by_date(self):
+    """Returns {date: frozenset of service_ids} for every date on which at
+    least one service used by a trip runs. Dates a service is removed from in
+    calendar_dates.txt take precedence over those it is added on."""
+    used     = set(self.trips.service_id)
+    added    = collections.defaultdict(set)
+    removed  = collections.defaultdict(set)
+    weekdays = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+    calendar = self.calendar
+    for _, cal in calendar[calendar.service_id.isin(used)].iterrows():
+      for ordinal in range(cal.start_date.toordinal(), cal.end_date.toordinal()+1):
+        date = datetime.date.fromordinal(ordinal)
+        if int(cal[weekdays[date.weekday()]]):
+          added[date].add(cal.service_id)
+    calendar_dates = self.calendar_dates
+    for _, cd in calendar_dates[calendar_dates.service_id.isin(used)].iterrows():
+      if int(cd.exception_type)==1:
+        added[cd.date].add(cd.service_id)
+      elif int(cd.exception_type)==2:
+        removed[cd.date].add(cd.service_id)
+    service_ids = {date: frozenset(ids-removed[date]) for date, ids in added.items()}
+    return {date: ids for date, ids in service_ids.items() if ids}
+
+  def busiest_date(self):
+    """Returns (date, service_ids) for the date with the most trips, as
+    `ptg.read_busiest_date()` would, but from this session's tables. Ties go
+    to the earliest date."""
+    if self._busiest_date is None:
+      trips_per_service = self.trips.service_id.value_counts()
+      service_ids_by_date = self.service_ids_by_date()
+      if not service_ids_by_date:
+        raise Exception(f"{self.filename} has no dates with service!")
+      trip_counts = {
+        date: int(trips_per_service.reindex(list(ids), fill_value=0).sum())
+        for date, ids in service_ids_by_date.items()
+      }
+      date = max(trip_counts, key=lambda d: (trip_counts[d], -d.toordinal()))
+      self._busiest_date = (date, service_ids_by_date[date])
+    return self._busiest_date
+
+  def stop_time_chunks(self, chunksize=STOP_TIMES_CHUNKSIZE):
+    """Yields stop_times.txt in DataFrames of at most `chunksize` rows, reading
+    it straight from the feed rather than loading the whole table.
+
+    As in partridge's tables, ids are strings and `arrival_time` and
+    `departure_time` are seconds after midnight (NaN where blank).
+    """
+    with OpenFeedFile(self.filename, 'stop_times.txt') as fin:
+      reader = pd.read_csv(
+        fin,
+        chunksize = chunksize,
+        dtype     = str,
+        encoding  = 'utf-8-sig',
+        usecols   = lambda c: c.strip() in STOP_TIMES_COLUMNS,
+      )
+      for chunk in reader:
+        chunk.columns = chunk.columns.str.strip()
+        chunk['stop_sequence']  = pd.to_numeric(chunk['stop_sequence'])
+        chunk['arrival_time']   = ParseTimes(chunk['arrival_time'])
+        chunk['departure_time'] = ParseTimes(chunk['departure_time'])
+        yield chunk
+
+  def stop_locations(self):
+    """Returns the `lat`, `lng` and projected `x` and `y` of every stop,
+    indexed like `stops`."""
+    if self._stop_locations is None:
+      stops = self.stops
+      lat   = stops.geometry.y.to_numpy()
+      lng   = stops.geometry.x.to_numpy()
+      x, y  = wgs_to_aea(lng, lat)  #All of the stops in one call
+      self._stop_locations = pd.DataFrame({'lat': lat, 'lng': lng, 'x': x, 'y': y}, index=stops.index)
+    return self._stop_locations
+
+
+
+def GetSession(gtfs):
+  """Returns `gtfs` if it is a `FeedSession`, otherwise opens a session on the
+  file it names."""
+  if isinstance(gtfs, FeedSession):
+    return gtfs
+  return FeedSession(gtfs)
 
 
 
@@ -173,7 +388,7 @@ def MatchColumn(df, colname):
 
 
 def GenerateTrips(gtfs, date, service_ids):
-  """TODO:
+  """Builds the trips table. `gtfs` is a `FeedSession` and is not modified.
   """
   # filter for bus routes only
   bus_routes = gtfs.routes[gtfs.routes.route_type.isin(route_types)]['route_id']
@@ -183,68 +398,37 @@ def GenerateTrips(gtfs, date, service_ids):
   #because they include service_ids as a substring (TODO: Is this universal?)
   trips = gtfs.trips[gtfs.trips.service_id.isin(service_ids)]
 
-  #Clean up stops data
-  gtfs.stops['lat'] = gtfs.stops.geometry.y
-  gtfs.stops['lng'] = gtfs.stops.geometry.x
-
-  #Change the projection of the stops
-  gtfs.stops['geometry'] = gtfs.stops['geometry'].map(ChangeProjection)
-
-  gtfs.stops['x'] = gtfs.stops.geometry.x
-  gtfs.stops['y'] = gtfs.stops.geometry.y
+  #Stop ids with their lat-long and projected coordinates
+  stop_locations = gtfs.stops[['stop_id']].join(gtfs.stop_locations())
 
-  #Combine trips with stop data
-  trips = trips.merge(gtfs.stop_times, left_on='trip_id', right_on='trip_id')
-
-  #Add missing pickup_type and drop_off_type columns
-  if 'pickup_type' not in trips.columns:
-    trips['pickup_type'] = 0
-  if 'drop_off_type' not in trips.columns:
-    trips['drop_off_type'] = 0
   if 'trip_headsign' not in trips.columns:
-    trips['trip_headsign'] = "##none##"
-
-  #0 or empty - Regularly scheduled drop off. (https://developers.google.com/transit/gtfs/reference)
-  trips.pickup_type   = trips.pickup_type.fillna(0)
-  trips.drop_off_type = trips.drop_off_type.fillna(0)
-  trips.trip_headsign = trips.trip_headsign.fillna("##none##")
-
-  #Filter trips to only regularly scheduled stops. Values are:
-  #0 or empty - Regularly scheduled pickup.
-  #1 - No pickup available.
-  #2 - Must phone agency to arrange pickup.
-  #3 - Must coordinate with driver to arrange pickup.
-  trips = trips[trips.pickup_type.astype(int)==0]
-  trips = trips[trips.drop_off_type.astype(int)==0]
-
-  trips = trips.sort_values(['trip_id','route_id','service_id','stop_sequence'])
+    trips = trips.assign(trip_headsign="##none##")
 
   #TODO: Maybe concatenate trip_id with a service_id and route_id and direction_id to ensure it is unique?
 
-  #Drops 'route_id', 'timepoint', 'wheelchair_accessible', 'pickup_type',
-  #'drop_off_type', 'service_id', 'direction_id', 'route_id', 'stop_sequence'
+  #Drops 'route_id', 'direction_id', 'wheelchair_accessible' and the like
   trips = trips[[
-                'service_id',
                 'trip_id',
+                'service_id',
                 'trip_headsign',
                 'block_id',
                 'shape_id',
-                'arrival_time',
-                'departure_time',
-                'stop_id',
-               ]]
+               ]].copy()
+  trips['trip_headsign'] = trips.trip_headsign.fillna("##none##")
 
   #TODO: block_id is supposed to indicate continuous travel by a *single vehicle*
   #and, thus, might provide a good way of simplifying the problem
 
-  #We need to get information about when each trip begins and ends, so we sort and
-  #then group by trip. Each group is then ordered such that its first and last
-  #entries contain the needed information.
-  first_stops = trips.groupby(by='trip_id').first().reset_index()
-  last_stops  = trips.groupby(by='trip_id').last().reset_index()
+  #We need to get information about when each trip begins and ends. Rather than
+  #joining every trip with all of its stop_times, stop_times is streamed and
+  #reduced to the first and last stop of each trip.
+  first_times, last_times, dwell_time = ReduceStopTimes(gtfs, trips['trip_id'])
+
+  first_stops = trips.merge(first_times, on='trip_id')
+  last_stops  = trips.merge(last_times,  on='trip_id')
 
-  first_stops = first_stops.merge(gtfs.stops[['stop_id','lat','lng','x','y']], how='left', on='stop_id')
-  last_stops  = last_stops.merge (gtfs.stops[['stop_id','lat','lng','x','y']], how='left', on='stop_id')
+  first_stops = first_stops.merge(stop_locations, how='left', on='stop_id')
+  last_stops  = last_stops.merge (stop_locations, how='left', on='stop_id')
 
   trips = first_stops.merge(last_stops, on="trip_id")
 
@@ -267,10 +451,12 @@ def GenerateTrips(gtfs, date, service_ids):
   trips = MatchColumn(trips,'trip_headsign')
 
   #Merge in distances
-  gtfs.shapes['distance'] = gtfs.shapes['geometry'].map(GetGeoDistanceFromLineString)
-  trips = trips.merge(gtfs.shapes[['shape_id', 'distance']], how='left', on='shape_id')
+  shapes = gtfs.shapes[['shape_id']].copy()
+  shapes['distance'] = GetLineStringLengths(gtfs.shapes['geometry'])
+  trips = trips.merge(shapes, how='left', on='shape_id')
   trips = trips.drop(columns='shape_id')
   trips['duration'] = trips['end_arrival_time']-trips['start_departure_time']
+  trips['dwell_time'] = trips['trip_id'].map(dwell_time).fillna(0)
 
   #Get wait time between trips
   trips = trips.sort_values(["block_id", "start_arrival_time"])
@@ -285,24 +471,14 @@ def GenerateTrips(gtfs, date, service_ids):
 
 
 def GenerateStops(gtfs):
-  """TODO:
+  """Builds the stops table. `gtfs` is a `FeedSession` and is not modified.
   """
   #TODO: Make sure this table doesn't have weird extra columns
-  #Change the projection of the stops
-  stops = gtfs.stops.copy()
-
-  stops['lat'] = stops.geometry.y
-  stops['lng'] = stops.geometry.x
-
-  geom = stops['geometry'].copy().map(ChangeProjection)
-
-  #Clean up stops data
-  stops['x'] = geom.x
-  stops['y'] = geom.y
+  stops = gtfs.stops.join(gtfs.stop_locations())
 
   #Drop unneeded columns including 'wheelchair_boarding', 'stop_url', 'zone_id',
   #'stop_desc', 'location_type', 'stop_code', 'geometry'
-  stops = stops[['stop_id', 'stop_name', 'lat', 'lng', 'x', 'y']]
+  stops = stops[['stop_id', 'stop_name', 'lat', 'lng', 'x', 'y']].copy()
 
   stops['inductive_charging'] = False # Whether there's an inductive charger
   stops['evse'] = False               # Whether there is a traditional EVSE charger
@@ -341,18 +517,85 @@ def GenerateRoadSegments(gtfs):
 
 
 
-def GenerateStopTimes(gtfs):
+def GenerateStopTimes(gtfs, chunksize=STOP_TIMES_CHUNKSIZE):
+  """Yields the stop_times table in chunks of at most `chunksize` rows."""
   #TODO: Worry about pickup type and dropoff type?
-  stop_times = gtfs.stop_times.copy()
-  stop_times['stop_duration'] = stop_times['departure_time'] - stop_times['arrival_time']
-  stop_times = stop_times[['trip_id', 'stop_id', 'stop_duration']]
-  return stop_times
+  for stop_times in gtfs.stop_time_chunks(chunksize):
+    stop_times['stop_duration'] = stop_times['departure_time'] - stop_times['arrival_time']
+    yield stop_times[['trip_id', 'stop_id', 'stop_duration']]
+
+
+
+def ReduceStopTimes(gtfs, trip_ids, chunksize=STOP_TIMES_CHUNKSIZE):
+  """Streams stop_times and keeps only what the trips table needs from it.
+
+  Memory use is bounded by `chunksize` and the number of trips rather than by
+  the size of stop_times.
+
+  Args:
+    gtfs      - A `FeedSession`
+    trip_ids  - Trips to keep. Rows of other trips are dropped as they are read
+    chunksize - Number of stop_times rows to read at a time
+
+  Returns:
+    first      - DataFrame with the `trip_id`, `arrival_time`, `departure_time`
+                 and `stop_id` of the regularly scheduled stop with the lowest
+                 `stop_sequence` of each trip
+    last       - As `first`, but for the highest `stop_sequence`
+    dwell_time - Series indexed by trip_id giving the total time the trip is
+                 scheduled to spend at its stops
+  """
+  trip_ids = pd.Index(trip_ids).unique()
+  columns  = ['trip_id', 'stop_sequence', 'arrival_time', 'departure_time', 'stop_id']
+
+  def KeepEnd(kept, rows, keep):
+    #`rows` is sorted by trip_id and stop_sequence
+    rows = rows.drop_duplicates('trip_id', keep=keep)
+    if kept is None:
+      return rows
+    rows = pd.concat([kept, rows]).sort_values(['trip_id', 'stop_sequence'], kind='mergesort')
+    return rows.drop_duplicates('trip_id', keep=keep)
+
+  first = last = None
+  dwell_time = pd.Series(dtype=float)
+  for chunk in gtfs.stop_time_chunks(chunksize):
+    chunk = chunk[chunk.trip_id.isin(trip_ids)]
+
+    stop_duration = chunk['departure_time']-chunk['arrival_time']
+    dwell_time    = dwell_time.add(stop_duration.groupby(chunk.trip_id).sum(), fill_value=0)
+
+    #Filter trips to only regularly scheduled stops. Values are:
+    #0 or empty - Regularly scheduled pickup/drop off. (https://developers.google.com/transit/gtfs/reference)
+    #1 - No pickup available.
+    #2 - Must phone agency to arrange pickup.
+    #3 - Must coordinate with driver to arrange pickup.
+    for col in ['pickup_type', 'drop_off_type']:
+      if col in chunk.columns:
+        chunk = chunk[pd.to_numeric(chunk[col]).fillna(0).astype(int)==0]
+
+    chunk = chunk[columns].sort_values(['trip_id', 'stop_sequence'], kind='mergesort')
+    first = KeepEnd(first, chunk, 'first')
+    last  = KeepEnd(last,  chunk, 'last')
+
+  if first is None: #stop_times.txt had no rows
+    first = last = pd.DataFrame(columns=columns)
+
+  first = first.drop(columns='stop_sequence')
+  last  = last.drop (columns='stop_sequence')
+  return first, last, dwell_time
 
 
 
 def DoesFeedLoad(gtfs):
+  """Whether the feed's zip and the tables the other checks need can be read.
+
+  Args:
+    gtfs - A `FeedSession` or the location of a GTFS zip
+  """
   try:
-    feed = ptg.load_feed(gtfs)
+    gtfs = GetSession(gtfs)
+    gtfs.routes
+    gtfs.trips
     return True
   except Exception as e:
     print(e)
@@ -360,60 +603,186 @@ def DoesFeedLoad(gtfs):
 
 
 
-def HasBusRoutes(gtfs_filename):
+def HasBusRoutes(gtfs):
   #Check to see if the feed contains any buses
-  feed = ptg.load_feed(gtfs_filename)
-  return feed.routes.route_type.isin(route_types).any()
+  return GetSession(gtfs).routes.route_type.isin(route_types).any()
 
 
 
-def HasBlockIDs(gtfs_filename):
-  gtfs = ptg.load_feed(gtfs_filename)
-  if 'block_id' not in gtfs.trips.columns: #block_id column missing
+def HasBlockIDs(gtfs):
+  trips = GetSession(gtfs).trips
+  if 'block_id' not in trips.columns: #block_id column missing
     return False
-  if gtfs.trips['block_id'].isna().any():  #block_id column there but some are missing data
+  if trips['block_id'].isna().any():  #block_id column there but some are missing data
     return False
   return True
 
 
 
-def GetExtents(gtfs_filename):
+def GetExtents(gtfs):
   """Returns a bounding box containing all of the feed's stops.
 
   Returns: [minlon, minlat, maxlon, maxlat]
   """
-  gtfs   = ptg.load_geo_feed(gtfs_filename)
-  bounds = gtfs.stops.total_bounds
+  bounds = GetSession(gtfs).stops.total_bounds
   if np.isnan(bounds).any():
     raise Exception("Extents: bounds had a nan!")
   return bounds.tolist()
 
 
 
-def ParseFile(gtfs_filename, output_prefix):
+def IdColumns(df):
+  """Returns the columns of `df` which hold GTFS identifiers."""
+  return [c for c in df.columns if any(c==x or c.endswith('_'+x) for x in ID_COLUMNS)]
+
+
+
+def FeedHash(gtfs_filename):
+  """Returns the sha256 of a GTFS zip, or None if the feed is a directory."""
+  if not os.path.isfile(gtfs_filename):
+    return None
+  return caching.FileHash(gtfs_filename)
+
+
+
+def ParsedFiles(output_prefix, with_csv=False, tables=PARSED_TABLES):
+  """Returns {path relative to the output directory: path} for every file
+  `ParseFile()` wrote for `output_prefix` which still exists.
+
+  Args:
+    output_prefix - Prefix the outputs were written with
+    with_csv      - Include the CSV copies of the tables
+    tables        - Only include the files of these tables
+  """
+  base  = os.path.dirname(os.path.abspath(output_prefix))
+  files = []
+  for table in tables:
+    dirname = f"{output_prefix}_{table}"
+    if os.path.isdir(dirname):
+      files += [os.path.join(dirname, x) for x in sorted(os.listdir(dirname))]
+    if with_csv:
+      files.append(f"{output_prefix}_{table}.csv")
+  return {os.path.relpath(os.path.abspath(f), base): f for f in files if os.path.isfile(f)}
+
+
+
+def ParsedHashes(output_prefix, with_csv=False):
+  """Returns the sha256 of each of `ParsedFiles()`, keyed like it."""
+  return {rel: caching.FileHash(f) for rel, f in ParsedFiles(output_prefix, with_csv).items()}
+
+
+
+def ParsedStats(output_prefix, with_csv=False):
+  """Returns the [size, mtime_ns] of each of `ParsedFiles()`, keyed like it."""
+  return {rel: caching.FileStat(f) for rel, f in ParsedFiles(output_prefix, with_csv).items()}
+
+
+
+def ReadManifest(output_prefix):
+  """Returns the manifest `ParseFile()` wrote for `output_prefix`, or None if
+  there isn't one."""
+  filename = output_prefix+"_manifest.json"
+  if not os.path.exists(filename):
+    return None
+  with open(filename, 'r') as f:
+    return json.load(f)
+
+
+
+def IsParsed(gtfs_filename, output_prefix, write_csv=False):
+  """Whether `ParseFile()` would find nothing to do: the outputs were written
+  by this `PARSER_VERSION` from a feed with the same contents (and with CSVs if
+  `write_csv`) and haven't changed since."""
+  manifest = ReadManifest(output_prefix)
+  if manifest is None:
+    return False
+  if manifest['parser_version']!=PARSER_VERSION or (write_csv and not manifest['csv']):
+    return False
+  #Files whose size and mtime match those recorded aren't rehashed
+  if not caching.FileUnchanged(gtfs_filename, manifest['feed_hash'], manifest.get('feed_stat')):
+    return False
+  files  = ParsedFiles(output_prefix, manifest['csv'])
+  hashes = manifest['outputs']
+  stats  = manifest.get('output_stats', {})
+  return set(files)==set(hashes) and all(
+    caching.FileUnchanged(f, hashes[rel], stats.get(rel)) for rel, f in files.items()
+  )
+
+
+
+def ParseFile(gtfs, output_prefix, write_csv=False, force=False):
+  """Writes the trips, stops and stop_times tables of a feed.
+
+  Each table is written as a columnar table (see `columnar.py`) in the
+  directory `<output_prefix>_<table>`. A manifest of what was written goes in
+  `<output_prefix>_manifest.json`. If the manifest shows the outputs are
+  already up to date (see `IsParsed()`) nothing is parsed.
+
+  Args:
+    gtfs          - A `FeedSession` or the location of a GTFS zip
+    output_prefix - Prefix of the output tables
+    write_csv     - Also write each table to `<output_prefix>_<table>.csv`
+    force         - Parse even if the outputs are up to date
+
+  Returns: The manifest: the feed's sha256 (`feed_hash`) and [size,
+           mtime_ns] (`feed_stat`), the `parser_version`, whether CSVs were
+           written (`csv`) and the sha256 and [size, mtime_ns] of each output
+           file (`outputs` and `output_stats`, see `ParsedHashes()` and
+           `ParsedStats()`)
+  """
+  gtfs = GetSession(gtfs)
+
+  if not force and IsParsed(gtfs.filename, output_prefix, write_csv):
+    print(f"{output_prefix} is up to date")
+    return ReadManifest(output_prefix)
+
   # find the busiest date
-  date, service_ids = ptg.read_busiest_date(gtfs_filename)
+  date, service_ids = gtfs.busiest_date()
 
   print("Service id chosen = {0}".format(service_ids))
 
-  #Load file twice so that we don't modify it within these functions
-  trips      = GenerateTrips(ptg.load_geo_feed(gtfs_filename), date, service_ids)
-  stops      = GenerateStops(ptg.load_geo_feed(gtfs_filename))
-  stop_times = GenerateStopTimes(ptg.load_geo_feed(gtfs_filename))
-  # road_segs, seg_props = GenerateRoadSegments(ptg.load_geo_feed(gtfs_filename))
+  trips      = GenerateTrips(gtfs, date, service_ids)
+  stops      = GenerateStops(gtfs)
+  # road_segs, seg_props = GenerateRoadSegments(gtfs)
 
-  trips.to_csv(output_prefix+"_trips.csv", index=False)
-  stops.to_csv(output_prefix+"_stops.csv", index=False)
-  stop_times.to_csv(output_prefix+"_stop_times.csv", index=False)
+  columnar.WriteTable(output_prefix+"_trips", trips, strings=IdColumns(trips))
+  columnar.WriteTable(output_prefix+"_stops", stops, strings=IdColumns(stops))
 
+  #stop_times is written as it is read so that it is never held in memory
+  for i, stop_times in enumerate(GenerateStopTimes(gtfs)):
+    if i==0:
+      columnar.WriteTable(output_prefix+"_stop_times", stop_times, strings=IdColumns(stop_times))
+    else:
+      columnar.AppendTable(output_prefix+"_stop_times", stop_times)
 
+  if write_csv:
+    for table in PARSED_TABLES:
+      columnar.ExportCSV(f"{output_prefix}_{table}", f"{output_prefix}_{table}.csv")
 
-def main():
-  if len(sys.argv)!=3:
-    print("Syntax: {0} <GTFS File> <Output Pickle Name>".format(sys.argv[0]))
-    sys.exit(-1)
+  manifest = {
+    'feed_hash':      FeedHash(gtfs.filename),
+    'feed_stat':      caching.FileStat(gtfs.filename) if os.path.isfile(gtfs.filename) else None,
+    'parser_version': PARSER_VERSION,
+    'csv':            write_csv,
+    'outputs':        ParsedHashes(output_prefix, write_csv),
+    'output_stats':   ParsedStats(output_prefix, write_csv),
+  }
+  with caching.AtomicWrite(output_prefix+"_manifest.json") as temp_filename:
+    with open(temp_filename, 'w') as f:
+      json.dump(manifest, f, indent=2)
+  return manifest
 
-  ParseFile(gtfs_filename=sys.argv[1], output_prefix=sys.argv[2])
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Convert a GTFS feed into the tables used by the simulation')
+  parser.add_argument('gtfs_filename', type=str, help='GTFS zip to read')
+  parser.add_argument('output_prefix', type=str, help='Prefix of the output tables')
+  parser.add_argument('--csv', action='store_true', help='Also write each table as a CSV')
+  parser.add_argument('--force', action='store_true', help='Parse even if the outputs are up to date')
+  args = parser.parse_args()
+
+  ParseFile(args.gtfs_filename, args.output_prefix, write_csv=args.csv, force=args.force)
 
 
 
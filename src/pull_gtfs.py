@@ -17,6 +17,7 @@ import shelve
 from multiprocessing import Pool
 from os.path import basename
 
+import caching
 import parse_gtfs
 
 
@@ -176,11 +177,16 @@ class FeedManager:
                 url = f['u']['i']
             latest = f['latest']['ts']
 
-            if fid not in feed_data:              #We don't know about the feed
+            if fid not in self.db:                #We don't know about the feed
                 self.db[fid] = {"name":name, "url":url, "latest":latest, "needs_update": True}
-            elif feed_data[fid]['latest']<latest: #We do, but our data is old
-                self.db[fid]["latest"] = latest
-                self.db[fid]["needs_update"] = True
+                continue
+            #We do: keep what we know about its data and validation
+            feed = self.db[fid]
+            feed["name"] = name
+            feed["url"] = url
+            if feed["latest"]<latest:             #Our data is old
+                feed["latest"] = latest
+                feed["needs_update"] = True
         self.db.sync()
 
     def feeds_to_update(self):
@@ -188,8 +194,13 @@ class FeedManager:
         return [fid for fid in self.db if self.db[fid]['needs_update']]
 
     def updated(self, fid):
-        """Indicates that data has been acquired for the specified feed"""
+        """Indicates that data has been acquired for the specified feed. If its
+        contents differ from those last validated the feed will be validated
+        again; an identical re-fetch changes nothing."""
         self.db[fid]["needs_update"] = False
+        filename = feed_fn_template.format(feed=clean_fid(fid))
+        if not caching.FileUnchanged(filename, self.db[fid].get("zip_hash"), self.db[fid].get("zip_stat")):
+            self.db[fid]["validation_status"] = "unchecked"
         self.db.sync()
 
     def needs_update_all(self):
@@ -206,19 +217,50 @@ class FeedManager:
         while True:
             fid = out_queue.get(block=True)                   # Retrieve job
             filename = feed_fn_template.format(feed=clean_fid(fid))
+            item = {"fid": fid}
             try:
-                if not parse_gtfs.DoesFeedLoad(filename):
-                    in_queue.put( {"fid":fid, "result": "cannot_load"} )
-                elif not parse_gtfs.HasBusRoutes(filename):
-                    in_queue.put( {"fid":fid, "result": "no_buses"} )
-                elif not parse_gtfs.HasBlockIDs(filename):
-                    in_queue.put( {"fid":fid, "result": "no_blocks"} )
+                # Hash of the data actually validated
+                item["zip_stat"] = caching.FileStat(filename)
+                item["zip_hash"] = caching.FileHash(filename)
+                # Shared by all of the checks so that each table is read once
+                session = parse_gtfs.FeedSession(filename)
+                if not parse_gtfs.DoesFeedLoad(session):
+                    item["result"] = "cannot_load"
+                elif not parse_gtfs.HasBusRoutes(session):
+                    item["result"] = "no_buses"
+                elif not parse_gtfs.HasBlockIDs(session):
+                    item["result"] = "no_blocks"
                 else:
-                    extents = parse_gtfs.GetExtents(filename)
-                    parse_gtfs.ParseFile(filename, parsed_template.format(feed=clean_fid(fid)))
-                    in_queue.put( {"fid": fid, "result":"good", "extents":extents} )
+                    item["extents"] = parse_gtfs.GetExtents(session)
+                    # Skips parsing if the outputs are already up to date
+                    manifest = parse_gtfs.ParseFile(session, parsed_template.format(feed=clean_fid(fid)))
+                    item["parsed_hashes"] = manifest["outputs"]
+                    item["parsed_stats"] = manifest.get("output_stats")
+                    item["result"] = "good"
             except Exception as err:
-                in_queue.put( {"fid":fid, "result": f"error: {err}"} )
+                item["result"] = f"error: {err}"
+            in_queue.put(item)
+
+    def needs_validation(self, fid):
+        """Whether a feed has to be validated: it is unchecked or its data, the
+        parser or (for good feeds) its parsed outputs have changed since it was
+        last validated."""
+        feed = self.db[fid]
+        status = feed.get("validation_status", "unchecked")
+        if status=="unchecked":
+            return True
+        filename = feed_fn_template.format(feed=clean_fid(fid))
+        if not os.path.exists(filename):
+            return False
+        # Only rehashed if its size or mtime changed
+        if not caching.FileUnchanged(filename, feed.get("zip_hash"), feed.get("zip_stat")):
+            return True
+        if feed.get("parser_version")!=parse_gtfs.PARSER_VERSION:
+            return True
+        if status=="good":
+            # The parse's manifest says whether its outputs are still those of this zip
+            return not parse_gtfs.IsParsed(filename, parsed_template.format(feed=clean_fid(fid)))
+        return False
 
     def validate_feeds(self):
         for fid in sorted(self.db):
@@ -236,8 +278,9 @@ class FeedManager:
         in_queue  = multiprocessing.Queue() # To get data back from workers
         # Pool of workers for downloading data
         pool  = multiprocessing.Pool(self.workers, self.validate_feed, (out_queue,in_queue))
-        #Get a list of unvalidated feeds
-        feed_list = sorted([x for x in self.db if self.db[x].get("validation_status", "unchecked")=="unchecked"])
+        #Get a list of feeds which are unvalidated or have changed
+        feed_list = sorted([x for x in self.db if self.needs_validation(x)])
+        print(f"{len(feed_list)} feeds to validate, {len(self.db)-len(feed_list)} unchanged")
         # Load work onto the queue
         for fid in feed_list:
             print(f"Enqueueing {fid}...")
@@ -250,13 +293,22 @@ class FeedManager:
             if vresult=="good":
                 self.db[fid]["extents"] = item["extents"]
             self.db[fid]["validation_status"] = vresult   # Set validation result
+            self.db[fid]["zip_hash"]       = item.get("zip_hash")       # What was validated
+            self.db[fid]["zip_stat"]       = item.get("zip_stat")
+            self.db[fid]["parser_version"] = parse_gtfs.PARSER_VERSION  # and how
+            self.db[fid]["parsed_hashes"]  = item.get("parsed_hashes")
+            self.db[fid]["parsed_stats"]   = item.get("parsed_stats")
             feed_list.remove(fid)                         # Remove from the fetch list
             self.db.sync()                                # Save state
         pool.terminate()                                  # Terminate the worker processes
 
     def invalidate_feeds(self):
+        """Marks every feed for validation. Parsing is still skipped for feeds
+        whose parsed outputs are up to date (see `parse_gtfs.ParseFile()`)."""
         for fid in sorted(self.db):
             self.db[fid]["validation_status"] = "unchecked"
+            for key in ["zip_hash", "zip_stat", "parser_version", "parsed_hashes", "parsed_stats"]:
+                self.db[fid].pop(key, None)
         self.db.sync()
 
     def print_validation(self):
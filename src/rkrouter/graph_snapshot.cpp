@@ -0,0 +1,246 @@
+#include <routingkit/constants.h>
+#include <routingkit/geo_dist.h>
+
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
+
+#include <algorithm>
+#include <cerrno>
+#include <cmath>
+#include <cstring>
+#include <fstream>
+#include <stdexcept>
+#include <vector>
+
+#include "graph_snapshot.hpp"
+
+namespace rk = RoutingKit;
+
+namespace {
+
+const char     snapshot_magic[8] = {'D','S','P','G','R','A','P','H'};
+const uint32_t snapshot_version  = 1;
+
+//Average number of nodes we aim to put in each cell of the geo index
+const double   nodes_per_cell = 8;
+//Most cells the geo index may have along either axis
+const uint32_t max_grid_dim   = 4096;
+
+const double deg_to_rad = 3.14159265358979323846/180;
+
+size_t align8(const size_t x){
+  return (x+7)/8*8;
+}
+
+
+
+///Byte offsets of each of the snapshot's arrays
+struct Layout {
+  size_t latitude, longitude, first_out, head, travel_time, geo_distance, cell_first, cell_node;
+  size_t total;
+
+  Layout(const GraphSnapshot::Header &h){
+    const size_t nodes = h.node_count;
+    const size_t arcs  = h.arc_count;
+    const size_t cells = static_cast<size_t>(h.grid_rows)*h.grid_cols;
+    size_t pos = align8(sizeof(GraphSnapshot::Header));
+    const auto place = [&](const size_t bytes){
+      const auto start = pos;
+      pos = align8(pos+bytes);
+      return start;
+    };
+    latitude     = place(nodes*sizeof(float));
+    longitude    = place(nodes*sizeof(float));
+    first_out    = place((nodes+1)*sizeof(uint32_t));
+    head         = place(arcs*sizeof(uint32_t));
+    travel_time  = place(arcs*sizeof(uint32_t));
+    geo_distance = place(arcs*sizeof(uint32_t));
+    cell_first   = place((cells+1)*sizeof(uint32_t));
+    cell_node    = place(nodes*sizeof(uint32_t));
+    total        = pos;
+  }
+};
+
+
+
+int64_t cell_row(const GraphSnapshot::Header &h, const double lat){
+  return static_cast<int64_t>(std::floor((lat-h.min_lat)/h.cell_deg));
+}
+
+int64_t cell_col(const GraphSnapshot::Header &h, const double lon){
+  return static_cast<int64_t>(std::floor((lon-h.min_lon)/h.cell_deg));
+}
+
+}
+
+
+
+void GraphSnapshot::save(
+  const std::string &filename,
+  const uint32_t node_count,
+  const uint32_t arc_count,
+  const float    *latitude,
+  const float    *longitude,
+  const uint32_t *first_out,
+  const uint32_t *head,
+  const uint32_t *travel_time,
+  const uint32_t *geo_distance
+){
+  Header h{};
+  std::memcpy(h.magic, snapshot_magic, sizeof(h.magic));
+  h.version    = snapshot_version;
+  h.node_count = node_count;
+  h.arc_count  = arc_count;
+
+  //Size the geo index's grid to the graph's bounding box
+  double min_lat = 0, max_lat = 0, min_lon = 0, max_lon = 0;
+  if(node_count>0){
+    const auto [lat0, lat1] = std::minmax_element(latitude,  latitude+node_count);
+    const auto [lon0, lon1] = std::minmax_element(longitude, longitude+node_count);
+    min_lat = *lat0; max_lat = *lat1;
+    min_lon = *lon0; max_lon = *lon1;
+  }
+  const double lat_span = std::max(max_lat-min_lat, 1e-6);
+  const double lon_span = std::max(max_lon-min_lon, 1e-6);
+  const double cells    = std::max(1.0, node_count/nodes_per_cell);
+  h.min_lat  = min_lat;
+  h.min_lon  = min_lon;
+  h.cell_deg = std::max(std::sqrt(lat_span*lon_span/cells), std::max(lat_span, lon_span)/max_grid_dim);
+  h.grid_rows = static_cast<uint32_t>(lat_span/h.cell_deg)+1;
+  h.grid_cols = static_cast<uint32_t>(lon_span/h.cell_deg)+1;
+
+  //Bucket the nodes by cell with a counting sort
+  const auto cell_of = [&](const uint32_t n) -> size_t {
+    const auto row = std::min<int64_t>(cell_row(h, latitude[n]),  h.grid_rows-1);
+    const auto col = std::min<int64_t>(cell_col(h, longitude[n]), h.grid_cols-1);
+    return static_cast<size_t>(row)*h.grid_cols+col;
+  };
+  std::vector<uint32_t> cell_first(static_cast<size_t>(h.grid_rows)*h.grid_cols+1, 0);
+  for(uint32_t n=0;n<node_count;n++)
+    cell_first[cell_of(n)+1]++;
+  for(size_t c=1;c<cell_first.size();c++)
+    cell_first[c] += cell_first[c-1];
+  std::vector<uint32_t> cell_node(node_count);
+  std::vector<uint32_t> fill(cell_first.begin(), cell_first.end()-1);
+  for(uint32_t n=0;n<node_count;n++)
+    cell_node[fill[cell_of(n)]++] = n;
+
+  //Write everything out
+  std::ofstream fout(filename, std::ios::binary);
+  if(!fout.good())
+    throw std::runtime_error("Could not open '"+filename+"' for writing!");
+
+  const Layout layout(h);
+  size_t pos = 0;
+  const auto write_at = [&](const size_t offset, const void *data, const size_t bytes){
+    static const char zeros[8] = {};
+    fout.write(zeros, offset-pos);
+    fout.write(static_cast<const char*>(data), bytes);
+    pos = offset+bytes;
+  };
+  write_at(0,                   &h,                  sizeof(h));
+  write_at(layout.latitude,     latitude,            node_count*sizeof(float));
+  write_at(layout.longitude,    longitude,           node_count*sizeof(float));
+  write_at(layout.first_out,    first_out,           (node_count+1)*sizeof(uint32_t));
+  write_at(layout.head,         head,                arc_count*sizeof(uint32_t));
+  write_at(layout.travel_time,  travel_time,         arc_count*sizeof(uint32_t));
+  write_at(layout.geo_distance, geo_distance,        arc_count*sizeof(uint32_t));
+  write_at(layout.cell_first,   cell_first.data(),   cell_first.size()*sizeof(uint32_t));
+  write_at(layout.cell_node,    cell_node.data(),    cell_node.size()*sizeof(uint32_t));
+  write_at(layout.total,        nullptr,             0);
+
+  if(!fout.good())
+    throw std::runtime_error("Failed while writing graph snapshot '"+filename+"'!");
+}
+
+
+
+GraphSnapshot::GraphSnapshot(const std::string &filename){
+  const int fd = open(filename.c_str(), O_RDONLY);
+  if(fd==-1)
+    throw std::runtime_error("Could not open graph snapshot '"+filename+"': "+std::strerror(errno));
+
+  struct stat st;
+  if(fstat(fd, &st)==-1){
+    close(fd);
+    throw std::runtime_error("Could not stat graph snapshot '"+filename+"': "+std::strerror(errno));
+  }
+  map_size = st.st_size;
+
+  map_addr = mmap(nullptr, map_size, PROT_READ, MAP_SHARED, fd, 0);
+  close(fd);
+  if(map_addr==MAP_FAILED){
+    map_addr = nullptr;
+    throw std::runtime_error("Could not map graph snapshot '"+filename+"': "+std::strerror(errno));
+  }
+
+  //The destructor doesn't run if we throw from here, so clean up ourselves
+  const auto fail = [&](const std::string &why){
+    munmap(map_addr, map_size);
+    map_addr = nullptr;
+    throw std::runtime_error("Bad graph snapshot '"+filename+"': "+why);
+  };
+
+  header = static_cast<const Header*>(map_addr);
+  if(map_size<sizeof(Header) || std::memcmp(header->magic, snapshot_magic, sizeof(header->magic))!=0)
+    fail("not a graph snapshot");
+  if(header->version!=snapshot_version)
+    fail("unsupported version "+std::to_string(header->version));
+
+  const Layout layout(*header);
+  if(layout.total!=map_size)
+    fail("file is "+std::to_string(map_size)+" bytes but should be "+std::to_string(layout.total));
+
+  const auto base = static_cast<const char*>(map_addr);
+  latitude     = reinterpret_cast<const float*>   (base+layout.latitude);
+  longitude    = reinterpret_cast<const float*>   (base+layout.longitude);
+  first_out    = reinterpret_cast<const uint32_t*>(base+layout.first_out);
+  head         = reinterpret_cast<const uint32_t*>(base+layout.head);
+  travel_time  = reinterpret_cast<const uint32_t*>(base+layout.travel_time);
+  geo_distance = reinterpret_cast<const uint32_t*>(base+layout.geo_distance);
+  cell_first   = reinterpret_cast<const uint32_t*>(base+layout.cell_first);
+  cell_node    = reinterpret_cast<const uint32_t*>(base+layout.cell_node);
+}
+
+
+
+GraphSnapshot::~GraphSnapshot(){
+  if(map_addr!=nullptr)
+    munmap(map_addr, map_size);
+}
+
+
+
+uint32_t GraphSnapshot::find_nearest_node(const double lat, const double lon, const double radius_m) const {
+  const auto &h = *header;
+
+  //Degrees spanned by the search radius. We use lower bounds on the length of
+  //a degree so that the box of cells always covers the search circle.
+  const double dlat        = radius_m/110'574.0;
+  const double max_abs_lat = std::min(89.9, std::abs(lat)+dlat);
+  const double dlon        = radius_m/(111'320.0*std::cos(max_abs_lat*deg_to_rad));
+
+  const auto row0 = std::max<int64_t>(cell_row(h, lat-dlat), 0);
+  const auto row1 = std::min<int64_t>(cell_row(h, lat+dlat), h.grid_rows-1);
+  const auto col0 = std::max<int64_t>(cell_col(h, lon-dlon), 0);
+  const auto col1 = std::min<int64_t>(cell_col(h, lon+dlon), h.grid_cols-1);
+
+  uint32_t best      = rk::invalid_id;
+  double   best_dist = radius_m;
+  for(auto row=row0;row<=row1;row++)
+  for(auto col=col0;col<=col1;col++){
+    const auto cell = static_cast<size_t>(row)*h.grid_cols+col;
+    for(auto i=cell_first[cell];i<cell_first[cell+1];i++){
+      const auto n = cell_node[i];
+      const auto d = rk::geo_dist(lat, lon, latitude[n], longitude[n]);
+      if(d<best_dist || (d==best_dist && (best==rk::invalid_id || n<best))){
+        best      = n;
+        best_dist = d;
+      }
+    }
+  }
+
+  return best;
+}
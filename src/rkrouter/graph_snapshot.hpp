@@ -0,0 +1,76 @@
+#pragma once
+
+#include <cstddef>
+#include <cstdint>
+#include <string>
+
+///A compact binary snapshot of a routing graph plus a geo index over its nodes.
+///
+///The file is memory-mapped read-only, so opening it costs milliseconds
+///regardless of the graph's size and several processes opening the same file
+///share its pages.
+///
+///File layout (native endianness, every array starts on an 8-byte boundary):
+///   Header
+///   float    latitude[node_count]
+///   float    longitude[node_count]
+///   uint32_t first_out[node_count+1]
+///   uint32_t head[arc_count]
+///   uint32_t travel_time[arc_count]         //Milliseconds
+///   uint32_t geo_distance[arc_count]        //Meters
+///   uint32_t cell_first[grid_rows*grid_cols+1]
+///   uint32_t cell_node[node_count]          //Node ids bucketed by grid cell
+class GraphSnapshot {
+ public:
+  struct Header {
+    char     magic[8];
+    uint32_t version;
+    uint32_t node_count;
+    uint32_t arc_count;
+    uint32_t grid_rows;
+    uint32_t grid_cols;
+    uint32_t reserved;
+    double   min_lat;
+    double   min_lon;
+    double   cell_deg;   //Width and height of a geo index cell in degrees
+  };
+
+  GraphSnapshot(const std::string &filename);
+  ~GraphSnapshot();
+  GraphSnapshot(const GraphSnapshot &) = delete;
+  GraphSnapshot& operator=(const GraphSnapshot &) = delete;
+
+  ///Write a snapshot of the given graph to `filename`
+  static void save(
+    const std::string &filename,
+    const uint32_t node_count,
+    const uint32_t arc_count,
+    const float    *latitude,
+    const float    *longitude,
+    const uint32_t *first_out,
+    const uint32_t *head,
+    const uint32_t *travel_time,
+    const uint32_t *geo_distance
+  );
+
+  uint32_t node_count() const { return header->node_count; }
+  uint32_t arc_count()  const { return header->arc_count;  }
+
+  const float    *latitude;
+  const float    *longitude;
+  const uint32_t *first_out;
+  const uint32_t *head;
+  const uint32_t *travel_time;
+  const uint32_t *geo_distance;
+
+  ///Returns the id of the nearest node within `radius_m` meters of the given
+  ///point or RoutingKit::invalid_id if there is no such node
+  uint32_t find_nearest_node(const double lat, const double lon, const double radius_m) const;
+
+ private:
+  void  *map_addr = nullptr;
+  size_t map_size = 0;
+  const Header   *header;
+  const uint32_t *cell_first;
+  const uint32_t *cell_node;
+};
@@ -2,10 +2,13 @@
 #include <routingkit/contraction_hierarchy.h>
 #include <routingkit/geo_position_to_node.h>
 #include <routingkit/inverse_vector.h>
+#include <algorithm>
+#include <cmath>
 #include <limits>
 #include <stdexcept>
 #include <string>
 #include <utility>
+#include <vector>
 
 #include "routingkit.hpp"
 
@@ -44,14 +47,80 @@ Router::Router(const std::string &pbf_filename, const std::string &ch_filename){
 
 
 
+Router Router::from_snapshot(const std::string &snapshot_filename){
+  Router router;
+  router.snapshot = std::make_unique<GraphSnapshot>(snapshot_filename);
+  const auto &snap = *router.snapshot;
+
+  // Build the shortest path index
+  const std::vector<unsigned> first_out(snap.first_out, snap.first_out+snap.node_count()+1);
+  router.ch = rk::ContractionHierarchy::build(
+    snap.node_count(),
+    rk::invert_inverse_vector(first_out),
+    std::vector<unsigned>(snap.head,        snap.head+snap.arc_count()),
+    std::vector<unsigned>(snap.travel_time, snap.travel_time+snap.arc_count())
+  );
+
+  return router;
+}
+
+
+
+Router Router::from_snapshot(const std::string &snapshot_filename, const std::string &ch_filename){
+  Router router;
+  router.snapshot = std::make_unique<GraphSnapshot>(snapshot_filename);
+
+  // Load the shortest path index
+  router.ch = rk::ContractionHierarchy::load_file(ch_filename);
+  if(router.ch.node_count()!=router.snapshot->node_count())
+    throw std::runtime_error("Contraction hierarchy '"+ch_filename+"' does not match graph snapshot '"+snapshot_filename+"'!");
+
+  return router;
+}
+
+
+
 void Router::save_ch(const std::string &filename) {
   ch.save_file(filename);
 }
 
 
 
+void Router::save_snapshot(const std::string &filename) const {
+  if(snapshot){
+    const auto &snap = *snapshot;
+    GraphSnapshot::save(
+      filename, snap.node_count(), snap.arc_count(),
+      snap.latitude, snap.longitude,
+      snap.first_out, snap.head, snap.travel_time, snap.geo_distance
+    );
+  } else {
+    GraphSnapshot::save(
+      filename, graph.node_count(), graph.arc_count(),
+      graph.latitude.data(), graph.longitude.data(),
+      graph.first_out.data(), graph.head.data(), graph.travel_time.data(), graph.geo_distance.data()
+    );
+  }
+}
+
+
+
+unsigned Router::arcGeoDistance(const unsigned arc) const {
+  return snapshot ? snapshot->geo_distance[arc] : graph.geo_distance[arc];
+}
+
+
+
+unsigned Router::findNearestNode(const double lat, const double lon, const int search_radius_m) const {
+  return snapshot
+    ? snapshot->find_nearest_node(lat, lon, search_radius_m)
+    : map_geo_position.find_nearest_neighbor_within_radius(lat, lon, search_radius_m).id;
+}
+
+
+
 unsigned Router::getNearestNode(const double lat, const double lon, const int search_radius_m) const {
-  const auto id = map_geo_position.find_nearest_neighbor_within_radius(lat, lon, search_radius_m).id;
+  const auto id = findNearestNode(lat, lon, search_radius_m);
   if(id==rk::invalid_id)
     throw std::runtime_error("No node near: "+std::to_string(lat)+","+std::to_string(lon));
   return id;
@@ -59,6 +128,19 @@ unsigned Router::getNearestNode(const double lat, const double lon, const int se
 
 
 
+std::vector<unsigned> Router::getNearestNodes(const std::vector<double> &lat, const std::vector<double> &lon, const int search_radius_m) const {
+  if(lat.size()!=lon.size())
+    throw std::runtime_error("Latitude and longitude vectors must be the same length!");
+
+  std::vector<unsigned> nodes(lat.size());
+  #pragma omp parallel for
+  for(size_t i=0;i<lat.size();i++)
+    nodes[i] = findNearestNode(lat[i], lon[i], search_radius_m);
+  return nodes;
+}
+
+
+
 ///Returns <travel time (s), travel distance (m)>
 std::pair<double,double> Router::getTravelTime(const double from_lat, const double from_lon, const double to_lat, const double to_lon, const int search_radius_m) const {
   unsigned from;
@@ -84,7 +166,157 @@ std::pair<double,double> Router::getTravelTime(const double from_lat, const doub
 
   double distance = 0;
   for(const auto &x: ch_query.get_arc_path())
-    distance += graph.geo_distance[x];
+    distance += arcGeoDistance(x);
 
   return {travel_time, distance};
 }
+
+
+
+
+ClosestTargets Router::getClosestTargets(
+  const std::vector<double> &source_lat,
+  const std::vector<double> &source_lon,
+  const std::vector<double> &target_lat,
+  const std::vector<double> &target_lon,
+  const int search_radius_m
+) const {
+  // The matrix measures the route to each source's closest target, so the
+  // closest target is just the argmin of its row. Ties go to the lowest target
+  // index, as they do in the matrix.
+  const auto matrix = getTravelMatrix(source_lat, source_lon, target_lat, target_lon, search_radius_m);
+
+  ClosestTargets closest(matrix.rows);
+  for(size_t si=0;si<matrix.rows;si++){
+    const auto row = matrix.travel_time.begin()+si*matrix.cols;
+    int64_t best = -1;
+    for(size_t ti=0;ti<matrix.cols;ti++){
+      if(!std::isnan(row[ti]) && (best==-1 || row[ti]<row[best]))
+        best = ti;
+    }
+    if(best==-1)
+      continue;
+    closest.target[si]      = best;
+    closest.travel_time[si] = row[best];
+    closest.distance[si]    = matrix.distance[si*matrix.cols+best];
+  }
+
+  return closest;
+}
+
+
+
+
+TravelMatrix Router::getTravelMatrix(
+  const std::vector<double> &source_lat,
+  const std::vector<double> &source_lon,
+  const std::vector<double> &target_lat,
+  const std::vector<double> &target_lon,
+  const int search_radius_m
+) const {
+  const auto sources      = getNearestNodes(source_lat, source_lon, search_radius_m);
+  const auto target_nodes = getNearestNodes(target_lat, target_lon, search_radius_m);
+
+  // Pin each distinct reachable target node once. `pinned[ti]` is the position
+  // of target ti's node among the pinned nodes.
+  constexpr auto not_pinned = std::numeric_limits<size_t>::max();
+  std::vector<unsigned> targets;
+  std::vector<size_t>   pinned(target_nodes.size(), not_pinned);
+  for(size_t ti=0;ti<target_nodes.size();ti++){
+    const auto node = target_nodes[ti];
+    if(node==rk::invalid_id)
+      continue;
+    pinned[ti] = std::find(targets.begin(), targets.end(), node)-targets.begin();
+    if(pinned[ti]==targets.size())
+      targets.push_back(node);
+  }
+
+  TravelMatrix matrix(sources.size(), target_nodes.size());
+  if(targets.empty())
+    return matrix;
+
+  #pragma omp parallel
+  {
+    // Query objects are reused by each thread. `to_targets` keeps the targets
+    // pinned between sources; `path` recovers the route to the closest target
+    // so we can measure its length.
+    rk::ContractionHierarchyQuery to_targets(ch);
+    to_targets.reset().pin_targets(targets);
+    rk::ContractionHierarchyQuery path(ch);
+
+    #pragma omp for schedule(dynamic, 16)
+    for(size_t si=0;si<sources.size();si++){
+      if(sources[si]==rk::invalid_id)
+        continue;
+
+      to_targets.reset_source().add_source(sources[si]).run_to_pinned_targets();
+      const auto times = to_targets.get_distances_to_targets();
+
+      // Ties go to the lowest target index
+      const auto row = matrix.travel_time.begin()+si*matrix.cols;
+      size_t best = not_pinned;
+      for(size_t ti=0;ti<matrix.cols;ti++){
+        if(pinned[ti]==not_pinned || times[pinned[ti]]==rk::inf_weight)
+          continue;
+        row[ti] = times[pinned[ti]]/1000.0;
+        if(best==not_pinned || row[ti]<row[best])
+          best = ti;
+      }
+      if(best==not_pinned)
+        continue;
+
+      path.reset().add_source(sources[si]).add_target(targets[pinned[best]]).run();
+      double distance = 0;
+      for(const auto &x: path.get_arc_path())
+        distance += arcGeoDistance(x);
+
+      // Targets which snapped to the same node share the route
+      for(size_t ti=0;ti<matrix.cols;ti++){
+        if(pinned[ti]==pinned[best])
+          matrix.distance[si*matrix.cols+ti] = distance;
+      }
+    }
+  }
+
+  return matrix;
+}
+
+
+
+std::vector<double> Router::getPathDistances(
+  const std::vector<double> &source_lat,
+  const std::vector<double> &source_lon,
+  const std::vector<double> &target_lat,
+  const std::vector<double> &target_lon,
+  const int search_radius_m
+) const {
+  if(source_lat.size()!=target_lat.size())
+    throw std::runtime_error("There must be as many sources as targets!");
+
+  const auto sources = getNearestNodes(source_lat, source_lon, search_radius_m);
+  const auto targets = getNearestNodes(target_lat, target_lon, search_radius_m);
+
+  std::vector<double> distances(sources.size(), std::numeric_limits<double>::quiet_NaN());
+
+  #pragma omp parallel
+  {
+    rk::ContractionHierarchyQuery path(ch);
+
+    #pragma omp for schedule(dynamic, 16)
+    for(size_t i=0;i<sources.size();i++){
+      if(sources[i]==rk::invalid_id || targets[i]==rk::invalid_id)
+        continue;
+
+      path.reset().add_source(sources[i]).add_target(targets[i]).run();
+      if(path.get_distance()==rk::inf_weight)
+        continue;
+
+      double distance = 0;
+      for(const auto &x: path.get_arc_path())
+        distance += arcGeoDistance(x);
+      distances[i] = distance;
+    }
+  }
+
+  return distances;
+}
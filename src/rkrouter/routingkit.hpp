@@ -1,26 +1,113 @@
 #pragma once
 
+#include <cstdint>
+#include <limits>
+#include <memory>
+#include <string>
 #include <utility>
+#include <vector>
 
 #include <routingkit/osm_simple.h>
 #include <routingkit/contraction_hierarchy.h>
 #include <routingkit/geo_position_to_node.h>
 
+#include "graph_snapshot.hpp"
+
+//For each source: the index of the target with the shortest travel time, or
+//-1 if no target can be reached, along with that travel time and distance
+struct ClosestTargets {
+  std::vector<int64_t> target;
+  std::vector<double>  travel_time;   //s
+  std::vector<double>  distance;      //m
+  ClosestTargets(const size_t N) : target(N, -1), travel_time(N, std::numeric_limits<double>::quiet_NaN()), distance(N, std::numeric_limits<double>::quiet_NaN()) {}
+};
+
+
+
+//Travel times (s) from every source to every target, stored row-major by
+//source. NaN where there is no route. Distances (m) are only measured to each
+//source's closest target and are NaN elsewhere.
+struct TravelMatrix {
+  size_t rows;
+  size_t cols;
+  std::vector<double> travel_time;
+  std::vector<double> distance;
+  TravelMatrix(const size_t rows, const size_t cols) : rows(rows), cols(cols), travel_time(rows*cols, std::numeric_limits<double>::quiet_NaN()), distance(rows*cols, std::numeric_limits<double>::quiet_NaN()) {}
+};
+
+
+
 class Router {
  private:
   RoutingKit::ContractionHierarchy ch;
   RoutingKit::GeoPositionToNode map_geo_position;
   RoutingKit::SimpleOSMCarRoutingGraph graph;
+  //If set, the graph and geo index live here and `graph`/`map_geo_position`
+  //are empty
+  std::unique_ptr<GraphSnapshot> snapshot;
+
+  Router() = default;
+
+  //Geographic length (m) of an arc of the graph
+  unsigned arcGeoDistance(const unsigned arc) const;
+
+  //Nearest node to a lat,lon point or RoutingKit::invalid_id if there is none
+  unsigned findNearestNode(const double lat, const double lon, const int search_radius_m) const;
 
  public:
   Router(const std::string &pbf_filename);
   Router(const std::string &pbf_filename, const std::string &ch_filename);
 
+  //Load a router from a graph snapshot (see `save_snapshot`), building the
+  //contraction hierarchy or loading it from `ch_filename`. Neither needs the
+  //PBF.
+  static Router from_snapshot(const std::string &snapshot_filename);
+  static Router from_snapshot(const std::string &snapshot_filename, const std::string &ch_filename);
+
   void save_ch(const std::string &filename);
 
+  //Save the routing graph and geo index as a memory-mappable snapshot
+  void save_snapshot(const std::string &filename) const;
+
   //Return the id of the nearest node to a lat,lon point
   unsigned getNearestNode(const double lat, const double lon, const int search_radius_m) const;
 
+  //Return the id of the nearest node to each lat,lon point, or
+  //RoutingKit::invalid_id for points with no node within the search radius
+  std::vector<unsigned> getNearestNodes(const std::vector<double> &lat, const std::vector<double> &lon, const int search_radius_m) const;
+
   //Returns <travel time (s), travel distance (m)>
   std::pair<double,double> getTravelTime(const double from_lat, const double from_lon, const double to_lat, const double to_lon, const int search_radius_m) const;
+
+  //For each source point find the target point with the shortest travel time:
+  //the argmin of each row of `getTravelMatrix()`.
+  ClosestTargets getClosestTargets(
+    const std::vector<double> &source_lat,
+    const std::vector<double> &source_lon,
+    const std::vector<double> &target_lat,
+    const std::vector<double> &target_lon,
+    const int search_radius_m
+  ) const;
+
+  //Travel time between every source and every target point, and the distance
+  //to each source's closest target. Every point is snapped to the road network
+  //once and travel times come from one-to-many queries with the targets
+  //pinned, so only one route per source is recovered.
+  TravelMatrix getTravelMatrix(
+    const std::vector<double> &source_lat,
+    const std::vector<double> &source_lon,
+    const std::vector<double> &target_lat,
+    const std::vector<double> &target_lon,
+    const int search_radius_m
+  ) const;
+
+  //Route distance (m) from source i to target i for each i. NaN where there is
+  //no route.
+  std::vector<double> getPathDistances(
+    const std::vector<double> &source_lat,
+    const std::vector<double> &source_lon,
+    const std::vector<double> &target_lat,
+    const std::vector<double> &target_lon,
+    const int search_radius_m
+  ) const;
 };
@@ -1,11 +1,22 @@
+import argparse
 import csv
+import hashlib
+import json
 import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 import numpy as np
 import pandas as pd
+import yaml
 from itertools import product
 
-from sim import simulate as sim
+import caching
+import parse_gtfs
+from sim import FleetCost, LoadInputs, RunScenario, generateParams
+
+#Parsed GTFS tables read by `sim.LoadInputs()`
+SIMULATED_TABLES = ['trips', 'stops']
 
 #TODO add charger_density once supported in sim.py
 #TODO include support for depot_chargers. Not sure the best way to scale this
@@ -24,7 +35,20 @@ def genScenarios(battery_cap_kwh,nondepot_charger_rate):
     scens = dict(zip(keys, scens))
     return scens
 
-#TODO move to np_financial or otherwise to implement PMT()
+def Pmt(rate, nper, pv):
+  """Payment per period of a loan of `pv` over `nper` periods at `rate` per
+  period, as a negative number. Equivalent to the `pmt()` that was removed from
+  NumPy (with no future value and payments at the end of each period) and
+  vectorized in the same way.
+  """
+  rate = np.asarray(rate, dtype=float)
+  nper = np.asarray(nper, dtype=float)
+  pv   = np.asarray(pv,   dtype=float)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    growth = (1 + rate)**nper
+    pmt    = -pv * growth * rate / (growth - 1)
+  return np.where(rate==0, -pv / nper, pmt)[()]
+
 def genAnnualizedCosts(bat_range,non_depot_range,rate,years,bus_base_price,
                        bprice_kwh,cprice_bos=265,cprice_scaled=511,
                        bos_coeff=0.8,scaled_coeff=0.2
@@ -66,10 +90,10 @@ def genAnnualizedCosts(bat_range,non_depot_range,rate,years,bus_base_price,
   charger_pv_bos    = non_depot_range * cprice_bos
   charger_pv_scaled = non_depot_range * cprice_scaled
 
-  annualized_base_bus        = -np.pmt(rate,years,bus_base_price)
-  annualized_bat             = -np.pmt(rate,years / 2,bat_pv) * 2# assumes a mid-life battery replacement.
-  annualized_charge_bos      = -np.pmt(rate,years,charger_pv_bos)
-  annualized_charge_scaled   = -np.pmt(rate,years,charger_pv_scaled)
+  annualized_base_bus        = -Pmt(rate,years,bus_base_price)
+  annualized_bat             = -Pmt(rate,years / 2,bat_pv) * 2# assumes a mid-life battery replacement.
+  annualized_charge_bos      = -Pmt(rate,years,charger_pv_bos)
+  annualized_charge_scaled   = -Pmt(rate,years,charger_pv_scaled)
 
   anl_charge_weighted = (annualized_base_bus * bos_coeff) + (annualized_charge_scaled * scaled_coeff) 
   results = {'annualized_base_bus':annualized_base_bus,
@@ -78,10 +102,113 @@ def genAnnualizedCosts(bat_range,non_depot_range,rate,years,bus_base_price,
             }
   return results
 
+def WriteScenarioOutputs(output_dir, prefix, results):
+  """Writes the optimized trips, depot bus counts, depot peak times and depot
+  occupancy over time of one scenario."""
+  results['opti_trips'].to_csv(f'{output_dir}/{prefix}_trips.csv')
+  results['opti_depot_peaks'].to_csv(f'{output_dir}/{prefix}_depot_peaks.csv', index=False)
+  results['opti_depot_occupancy'].to_csv(f'{output_dir}/{prefix}_depot_occupancy.csv', index=False)
+
+  depot_res_name = f'{output_dir}/{prefix}_depot_counts.csv'
+  with open(depot_res_name,'w',newline='') as csvfile:
+    fieldnames = ['depot','bus_count']
+    writer = csv.DictWriter(csvfile,fieldnames=fieldnames)
+    writer.writeheader()
+    #TODO include nc and ac depots as well
+    for key, val in results['opti_depot_counts'].items():
+      writer.writerow({'depot': key, 'bus_count': val})
+
+def SummarizeScenario(bat_cap, cpower, results):
+  """Returns the row of the summary table for one scenario."""
+  return {'battery_cap_kwh':bat_cap,
+          'nondepot_charger_rate':cpower,
+          'optimized_buses':results['opti_buses'],
+          'optimized_chargers':results['opti_chargers'],
+          'optimized_cost':results['opti_cost'],
+          'optimized_depots':results['opti_depots'],
+          'nc_buses':results['nc_buses'],
+          'nc_chargers':results['nc_chargers'],
+          'nc_cost':results['nc_cost'],
+          'nc_depots':results['nc_depots'],
+          'ac_buses':results['ac_buses'],
+          'ac_chargers':results['ac_chargers'],
+          'ac_costs':results['ac_cost'],
+          'ac_depots':results['ac_depots']
+         }
+
+def _JsonDefault(x):
+  """Lets `json` serialize NumPy scalars and arrays."""
+  if isinstance(x, np.generic):
+    return x.item()
+  if isinstance(x, np.ndarray):
+    return x.tolist()
+  raise TypeError(f"Can't serialize {type(x)}")
+
+def InputHashes(parsed_gtfs_prefix, osm_data, depots_filename):
+  """Returns the sha256 of the contents of a sweep's input files, so that
+  stored results aren't reused once an input has been regenerated or edited
+  in place.
+
+  Only the parsed tables the simulation reads are included. Their hashes are
+  taken from the manifest `parse_gtfs.py` wrote wherever the files' sizes and
+  mtimes show they haven't changed since, so they are usually not reread.
+
+  Args:
+    parsed_gtfs_prefix (str): Prefix of the files generated by parse_gtfs.py
+    osm_data (str):           OSM pbf file
+    depots_filename (str):    CSV file of depots
+  """
+  files = parse_gtfs.ParsedFiles(parsed_gtfs_prefix, tables=SIMULATED_TABLES)
+  if not files: #Older outputs only have CSVs
+    files = parse_gtfs.ParsedFiles(parsed_gtfs_prefix, with_csv=True, tables=SIMULATED_TABLES)
+  if not files:
+    raise Exception(f"No parsed GTFS tables found for '{parsed_gtfs_prefix}'!")
+
+  manifest = parse_gtfs.ReadManifest(parsed_gtfs_prefix) or {}
+  recorded = manifest.get('outputs', {})
+  stats    = manifest.get('output_stats', {})
+  parsed   = {}
+  for rel, filename in files.items():
+    if rel in recorded and caching.FileUnchanged(filename, recorded[rel], stats.get(rel)):
+      parsed[rel] = recorded[rel]
+    else:
+      parsed[rel] = caching.FileHash(filename)
+  return {'parsed_gtfs':parsed, 'osm_data':caching.FileHash(osm_data),
+          'depots':caching.FileHash(depots_filename)}
+
+def ScenarioKey(inputs, scen_params):
+  """Returns the key under which a scenario's results are stored: a hash of
+  its inputs and its full parameter set.
+
+  Args:
+    inputs (dict):      The input files of the sweep and their hashes
+    scen_params (dict): Every parameter passed to `sim.generateParams()`
+  """
+  blob = json.dumps({'inputs':inputs, 'params':scen_params}, sort_keys=True,
+                    default=_JsonDefault)
+  return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+def LoadScenarioRecord(store_dir, key):
+  """Returns the stored record of a finished scenario, or None if there is
+  none."""
+  filename = os.path.join(store_dir, f'{key}.json')
+  if not os.path.exists(filename):
+    return None
+  with open(filename,'r') as f:
+    return json.load(f)
+
+def SaveScenarioRecord(store_dir, key, record):
+  """Stores the record of a finished scenario. The record is written
+  atomically, so an interrupted sweep never leaves a partial one behind."""
+  with caching.AtomicWrite(os.path.join(store_dir, f'{key}.json')) as temp_filename:
+    with open(temp_filename,'w') as f:
+      json.dump(record, f, indent=2, default=_JsonDefault)
+
 def main(parsed_gtfs_prefix,osm_data,depots_filename,output_dir,battery_cap_kwh,
-         nondepot_charger_rate,parameter_override=None
+         nondepot_charger_rate,parameter_override=None,cache_dir=None,workers=1,
+         resume=False,warm_start=True
         ):
-  """Runs Dispatch simulator with the given scenarios, in series.
+  """Runs Dispatch simulator with the given scenarios, `workers` at a time.
 
   Parameters
   ----------
@@ -112,6 +239,25 @@ def main(parsed_gtfs_prefix,osm_data,depots_filename,output_dir,battery_cap_kwh,
   parameter_override : dict
     dict that overrides any Dispatch parameter defaults. See
     `sim.generateParams()` for details on possible inputs.
+  cache_dir : str
+    where to cache routing data between scenarios and runs. See
+    `sim.GetRouter()` for details.
+  workers : int
+    how many scenarios to run at once. The router, depot matrix and trip
+    tables are loaded once and shared by all of them; each worker thread keeps
+    one `dispatch.ModelInfo` and only changes its parameters. Each scenario's
+    optimizer is itself multithreaded, so with several workers consider
+    lowering OMP_NUM_THREADS.
+  resume : bool
+    skip scenarios whose results are already in the results store. Every
+    finished scenario is recorded in `output_dir/scenario_store/`, keyed by a
+    hash of the contents of its inputs and its full parameter set, so an
+    interrupted sweep can be picked up where it stopped and a widened grid only
+    runs its new points.
+  warm_start : bool
+    seed each scenario's optimizer with the best charger layout of the nearest
+    finished scenario. With more than one worker which scenarios have finished
+    depends on timing, so results may differ from run to run.
 
   Returns
   -------
@@ -129,56 +275,223 @@ def main(parsed_gtfs_prefix,osm_data,depots_filename,output_dir,battery_cap_kwh,
   # It may be best to just move all this out of CLI and into params exclusively?
   if parameter_override is not None:
     params = parameter_override
-  scen_costs = {}
-  for key,val in scenarios.items():
-    bat_cap = val[0]
-    cpower = val[1]
+
+  #create output dir and results store if needed
+  store_dir = os.path.join(output_dir, 'scenario_store')
+  os.makedirs(store_dir, exist_ok=True)
+  sweep_inputs = {'parsed_gtfs_prefix':parsed_gtfs_prefix, 'osm_data':osm_data,
+                  'depots_filename':depots_filename,
+                  'hashes':InputHashes(parsed_gtfs_prefix, osm_data, depots_filename)}
+
+  #Work out every scenario's parameters and which still need to be run
+  keys = {}
+  records = {}
+  pending = []
+  for bat_cap, cpower in scenarios.values():
     prefix = f'{bat_cap}kwh_{cpower}_kw'
     #set up scenario parameters
-    params['battery_cap_kwh'] = bat_cap
-    params['nondepot_charger_rate'] = cpower
-    params['bus_cost'] = an_costs['annualized_base_bus']
-    params['battery_cost_per_kwh'] = an_costs['annualized_bat'][bat_cap]
-    params['nondepot_charger_cost'] = an_costs['annualized_charger'][cpower]
-
-    results = sim(parsed_gtfs_prefix, 
-                  osm_data,
-                  depots_filename,
-                  parameters=params)
-    # parse results and write to file
-    scen_costs[prefix] = {'battery_cap_kwh':bat_cap,
-                          'nondepot_charger_rate':cpower,
-                          'optimized_buses':results['opti_buses'],
-                          'optimized_chargers':results['opti_chargers'],
-                          'optimized_cost':results['opti_cost'],
-                          'nc_buses':results['nc_buses'],
-                          'nc_chargers':results['nc_chargers'],
-                          'nc_cost':results['nc_cost'],
-                          'ac_buses':results['ac_buses'],
-                          'ac_chargers':results['ac_chargers'],
-                          'ac_costs':results['ac_cost']
-                         }
-    #create output dir if needed, and write to file
-    if not os.path.exists(output_dir):
-      os.mkdir(output_dir)
-    results['opti_trips'].to_csv(f'{output_dir}/{prefix}_trips.csv')
-
-    depot_res_name = f'{output_dir}/{prefix}_depot_counts.csv'
-    with open(depot_res_name,'w',newline='') as csvfile:
-      fieldnames = ['depot','bus_count']
-      writer = csv.DictWriter(csvfile,fieldnames=fieldnames)
-      writer.writeheader()
-      #TODO include nc and ac depots as well
-      for key, val in results['opti_depot_counts'].items():
-        writer.writerow({'depot': key, 'bus_count': val})
-    #create DF of summary results and write to file
-  scen_costs = pd.DataFrame(scen_costs).T
-  scen_costs.to_csv(f'{output_dir}/scenarios_results.csv')
+    scen_params = dict(params)
+    scen_params['battery_cap_kwh'] = bat_cap
+    scen_params['nondepot_charger_rate'] = cpower
+    scen_params['bus_cost'] = an_costs['annualized_base_bus']
+    scen_params['battery_cost_per_kwh'] = an_costs['annualized_bat'][bat_cap]
+    scen_params['nondepot_charger_cost'] = an_costs['annualized_charger'][cpower]
+    keys[prefix] = ScenarioKey(sweep_inputs, scen_params)
+    record = LoadScenarioRecord(store_dir, keys[prefix]) if resume else None
+    if record is not None:
+      records[prefix] = record
+    else:
+      pending.append((prefix, bat_cap, cpower, scen_params))
+  print(f'{len(records)} scenarios already done, {len(pending)} to run')
+
+  def write_summary():
+    #create DF of summary results so far and write to file
+    scen_costs = pd.DataFrame({p:records[p]['summary'] for p in keys if p in records}).T
+    with caching.AtomicWrite(f'{output_dir}/scenarios_results.csv') as temp_filename:
+      scen_costs.to_csv(temp_filename)
+    return scen_costs
+
+  if not pending:
+    return write_summary()
+
+  inputs = LoadInputs(parsed_gtfs_prefix, osm_data, depots_filename,
+                      cache_dir=cache_dir)
+
+  #Each worker thread builds its model once and reuses it for every scenario
+  #it runs
+  thread_state = threading.local()
+
+  def run(scen_params, seeds):
+    model_info = getattr(thread_state, 'model_info', None)
+    results = RunScenario(inputs, generateParams(**scen_params), model_info=model_info,
+                          seeds=seeds)
+    if model_info is None:
+      thread_state.model_info = results['model_info']
+    return results
+
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    #Scenarios are submitted as workers free up so that each can be seeded
+    #with the results of those finished before it
+    futures = {}
+    to_submit = iter(pending)
+
+    def submit_next():
+      scenario = next(to_submit, None)
+      if scenario is None:
+        return
+      prefix, bat_cap, cpower, scen_params = scenario
+      seeds = []
+      if warm_start:
+        layout = NearestLayout(records, bat_cap, cpower, battery_cap_kwh[2],
+                               nondepot_charger_rate[2])
+        if layout is not None:
+          seeds.append({stop_id:True for stop_id in layout})
+      futures[executor.submit(run, scen_params, seeds)] = scenario
+
+    for _ in range(workers):
+      submit_next()
+
+    #Record each scenario's results as soon as it finishes
+    while futures:
+      done, _ = wait(futures, return_when=FIRST_COMPLETED)
+      for future in done:
+        prefix, bat_cap, cpower, scen_params = futures.pop(future)
+        results = future.result()
+        WriteScenarioOutputs(output_dir, prefix, results)
+        records[prefix] = {'prefix':prefix,
+                           'inputs':sweep_inputs,
+                           'params':scen_params,
+                           'summary':SummarizeScenario(bat_cap, cpower, results),
+                           'layout':sorted(k for k, v in results['opti_has_charger'].items() if v)}
+        SaveScenarioRecord(store_dir, keys[prefix], records[prefix])
+        write_summary()
+        print(f'Finished scenario {prefix} ({len(records)}/{len(keys)})')
+        submit_next()
+
+  return write_summary()
+
+
+
+def NearestLayout(records, bat_cap, cpower, bat_step, cpower_step):
+  """Returns the optimized charger layout of the finished scenario nearest to
+  (`bat_cap`, `cpower`), measured in grid steps, or None if no finished
+  scenario has one. Ties go to the scenario finished first.
+  """
+  best = None
+  best_dist = np.inf
+  for record in records.values():
+    if 'layout' not in record:
+      continue
+    summary = record['summary']
+    dist = (abs(summary['battery_cap_kwh'] - bat_cap) / bat_step
+            + abs(summary['nondepot_charger_rate'] - cpower) / cpower_step)
+    if dist < best_dist:
+      best = record['layout']
+      best_dist = dist
+  return best
+
+def LoadScenarioRecords(output_dir):
+  """Returns every record in a sweep's results store."""
+  store_dir = os.path.join(output_dir, 'scenario_store')
+  records = []
+  for filename in sorted(os.listdir(store_dir)):
+    if filename.endswith('.json'):
+      with open(os.path.join(store_dir, filename),'r') as f:
+        records.append(json.load(f))
+  return records
+
+def FinanceSweep(records,rates,years,bus_base_price=500_000,bprice_kwh=100,
+                 **annualize_kwargs):
+  """Reprices finished scenarios under every combination of interest rate and
+  amortization period without re-simulating them.
+
+  Each scenario's fleet (buses, non-depot chargers and depots used) depends on
+  its battery capacity and charger rate but not on prices, so the costs of all
+  the scenarios are recomputed at once with `sim.FleetCost()`. The no-charger
+  and all-charger baselines are repriced exactly. The optimized charger layout
+  was chosen under the sweep's original prices; its repriced cost is that of
+  the same fleet, not of a layout re-optimized for the new prices.
+
+  Parameters
+  ----------
+  records : list
+    scenario records, e.g. from `LoadScenarioRecords()`
+  rates : list
+    interest rates to try
+  years : list
+    amortization periods (years) to try
+  bus_base_price, bprice_kwh, annualize_kwargs :
+    passed on to `genAnnualizedCosts()`
+
+  Returns
+  -------
+  dataframe
+    one row per scenario, rate and period with the costs of the optimized,
+    no-charger and all-charger fleets
+  """
+  summary = pd.DataFrame([r['summary'] for r in records])
+  params  = [generateParams(**r['params']) for r in records]
+  b_caps  = tuple(summary['battery_cap_kwh'])
+  cpowers = tuple(summary['nondepot_charger_rate'])
+  depot_charger_cost = np.array([float(p.depot_charger_cost) for p in params])
+  chargers_per_depot = np.array([p.chargers_per_depot for p in params])
+
+  repriced = []
+  for rate, nyears in product(rates, years):
+    an_costs = genAnnualizedCosts(b_caps,cpowers,rate=rate,years=nyears,
+                                  bus_base_price=bus_base_price,
+                                  bprice_kwh=bprice_kwh,**annualize_kwargs)
+    prices = {'battery_cap_kwh':np.array(b_caps, dtype=float),
+              'bus_cost':an_costs['annualized_base_bus'],
+              'battery_cost_per_kwh':np.array([an_costs['annualized_bat'][b] for b in b_caps]),
+              'nondepot_charger_cost':np.array([an_costs['annualized_charger'][c] for c in cpowers]),
+              'depot_charger_cost':depot_charger_cost,
+              'chargers_per_depot':chargers_per_depot}
+    df = pd.DataFrame({'prefix':[r['prefix'] for r in records],
+                       'rate':rate,
+                       'years':nyears,
+                       'battery_cap_kwh':b_caps,
+                       'nondepot_charger_rate':cpowers})
+    for name in ('optimized','nc','ac'):
+      df[f'{name}_cost'] = FleetCost(summary[f'{name}_buses'].to_numpy(),
+                                     summary[f'{name}_chargers'].to_numpy(),
+                                     summary[f'{name}_depots'].to_numpy(),
+                                     **prices)
+    repriced.append(df)
+  return pd.concat(repriced, ignore_index=True)
+
+def cli():
+  parser = argparse.ArgumentParser(description='Run Dispatch over a grid of battery capacities and non-depot charger rates.')
+  parser.add_argument('parsed_gtfs_prefix',      type=str, help='Prefix of the files generated by parse_gtfs.py')
+  parser.add_argument('osm_data',                type=str, help='OSM pbf file for the GTFS feed being simulated')
+  parser.add_argument('depots_filename',         type=str, help='CSV file of depots')
+  parser.add_argument('output_dir',              type=str, help='Where to write results')
+  parser.add_argument('--battery-cap-kwh',       type=int, nargs=3, default=[220,440,200], help='Start, end (exclusive) and step of battery capacities (kWh)')
+  parser.add_argument('--nondepot-charger-rate', type=int, nargs=3, default=[100,300,200], help='Start, end (exclusive) and step of non-depot charger rates (kW)')
+  parser.add_argument('--sim-parameters',        type=str, help='YAML file of parameters overriding the defaults of sim.generateParams()')
+  parser.add_argument('--cache-dir',             type=str, help='Where to cache routing data. Default: cache/ next to osm_data')
+  parser.add_argument('--workers',               type=int, default=1, help='Number of scenarios to run at once')
+  parser.add_argument('--resume',                action='store_true', help='Skip scenarios already in the results store')
+  parser.add_argument('--no-warm-start',         action='store_true', help="Don't seed each scenario with the best layout of the nearest finished one")
+  args = parser.parse_args()
+
+  params = None
+  if args.sim_parameters is not None:
+    with open(args.sim_parameters,'r') as f:
+      params = yaml.full_load(f)
+
+  main(args.parsed_gtfs_prefix,
+       args.osm_data,
+       args.depots_filename,
+       args.output_dir,
+       args.battery_cap_kwh,
+       args.nondepot_charger_rate,
+       parameter_override=params,
+       cache_dir=args.cache_dir,
+       workers=args.workers,
+       resume=args.resume,
+       warm_start=not args.no_warm_start)
 
+#python3 scenarios.py ../../data/parsed_actransit121 ../../data/osm_actransit121.osm.pbf ../../data/depots_actransit.csv ../../out/test --battery-cap-kwh 220 440 200 --nondepot-charger-rate 100 300 200
 if __name__ == '__main__':
-  main('../../data/parsed_actransit121',
-       '../../data/osm_actransit121.osm.pbf',
-       '../../data/depots_actransit.csv',
-       '../../out/test',
-       [220,440,200],
-       [100,300,200])
+  cli()
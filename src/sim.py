@@ -1,51 +1,263 @@
 #!/usr/bin/env python3
 
 import argparse
-import collections
+import hashlib
+import os
 import yaml
 import code #TODO
 
 import numpy as np
 import pandas as pd
 
+import caching
+import columnar
 import dispatch
 
+#Routing profile used by `dispatch.Router` (RoutingKit's simple car profile).
+#Part of the cache key so that contraction hierarchies built for different
+#profiles never collide.
+ROUTING_PROFILE = 'car'
 
+#Columns of the trips and stops tables read by `dispatch.ModelInfo`
+MODEL_TRIP_COLUMNS = ['trip_id', 'block_id', 'start_arrival_time', 'start_stop_id',
+                      'end_arrival_time', 'end_stop_id', 'distance', 'wait_time']
+MODEL_STOP_COLUMNS = ['stop_id', 'depot_id', 'depot_time', 'depot_distance']
 
-def ConvertVectorOfStructsToDataFrame(vos):
-  """Converts a vector of structures to a dataframe"""
-  #Sample the first struct to get the column names
-  column_names = [x for x in dir(vos[0]) if not x.startswith('__')]
-  data = collections.defaultdict(list)
-  for x in vos:
-    for c in column_names:
-      data[c].append(getattr(x,c))
-  return pd.DataFrame(data)
+#Columns of the parsed stops table needed to find each stop's depot
+INPUT_STOP_COLUMNS = ['stop_id', 'lat', 'lng']
 
+#Identifier columns which `dispatch.ModelInfo` takes as integers
+MODEL_ID_COLUMNS = ['block_id', 'start_stop_id', 'end_stop_id', 'stop_id']
 
 
-def GetNearestDepots(router, trips, stops, depots, search_radius_m=1000):
+
+def ReadParsedTable(input_prefix, table, columns):
+  """Reads the given columns of one of the tables written by
+  `parse_gtfs.ParseFile()`. Only those columns are read from disk. Older
+  outputs which only have a CSV are read from that instead.
+
+  Args:
+    input_prefix (str): Prefix of the files written by `parse_gtfs.py`
+    table (str):        Name of the table: 'trips', 'stops' or 'stop_times'
+    columns (list):     Columns to read
+
+  Returns: pandas.DataFrame
+  """
+  dirname = f"{input_prefix}_{table}"
+  if columnar.IsTable(dirname):
+    return columnar.ReadTable(dirname, columns)
+  return pd.read_csv(f"{dirname}.csv", usecols=columns)[columns]
+
+
+
+def NumericIds(df):
+  """Returns `df` with its `MODEL_ID_COLUMNS` converted to the numbers the model
+  identifies blocks and stops by. The parsed tables keep ids as strings.
+  """
+  df = df.copy()
+  for c in [c for c in MODEL_ID_COLUMNS if c in df.columns]:
+    try:
+      df[c] = pd.to_numeric(df[c])
+    except (ValueError, TypeError):
+      raise Exception(f"The model needs numeric ids, but '{c}' holds ids which aren't numbers!")
+  return df
+
+
+
+def TableColumns(df, columns):
+  """Returns a dict mapping each of `columns` to a NumPy array of its values.
+
+  Numeric columns are passed without copying, so `dispatch.ModelInfo` reads
+  them straight out of the DataFrame's memory.
+  """
+  return {c: df[c].to_numpy() for c in columns}
+
+
+
+def GetRouter(osm_data, cache_dir=None):
+  """Builds a `dispatch.Router`, reusing cached routing data for this OSM file
+  where possible.
+
+  Two things are cached, both keyed by the content hash of `osm_data` and the
+  routing profile so that an edited or replaced PBF never picks up stale data:
+    * the contraction hierarchy (`.ch`), saved with `Router.save_ch()`
+    * a memory-mapped snapshot of the routing graph and its geo index
+      (`.graph`), saved with `Router.save_snapshot()`
+  When both are present the router comes up without touching the PBF and
+  processes using the same cache share the snapshot's pages.
+
+  Args:
+    osm_data (str):  OSM PBF file to route over
+    cache_dir (str): Where to keep cached routing data. Default: `cache/` next
+                     to `osm_data`.
+
+  Returns: A `dispatch.Router()` object
+  """
+  cache_dir      = caching.GetCacheDir(cache_dir, osm_data)
+  key            = f"{caching.FileHash(osm_data)}_{ROUTING_PROFILE}"
+  ch_filename    = os.path.join(cache_dir, f"{key}.ch")
+  graph_filename = os.path.join(cache_dir, f"{key}.graph")
+
+  if os.path.exists(ch_filename) and os.path.exists(graph_filename):
+    print(f"Loading cached routing data {graph_filename}...")
+    return dispatch.Router.from_snapshot(graph_filename, ch_filename)
+
+  if os.path.exists(ch_filename):
+    print(f"Loading cached contraction hierarchy {ch_filename}...")
+    router = dispatch.Router(osm_data, ch_filename)
+  else:
+    print("Building contraction hierarchy...")
+    router = dispatch.Router(osm_data)
+    with caching.AtomicWrite(ch_filename) as temp_filename:
+      router.save_ch(temp_filename)
+
+  with caching.AtomicWrite(graph_filename) as temp_filename:
+    router.save_snapshot(temp_filename)
+  return router
+
+
+
+def GetDepotMatrix(router, graph_key, stop_lat, stop_lng, depots, cache_dir, search_radius_m=1000):
+  """Returns travel time (s) and distance (m) matrices from stops to depots.
+
+  Depot times and distances depend only on the road graph, the stop
+  coordinates, and the depot coordinates, so the full stop x depot matrix is
+  cached on disk keyed by the graph's hash, the search radius, and the stop
+  coordinates. Depots are matched to cached columns by their coordinates: if
+  the depots file changes only the new depots' columns are computed.
+
+  Distances are only measured to each stop's closest depot among `depots`
+  (and, when columns are computed, among those computed together); other
+  distances are NaN. A distance measured for a new closest depot is added to
+  the cache.
+
+  Args:
+    router:                A `dispatch.Router()` object
+    graph_key (str):       Identifies the road graph, e.g. the OSM file's hash
+    stop_lat (np.array):   Latitudes of the stops
+    stop_lng (np.array):   Longitudes of the stops
+    depots (DataFrame):    A DataFrame of depots with `lat` and `lng` columns
+    cache_dir (str):       Where to cache the matrix
+    search_radius_m (int): How many metres around each point we search for a
+                           road network node
+
+  Returns: (time, distance) arrays of shape (len(stops), len(depots)). NaN
+           where there is no route or the distance wasn't measured.
+  """
+  if len(depots)==0:
+    raise Exception("There are no depots!")
+  stop_lat = np.ascontiguousarray(stop_lat, dtype=np.float64)
+  stop_lng = np.ascontiguousarray(stop_lng, dtype=np.float64)
+
+  key = hashlib.sha256()
+  key.update(f"{graph_key}_{search_radius_m}".encode())
+  key.update(stop_lat.tobytes())
+  key.update(stop_lng.tobytes())
+  filename = os.path.join(cache_dir, f"depot_matrix_{key.hexdigest()}.npz")
+
+  if os.path.exists(filename):
+    with np.load(filename) as cached:
+      cached_lat, cached_lng = cached['depot_lat'], cached['depot_lng']
+      time, distance         = cached['time'],      cached['distance']
+  else:
+    cached_lat = cached_lng = np.zeros(0)
+    time = distance = np.zeros((len(stop_lat), 0))
+
+  columns = {depot: i for i, depot in enumerate(zip(cached_lat, cached_lng))}
+  wanted  = list(zip(depots['lat'].astype(float), depots['lng'].astype(float)))
+  missing = [depot for depot in dict.fromkeys(wanted) if depot not in columns]
+
+  if len(missing)>0:
+    print(f"Computing travel times to {len(missing)} new depots...")
+    new_lat, new_lng = [np.array(x, dtype=np.float64) for x in zip(*missing)]
+    new_time, new_distance = dispatch.GetTravelMatrix(router, stop_lat, stop_lng, new_lat, new_lng, search_radius_m)
+    columns.update({depot: len(columns)+i for i, depot in enumerate(missing)})
+    cached_lat = np.concatenate((cached_lat, new_lat))
+    cached_lng = np.concatenate((cached_lng, new_lng))
+    time       = np.hstack((time,     new_time))
+    distance   = np.hstack((distance, new_distance))
+
+  #The cache may not hold the distance to a stop's closest depot if it was
+  #closest only among the depots in use now. Measure those routes.
+  idx        = np.array([columns[depot] for depot in wanted], dtype=np.int64)
+  rows       = np.arange(len(stop_lat))
+  closest    = idx[np.where(np.isnan(time[:, idx]), np.inf, time[:, idx]).argmin(axis=1)]
+  unmeasured = ~np.isnan(time[rows, closest]) & np.isnan(distance[rows, closest])
+  if unmeasured.any():
+    print(f"Measuring routes from {unmeasured.sum()} stops to their closest depots...")
+    distance[rows[unmeasured], closest[unmeasured]] = dispatch.GetPathDistances(
+      router,
+      stop_lat[unmeasured],
+      stop_lng[unmeasured],
+      cached_lat[closest[unmeasured]],
+      cached_lng[closest[unmeasured]],
+      search_radius_m
+    )
+
+  if len(missing)>0 or unmeasured.any():
+    with caching.AtomicWrite(filename) as temp_filename:
+      with open(temp_filename, 'wb') as fout:
+        np.savez(fout, depot_lat=cached_lat, depot_lng=cached_lng, time=time, distance=distance)
+
+  return time[:, idx], distance[:, idx]
+
+
+
+def GetNearestDepots(router, trips, stops, depots, search_radius_m=1000, graph_key=None, cache_dir=None):
+  """Adds `depot_id`, `depot_distance`, and `depot_time` columns to `stops`
+  giving the depot with the shortest travel time from each stop that starts or
+  ends a trip.
+
+  If `graph_key` is given the stop x depot travel matrix is cached in
+  `cache_dir`, which is then required (see `GetDepotMatrix()`); otherwise it is
+  computed afresh.
+  """
   stops = stops.copy()
   #Get set of stops that are actually at the end of trips
   trip_stops = set(trips.start_stop_id.tolist() + trips.end_stop_id.tolist())
   #Filter stops to this list
   trip_stops = stops['stop_id'].isin(trip_stops)
-  #For each trip stop, find its closest depot
-  ret = dispatch.GetClosestDepot(
-    router,
-    stops[trip_stops]['lat'].to_numpy(),
-    stops[trip_stops]['lng'].to_numpy(),
-    depots['lat'].to_numpy(),
-    depots['lng'].to_numpy(),
-    search_radius_m
-  )
   #Add columns to stops containing the depot information
   stops['depot_id']                      = -1
   stops['depot_distance']                = np.nan
   stops['depot_time']                    = np.nan
-  stops.loc[trip_stops,'depot_id']       = ret.depot_id
-  stops.loc[trip_stops,'depot_distance'] = ret.dist_to_depot
-  stops.loc[trip_stops,'depot_time']     = ret.time_to_depot
+
+  if graph_key is None:
+    #For each trip stop, find its closest depot
+    ret = dispatch.GetClosestDepot(
+      router,
+      stops[trip_stops]['lat'].to_numpy(),
+      stops[trip_stops]['lng'].to_numpy(),
+      depots['lat'].to_numpy(),
+      depots['lng'].to_numpy(),
+      search_radius_m
+    )
+    stops.loc[trip_stops,'depot_id']       = ret.depot_id
+    stops.loc[trip_stops,'depot_distance'] = ret.dist_to_depot
+    stops.loc[trip_stops,'depot_time']     = ret.time_to_depot
+    return stops
+
+  if len(depots)==0:
+    raise Exception("There are no depots!")
+  if cache_dir is None:
+    raise Exception("A cache_dir is needed to cache the depot matrix!")
+
+  time, distance = GetDepotMatrix(
+    router,
+    graph_key,
+    stops[trip_stops]['lat'].to_numpy(),
+    stops[trip_stops]['lng'].to_numpy(),
+    depots,
+    search_radius_m=search_radius_m,
+    cache_dir=cache_dir
+  )
+  #For each trip stop, take its closest reachable depot. Ties go to the first depot.
+  depot_id  = np.where(np.isnan(time), np.inf, time).argmin(axis=1)
+  rows      = np.arange(len(time))
+  reachable = ~np.isnan(time[rows, depot_id])
+  stops.loc[trip_stops,'depot_id']       = np.where(reachable, depot_id, -1)
+  stops.loc[trip_stops,'depot_distance'] = distance[rows, depot_id]
+  stops.loc[trip_stops,'depot_time']     = time[rows, depot_id]
   return stops
 
 
@@ -91,101 +303,193 @@ def generateParams(**kwargs):
   params.kwh_per_km            = kwargs.get('kwh_per_km',           1.2)        #kWh_per_km
   params.chargers_per_depot    = kwargs.get('chargers_per_depot',   1)          #TODO: Bad default
   # optimizer parameters
+  params.optimizer             = kwargs.get('optimizer',            'genetic')  #'genetic' or 'local_search'
+  params.local_search_start    = kwargs.get('local_search_start',   'none')     #Chargers at 'none' or 'all' candidate stops
   params.generations           = kwargs.get('generations',          [ 50,  50]) #,1000]
   params.mutation_rate         = kwargs.get('mutation_rate',        [0.1,0.05]) #,0.01]
   params.keep_top              = kwargs.get('keep_top',             [  5,   5]) #,   5]
   params.spawn_size            = kwargs.get('spawn_size',           [100, 100]) #,  50]
+  params.patience              = kwargs.get('patience',             [])         #Per stage generations without improvement before stopping early
+  params.min_improvement       = kwargs.get('min_improvement',      [])         #Per stage relative cost drop counted as an improvement
+  params.time_limit            = kwargs.get('time_limit',           [])         #Per stage seconds before stopping early
   params.restarts              = kwargs.get('restarts',             1)
+  params.migration_interval    = kwargs.get('migration_interval',   0) #Generations between restarts sharing their best layouts, 0 disables
   params.seed                  = kwargs.get('seed',                 0) #Initialize differently each time
+  params.fitness_cache_size    = kwargs.get('fitness_cache_size',   100_000) #Remembered charger layouts, 0 disables
   return params
 
-def simulate(input_prefix,
-             osm_data,
-             depots_filename,
-             parameters=None
-            ):
-  """ TODO Performs an optimized simulation
-      parameters, dict of simulation and optimizer parameters to be used, 
+def FleetCost(bus_count, charger_count, depot_count, battery_cap_kwh, bus_cost,
+              battery_cost_per_kwh, nondepot_charger_cost, depot_charger_cost,
+              chargers_per_depot):
+  """Returns the cost of a simulated fleet under the given prices, as
+  `calculate_cost` in `dispatch.cpp` would calculate it.
+
+  The fleet sizes come from `dispatch.ModelResults` (`bus_count`,
+  `charger_count`, `depot_count`) and only depend on the simulation
+  parameters, so one simulation can be repriced under many price assumptions.
+  Every argument may be a scalar or a NumPy array; arrays are broadcast
+  against each other.
+
+  Returns: Cost in dollars (float or np.array)
   """
+  bus_count     = np.asarray(bus_count)
+  charger_count = np.asarray(charger_count)
+  depot_count   = np.asarray(depot_count)
+  return (charger_count * nondepot_charger_cost
+          + bus_count * bus_cost
+          + bus_count * (battery_cap_kwh * battery_cost_per_kwh)
+          + (depot_count * chargers_per_depot) * depot_charger_cost)
 
-  print("Parsing OSM data into router...")
-  router = dispatch.Router(osm_data)
 
 
-  trips      = pd.read_csv(f"{input_prefix}_trips.csv")
-  stops      = pd.read_csv(f"{input_prefix}_stops.csv")
-  stop_times = pd.read_csv(f"{input_prefix}_stop_times.csv")
-  depots     = pd.read_csv(depots_filename)
+def LoadInputs(input_prefix, osm_data, depots_filename, cache_dir=None):
+  """Loads everything a simulation needs which doesn't depend on its
+  parameters, so that it can be shared by many scenarios.
 
-  #TODO error handling for malformed dict, maybe should be in generateParams()?
-  params = generateParams(**parameters)
+  Args:
+    input_prefix (str):    Prefix of the files written by `parse_gtfs.py`
+    osm_data (str):        OSM PBF file to route over
+    depots_filename (str): CSV of depots with `lat` and `lng` columns
+    cache_dir (str):       Where to cache routing data. See `GetRouter()`.
+
+  Returns: Dict with the `router`, the `trips`, the `stops` (with their nearest
+           depots) and the `depots`
+  """
+  print("Parsing OSM data into router...")
+  router = GetRouter(osm_data, cache_dir=cache_dir)
+
+  trips  = NumericIds(ReadParsedTable(input_prefix, 'trips', MODEL_TRIP_COLUMNS))
+  stops  = NumericIds(ReadParsedTable(input_prefix, 'stops', INPUT_STOP_COLUMNS))
+  if stops['stop_id'].duplicated().any():
+    raise Exception("Some stop ids are only distinct as strings (e.g. '012' and '12')!")
+  depots = pd.read_csv(depots_filename)
 
-  #TODO prettify output
-  print(f'Scenario Parameters: {params}')
   #TODO: Apply units to tables?
 
   #Modify the stops table to include depot_id, depot_distance, and depot_time
   #columns
   print("Getting nearest depots...")
-  stops = GetNearestDepots(router, trips, stops, depots, search_radius_m=1000)
+  stops = GetNearestDepots(router, trips, stops, depots, search_radius_m=1000,
+                           graph_key=f"{caching.FileHash(osm_data)}_{ROUTING_PROFILE}",
+                           cache_dir=caching.GetCacheDir(cache_dir, osm_data))
 
   #Ensure that depots are near a node in the road network
   print("Testing to see if all depots are near nodes...")
   if not DepotsHaveNodes(router, depots, search_radius_m=1000):
     raise Exception("One or more of the depots don't have road network nodes! Quitting.")
 
-  print("Creating model...")
-  model_info = dispatch.ModelInfo(params, trips.to_csv(), stops.to_csv())
+  return {'router':router, 'trips':trips, 'stops':stops, 'depots':depots}
+
+
+
+def RunScenario(inputs, params, model_info=None, seeds=None):
+  """Costs the no-charger and all-charger layouts and optimizes the charger
+  layout for one set of parameters.
+
+  Args:
+    inputs (dict):                    As returned by `LoadInputs()`
+    params (dispatch.Parameters):     Parameters of this scenario
+    model_info (dispatch.ModelInfo):  Model to reuse. Its parameters are
+                                      replaced with `params`. If None, a new
+                                      model is built from `inputs`.
+    seeds (list):                     `has_charger` dicts the optimizer starts
+                                      from in addition to having no chargers
+
+  Returns: Dict of results, including the `model_info` used
+  """
+  trips = inputs['trips']
+
+  #TODO prettify output
+  print(f'Scenario Parameters: {params}')
+
+  if model_info is None:
+    print("Creating model...")
+    model_info = dispatch.ModelInfo(params, TableColumns(trips, MODEL_TRIP_COLUMNS), TableColumns(inputs['stops'], MODEL_STOP_COLUMNS))
+    candidates = len(model_info.charger_candidates)
+    print(f"{candidates} of {model_info.trip_stop_count} stops can use a charger: "
+          f"the search space shrank by a factor of 2^{model_info.trip_stop_count-candidates}")
+  else:
+    model_info.update_params(params)
+
+  all_stops = set(trips['start_stop_id'].tolist() + trips['end_stop_id'].tolist())
 
   print("Cost with no chargers...")
   no_charger_scenario = dispatch.ModelResults()
-  no_charger_scenario.has_charger = {x:False for x in set(trips['start_stop_id'].tolist() + trips['end_stop_id'].tolist())}
+  no_charger_scenario.has_charger = {x:False for x in all_stops}
   dispatch.run_model(model_info, no_charger_scenario)
-  tripsdf = ConvertVectorOfStructsToDataFrame(no_charger_scenario.trips)
-  ncbuses = dispatch.count_buses(no_charger_scenario.trips)
+  ncbuses = no_charger_scenario.buses_per_depot
   nccost = no_charger_scenario.cost
-  nc_tot_buses = sum([x for x in ncbuses.values()])
-  nc_tot_chargers = sum([x for x in no_charger_scenario.has_charger.values()])
+  nc_tot_buses = no_charger_scenario.bus_count
+  nc_tot_chargers = no_charger_scenario.charger_count
   print(f"No Chargers Cost ${no_charger_scenario.cost:,.2f}")
   print(f"No Chargers Total buses: {nc_tot_buses}")
   print(f"No Chargers Total chargers: {nc_tot_chargers}")
-  
+
   print("Cost with all chargers...")
   all_charger_scenario = dispatch.ModelResults()
-  all_charger_scenario.has_charger = {x:True for x in set(trips['start_stop_id'].tolist() + trips['end_stop_id'].tolist())}
+  all_charger_scenario.has_charger = {x:True for x in all_stops}
   dispatch.run_model(model_info, all_charger_scenario)
-  tripsdf = ConvertVectorOfStructsToDataFrame(all_charger_scenario.trips)
-  acbuses = dispatch.count_buses(all_charger_scenario.trips)
+  acbuses = all_charger_scenario.buses_per_depot
   accost = all_charger_scenario.cost
-  ac_tot_buses = sum([x for x in acbuses.values()])
-  ac_tot_chargers = sum([x for x in all_charger_scenario.has_charger.values()])
+  ac_tot_buses = all_charger_scenario.bus_count
+  ac_tot_chargers = all_charger_scenario.charger_count #Only stops where a charger gets used
   print(f"No Chargers Cost ${all_charger_scenario.cost:,.2f}")
   print(f"No Chargers Total buses: {ac_tot_buses}")
   print(f"No Chargers Total chargers: {ac_tot_chargers}")
 
   print("Optimizing with chargers...")
-  results = dispatch.optimize_model(model_info)
-  tripsdf = ConvertVectorOfStructsToDataFrame(results.trips)
-  optibuses = dispatch.count_buses(results.trips)
-  opti_tot_buses = sum([x for x in optibuses.values()])
-  opti_tot_chargers = sum([x for x in results.has_charger.values()])
+  results = dispatch.optimize_model(model_info, seeds or [])
+  tripsdf = pd.DataFrame(results.trip_columns())
+  optibuses = results.buses_per_depot
+  opti_tot_buses = results.bus_count
+  opti_tot_chargers = results.charger_count
   cost = results.cost
   print(f"Optimized Cost ${results.cost:,.2f}")
   print(f"Optimized buses: {opti_tot_buses}")
   print(f"Optimized chargers: {opti_tot_chargers}")
-  
+  print(f"Optimizer stages stopped by: {list(results.stop_reasons)} after {list(results.generations_run)} generations")
+  depot_peaks, depot_occupancy = (pd.DataFrame(x) for x in results.depot_usage())
+
   full_results = {'opti_trips':tripsdf,
                   'opti_buses':opti_tot_buses,'opti_chargers':opti_tot_chargers,
                   'opti_cost':cost,'opti_depot_counts':optibuses,
+                  'opti_depot_peaks':depot_peaks,
+                  'opti_depot_occupancy':depot_occupancy,
+                  'opti_has_charger':results.has_charger,
+                  'opti_stop_reasons':list(results.stop_reasons),
+                  'opti_generations_run':list(results.generations_run),
                   'nc_buses':nc_tot_buses,'nc_chargers':nc_tot_chargers,
                   'nc_cost':nccost,'nc_depot_counts':ncbuses,
                   'ac_buses':ac_tot_buses,'ac_chargers':ac_tot_chargers,
                   'ac_cost':accost,'ac_depot_counts':acbuses,
+                  'opti_depots':results.depot_count,
+                  'nc_depots':no_charger_scenario.depot_count,
+                  'ac_depots':all_charger_scenario.depot_count,
+                  'model_info':model_info,
                   }
   # code.interact(local=dict(globals(), **locals())) #TODO
   return full_results
 
 
+
+def simulate(input_prefix,
+             osm_data,
+             depots_filename,
+             parameters=None,
+             cache_dir=None
+            ):
+  """ TODO Performs an optimized simulation
+      parameters, dict of simulation and optimizer parameters to be used, 
+      cache_dir, where to cache routing data. See `GetRouter()`.
+  """
+  inputs = LoadInputs(input_prefix, osm_data, depots_filename, cache_dir=cache_dir)
+
+  #TODO error handling for malformed dict, maybe should be in generateParams()?
+  params = generateParams(**(parameters or {}))
+
+  return RunScenario(inputs, params)
+
+
 #TODO: Used for testing
 #python3 sim.py "../../data/parsed_minneapolis" "../../data/minneapolis-saint-paul_minnesota.osm.pbf" "../../data/depots_minneapolis.csv" "/z/out"
 #python3 sim.py "../../data/parsed_utahtransportationauthority59" "../../data/osm_utahtransportationauthority59.osm.pbf" "../../data/depots_utahtransportationauthority59.csv" "/z/out"
@@ -197,12 +501,14 @@ def main():
   parser.add_argument('osm_data',           type=str, help='TODO')
   parser.add_argument('depots_filename',    type=str, help='TODO')
   parser.add_argument('--sim-parameters',   type=str, help='TODO') # a yaml config file
+  parser.add_argument('--cache-dir',        type=str, help='Where to cache routing data. Default: cache/ next to osm_data')
   args = parser.parse_args()
 
   print(f"parsed_gtfs_prefix: {args.parsed_gtfs_prefix}")
   print(f"osm_data:           {args.osm_data}")
   print(f"depots_filename:    {args.depots_filename}")
   print(f"sim_parameters:     {args.sim_parameters}")
+  print(f"cache_dir:          {args.cache_dir}")
 
   # sim_parameters assumed to be a yaml config file of k:v pairs mapping to the 
   # potential inputs to generateParams()
@@ -214,7 +520,8 @@ def main():
   bus_assignments, bus_counts, cost = simulate(args.parsed_gtfs_prefix, 
                                           args.osm_data,
                                           args.depots_filename,
-                                          parameters=params
+                                          parameters=params,
+                                          cache_dir=args.cache_dir
                                         )
 if __name__ == '__main__':
   main()
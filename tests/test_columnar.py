@@ -0,0 +1,37 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import columnar
+
+
+
+def test_id_strings_keep_leading_zeros_across_chunks(tmp_path):
+  dirname = str(tmp_path / 'stop_times')
+  columnar.WriteTable(dirname, pd.DataFrame({'stop_id': ['0012', '0013'], 'stop_duration': [1.0, 2.0]}), strings=['stop_id'])
+  columnar.AppendTable(dirname, pd.DataFrame({'stop_id': ['A1', None], 'stop_duration': [3.0, np.nan]}))
+
+  table = columnar.ReadTable(dirname)
+  assert table['stop_id'].iloc[:3].tolist() == ['0012', '0013', 'A1']
+  assert pd.isna(table['stop_id'].iloc[3])
+  assert table['stop_duration'].iloc[:3].tolist() == [1.0, 2.0, 3.0]
+
+
+
+def test_append_never_converts_stored_values(tmp_path):
+  dirname = str(tmp_path / 'table')
+  columnar.WriteTable(dirname, pd.DataFrame({'count': [1, 2]}))
+  before = open(os.path.join(dirname, 'count.bin'), 'rb').read()
+
+  with pytest.raises(Exception):
+    columnar.AppendTable(dirname, pd.DataFrame({'count': ['A1']}))
+  with pytest.raises(Exception):
+    columnar.AppendTable(dirname, pd.DataFrame({'count': [1.5]}))
+
+  assert open(os.path.join(dirname, 'count.bin'), 'rb').read() == before
+  assert columnar.ReadTable(dirname)['count'].tolist() == [1, 2]